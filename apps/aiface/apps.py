@@ -1,5 +1,16 @@
+import importlib
+
 from django.apps import AppConfig
+from django.conf import settings
+
+from utils.lazy import preload
+
 
+class AifaceConfig(AppConfig):
+    name = 'apps.aiface'
 
-class AppsConfig(AppConfig):
-    name = 'apps'
+    def ready(self):
+        if settings.AIFACE_PRELOAD:
+            # the views pull in every module with a lazy_import, then load them all before any fork
+            importlib.import_module('apps.aiface.views')
+            preload()
@@ -0,0 +1,310 @@
+import asyncio
+import io
+import json
+import sys
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import JsonResponse
+from hurry.filesize import size
+
+from apps.aiface.cache import detect_cache
+from apps.aiface.clients import aip_face, baidu_detect, baidu_retryable, new_aipface
+from apps.aiface.preprocess import rescale_result
+from apps.aiface.response import render
+from apps.aiface.uploadhandler import guard_image_upload
+from apps.aiface.views import (detect_cacheable, detect_image, detect_options, encode_upload, index_upload,
+                               save_result)
+from utils import timing
+from utils.lazy import lazy_import
+from utils.resilience import ResilienceError, get_policy
+from utils.timing import stage
+
+# httpx and the baidu sdk load on the first detect, like in clients.py
+httpx = lazy_import('httpx')
+
+# room for the multipart boundaries and the other form fields next to the image
+MULTIPART_OVERHEAD = 64 * 1024
+
+# access token expired before its expires_in, see AipBase._request
+BAIDU_TOKEN_EXPIRED = 110
+
+# the body was not json, e.g. the error page of a proxy in front of the api
+BAD_RESPONSE = 'AIFACE_BAD_RESPONSE'
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def async_retryable(result, error):
+    if error is not None:
+        return isinstance(error, httpx.TransportError)
+    return result.get('error_code') == BAD_RESPONSE or baidu_retryable(result, None)
+
+
+class AsyncBaiduClient:
+    """
+    AipFace.detect on httpx, at most max_inflight requests on the wire at once
+    the access token comes from the shared token cache, read in a thread when the copy here expires
+    """
+
+    def __init__(self, max_inflight=None):
+        self.max_inflight = max_inflight or settings.AIFACE_ASGI_MAX_INFLIGHT
+        self._aip = None
+        self._loop = None
+        self._token = None
+        self._token_expires = 0
+
+    def _bind(self):
+        # asyncio primitives belong to the loop they were made on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+            self._token_lock = asyncio.Lock()
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(settings.AIFACE_API_DEADLINE, connect=settings.AIFACE_API_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=self.max_inflight, max_keepalive_connections=self.max_inflight),
+            )
+
+    def _auth(self, refresh=False):
+        if self._aip is None:
+            self._aip = new_aipface()
+        auth = self._aip._auth(refresh)
+        # cloud users sign every request instead, there is no token to pass along
+        token = None if self._aip._isCloudUser else auth['access_token']
+        return token, auth['time'] + int(auth.get('expires_in', 0)) - 30
+
+    async def token(self, refresh=False):
+        """
+        :return: the access token, None for a cloud user
+        """
+        async with self._token_lock:
+            if refresh or time.time() >= self._token_expires:
+                self._token, self._token_expires = await sync_to_async(self._auth, thread_sensitive=False)(refresh)
+            return self._token
+
+    async def _post(self, data, token) -> dict:
+        params = {'access_token': token, 'aipSdk': 'python', 'aipVersion': self._aip.getVersion()}
+        try:
+            response = await self._http.post(aip_face.AipFace._AipFace__detectUrl, content=data, params=params,
+                                             headers={'Content-Type': 'application/json'})
+        except httpx.TimeoutException:
+            # what the sdk answers on a timeout, so BAIDU_RETRYABLE covers both paths
+            return {'error_code': 'SDK108', 'error_msg': 'connection or read data timeout'}
+        try:
+            return response.json() or {}
+        except ValueError:
+            return {'error_code': BAD_RESPONSE, 'error_msg': f'{response.status_code}: {response.text[:200]}'}
+
+    async def _detect(self, data, image, image_type, options) -> dict:
+        async with self._semaphore:
+            token = await self.token()
+            if token is None:
+                return await sync_to_async(baidu_detect, thread_sensitive=False)(image, image_type, options)
+
+            result = await self._post(data, token)
+            if result.get('error_code') == BAIDU_TOKEN_EXPIRED:
+                result = await self._post(data, await self.token(refresh=True))
+            return result
+
+    async def detect(self, image, image_type, options) -> dict:
+        """
+        :raise utils.resilience.ResilienceError: the breaker is open or the deadline passed
+        """
+        self._bind()
+        data = json.dumps({'image': image, 'image_type': image_type, **options}, ensure_ascii=False).encode()
+        return await get_policy('baidu_detect').call_async(lambda: self._detect(data, image, image_type, options),
+                                                           retryable=async_retryable)
+
+    async def close(self):
+        if self._loop is not None:
+            await self._http.aclose()
+            self._loop = None
+
+
+async_baidu_client = AsyncBaiduClient()
+
+
+def build_request(scope, body: bytes) -> WSGIRequest:
+    """
+    the WSGIRequest django would have built for the same request
+    """
+    script_name = scope.get('root_path', '')
+    path_info = scope['path']
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode().decode('latin1'),
+        'PATH_INFO': path_info.encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+        'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    # the body is all here already, chunked uploads included
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return WSGIRequest(environ)
+
+
+async def read_body(receive, limit):
+    """
+    :return: the request body, None when the client hung up
+    :raise BodyTooLarge: over limit bytes, nothing more is read
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > limit:
+            raise BodyTooLarge()
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def send_response(send, response):
+    headers = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.content})
+
+
+def prepare_index(scope, body):
+    """
+    the blocking part before the api call, parsing, validation and base64, run in a thread
+    :return: (response, None) when there is nothing left to ask, otherwise (None, state for finish_index)
+    """
+    request = build_request(scope, body)
+    img, fields, fmt, error = guard_image_upload(index_upload)(request)
+    if error is not None:
+        return error, None
+
+    options = detect_options(fields)
+    stream = encode_upload(img)
+    state = {
+        'client_id': request.META.get('HTTP_X_CID', ''),
+        'fields': fields,
+        'fmt': fmt,
+        'options': options,
+        'digest': stream['md5'],
+        'key': detect_cache.make_key(stream['md5'], options),
+    }
+    state['result'] = detect_cache.get(state['key'])
+    if state['result'] is None:
+        state['image'], state['scale'] = detect_image(img, stream)
+    return None, state
+
+
+def finish_index(state):
+    result = state['result']
+    if state.get('leader') and detect_cacheable(result):
+        detect_cache.set(state['key'], result)
+    result = save_result(state['digest'], state['client_id'], state['fields'], result)
+    with stage('serialize'):
+        return render(result, state['fmt'])
+
+
+class AsyncDetectApplication:
+    """
+    POST / (views.index) on the event loop, the detect call no longer holds a thread while baidu thinks
+    everything else goes to the wsgi application, which asgiref runs in its thread pool
+    """
+
+    def __init__(self, wsgi_application, client=None):
+        self.wsgi_application = wsgi_application
+        self.client = client or async_baidu_client
+        self._inflight = {}  # cache key: detect task
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/':
+            return await self.index(scope, receive, send)
+        return await self.wsgi_application(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.client.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def index(self, scope, receive, send):
+        token = timing.begin_request()
+        start = time.perf_counter()
+        try:
+            response = await self.handle_index(scope, receive)
+        finally:
+            entries = timing.end_request(token)
+
+        if response is None:  # the client went away
+            return
+        total = time.perf_counter() - start
+        timing.record('total', total)
+        response['Server-Timing'] = timing.server_timing(entries + [('total', total)])
+        await send_response(send, response)
+
+    async def handle_index(self, scope, receive):
+        max_bytes = settings.AIFACE_UPLOAD_MAX_BYTES
+        try:
+            body = await read_body(receive, max_bytes + MULTIPART_OVERHEAD)
+        except BodyTooLarge:
+            return JsonResponse({'msg': f'图片大小: 超过{size(max_bytes)}'})
+        if body is None:
+            return None
+
+        response, state = await sync_to_async(prepare_index, thread_sensitive=False)(scope, body)
+        if response is not None:
+            return response
+
+        if state['result'] is None:
+            task, state['leader'] = self.detect_once(state)
+            with stage('detect'):
+                # shielded, a client hanging up doesn't cancel the call the others wait for
+                state['result'] = await asyncio.shield(task)
+
+        return await sync_to_async(finish_index, thread_sensitive=False)(state)
+
+    def detect_once(self, state):
+        """
+        the event loop side of DetectCache.get_or_call, one detect call per cache key
+        :return: (task, True when this request started it and caches its result)
+        """
+        key = state['key']
+        task = self._inflight.get(key)
+        if task is not None:
+            return task, False
+
+        task = asyncio.ensure_future(self.detect(state['image'], state['options'], state['scale']))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task, True
+
+    async def detect(self, image, options, scale) -> dict:
+        """
+        views.aiface_baidu_api's detect, every request waiting on it shares the result it returns
+        """
+        try:
+            result = await self.client.detect(image, 'BASE64', options)
+        except ResilienceError as err:
+            return {'error_code': 'AIFACE_UNAVAILABLE', 'error_msg': str(err)}
+        # once, in the shared task, rescale_result works in place
+        return rescale_result(result, scale)
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# detect options that change the api result, anything else is left out of the cache key
+KEY_OPTIONS = ('face_field', 'max_face_num', 'face_type')
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DetectCache:
+    def __init__(self, max_entries=None, ttl=None, disk_dir=None, disk_max_bytes=None):
+        """
+        detect results keyed by image digest + options
+        :param max_entries:     in-memory LRU capacity
+        :param ttl:             seconds before an entry goes stale, for both tiers
+        :param disk_dir:        optional directory for the on-disk tier, None to disable it
+        :param disk_max_bytes:  the oldest files are evicted once the disk tier grows past this
+        """
+        self.max_entries = max_entries or settings.AIFACE_CACHE_ENTRIES
+        self.ttl = ttl or settings.AIFACE_CACHE_TTL
+        disk_dir = disk_dir or settings.AIFACE_CACHE_DIR
+        self.disk_dir = pathlib.Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes or settings.AIFACE_CACHE_DIR_MAX_BYTES
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key: (expires_at, result)
+        self._inflight = {}
+        self._disk_bytes = None
+
+    @staticmethod
+    def make_key(digest, options):
+        """
+        :param digest:  md5 hexdigest of the image bytes
+        :param options: options passed to AipFace.detect
+        """
+        picked = {name: options.get(name) for name in KEY_OPTIONS}
+        raw = digest + json.dumps(picked, sort_keys=True)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+
+        result = self._disk_get(key, now)
+        if result is not None:
+            self._memory_set(key, result, now)
+        return result
+
+    def set(self, key, result):
+        now = time.time()
+        self._memory_set(key, result, now)
+        self._disk_set(key, result)
+
+    def get_or_call(self, key, func, cacheable=lambda result: True):
+        """
+        return the cached result, or call func() once no matter how many threads ask for the same key
+        :param func:        makes the actual api call
+        :param cacheable:   results failing this check are handed to the waiting callers but not stored
+        """
+        result = self.get(key)
+        if result is not None:
+            return result
+
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            if cacheable(call.result):
+                self.set(key, call.result)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+        return call.result
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def _memory_set(self, key, result, now):
+        with self._lock:
+            self._memory[key] = (now + self.ttl, result)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        return self.disk_dir.joinpath(key[:2], f'{key}.json')
+
+    def _disk_get(self, key, now):
+        if self.disk_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            if path.stat().st_mtime + self.ttl <= now:
+                path.unlink()
+                return None
+            with path.open('r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_set(self, key, result):
+        if self.disk_dir is None:
+            return
+
+        path = self._disk_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps(result, ensure_ascii=False).encode()
+
+        # write to a temp file first so readers never see half a json
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent.as_posix(), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path.as_posix())
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            self._disk_bytes += len(data)
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._disk_evict()
+
+    def _disk_files(self):
+        for path in self.disk_dir.glob('*/*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+    def _disk_evict(self):
+        files = sorted(self._disk_files())
+        total = sum(size for _, size, _ in files)
+        expired_before = time.time() - self.ttl
+
+        # drop expired files first, then the oldest ones until we are back under 90% of the budget
+        for mtime, size, path in files:
+            if mtime > expired_before and total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+
+        with self._lock:
+            self._disk_bytes = total
+
+
+detect_cache = DetectCache()
@@ -0,0 +1,173 @@
+import functools
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from utils.lazy import lazy_import
+from utils.resilience import get_policy
+from utils.tokencache import TokenCache
+
+# the baidu sdk brings requests along, both load on the first client
+aip_base = lazy_import('aip.base')
+aip_face = lazy_import('aip.face')
+requests = lazy_import('requests')
+
+# detect error codes worth another try: 2 service unavailable, 4 cluster over limit, 18 qps limit,
+# 282000 internal error, SDK108 the sdk's own connect / read timeout
+BAIDU_RETRYABLE = frozenset((2, 4, 18, 282000, 'SDK108'))
+
+
+def baidu_retryable(result, error):
+    """
+    the retryable argument of utils.resilience.Resilient.call for AipFace calls
+    """
+    if error is not None:
+        return isinstance(error, requests.exceptions.RequestException)
+    return result.get('error_code') in BAIDU_RETRYABLE
+
+
+def fetch_baidu_token() -> dict:
+    """
+    what AipBase._auth asks for, the error response as it is when the credentials are wrong
+    """
+    token = requests.get(aip_base.AipBase._AipBase__accessTokenUrl, params={
+        'grant_type': 'client_credentials',
+        'client_id': settings.API_KEY,
+        'client_secret': settings.SECRET,
+    }, timeout=(settings.AIFACE_API_CONNECT_TIMEOUT, settings.AIFACE_API_DEADLINE)).json()
+    token['time'] = int(time.time())
+    return token
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache() -> TokenCache:
+    global _token_cache
+    with _token_cache_lock:
+        if _token_cache is None:
+            path = settings.AIFACE_TOKEN_CACHE_PATH or os.path.join(settings.UPLOAD_DIR, 'baidu_token.json')
+            _token_cache = TokenCache(path, fetch_baidu_token, margin=settings.AIFACE_TOKEN_REFRESH_MARGIN,
+                                      retry_interval=settings.AIFACE_TOKEN_RETRY_INTERVAL)
+        return _token_cache
+
+
+def _shared_auth(client, refresh=False):
+    # refresh comes from an error 110, only the token that was just rejected gets replaced
+    stale = client._authObj.get('access_token') if refresh else None
+    token = get_token_cache().get(stale=stale)
+    client._isCloudUser = not client._isPermission(token)
+    client._authObj = token
+    return token
+
+
+def new_aipface():
+    """
+    AipFace with the api timeouts, taking its access token from the host wide TokenCache instead of
+    fetching one per instance
+    """
+    client = aip_face.AipFace(settings.APP_ID, settings.API_KEY, settings.SECRET)
+    # the deadline of utils.resilience stops waiting, these stop the request itself
+    client.setConnectionTimeoutInMillis(settings.AIFACE_API_CONNECT_TIMEOUT * 1000)
+    client.setSocketTimeoutInMillis(settings.AIFACE_API_DEADLINE * 1000)
+    client._auth = functools.partial(_shared_auth, client)
+    return client
+
+
+class AipFacePool:
+    def __init__(self, size=None, idle_timeout=None):
+        """
+        process-wide pool of AipFace clients, each one owns a keep-alive requests.Session
+        :param size:            max clients alive at the same time, settings.AIFACE_POOL_SIZE by default
+        :param idle_timeout:    seconds a client may sit idle before its connections are dropped,
+                                settings.AIFACE_POOL_IDLE_TIMEOUT by default
+        """
+        self.size = size or settings.AIFACE_POOL_SIZE
+        self.idle_timeout = idle_timeout or settings.AIFACE_POOL_IDLE_TIMEOUT
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # sockets inherited from the parent process must never be reused, start from scratch
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _new_client(self):
+        client = new_aipface()
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        # AipBase sends every request through `self.__client`, the `requests` module by default
+        client._AipBase__client = session
+        return client
+
+    @staticmethod
+    def _close(client):
+        client._AipBase__client.close()
+
+    def _checkout(self):
+        while True:
+            try:
+                client, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new_client()
+
+            if time.monotonic() - released_at < self.idle_timeout:
+                return client
+            self._close(client)  # the server has most likely dropped the connection anyway
+
+    @contextmanager
+    def client(self):
+        """
+        borrow a client, blocks while all `size` clients are in use
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle, slots = self._idle, self._slots
+
+        slots.acquire()
+        try:
+            client = self._checkout()
+            try:
+                yield client
+            finally:
+                idle.put((client, time.monotonic()))
+        finally:
+            slots.release()
+
+    def clear(self):
+        while True:
+            try:
+                client, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(client)
+
+
+aipface_pool = AipFacePool()
+
+if hasattr(os, 'register_at_fork'):
+    # gunicorn forks workers after the app is loaded, drop the parent's clients in the child
+    os.register_at_fork(after_in_child=aipface_pool._reset)
+
+
+def baidu_detect(image, image_type, options) -> dict:
+    """
+    AipFace.detect with the baidu_detect resilience policy
+    :raise utils.resilience.ResilienceError: the breaker is open or the deadline passed
+    """
+    def call():
+        # every retry or hedged copy borrows its own client
+        with aipface_pool.client() as client:
+            return client.detect(image, image_type, options)
+
+    return get_policy('baidu_detect').call(call, retryable=baidu_retryable)
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import pathlib
+import socket
+import tempfile
+import types
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import close_old_connections
+from django.utils import timezone
+from rest_framework import status
+
+from apps.aiface.models import Job, JobStatus
+from apps.aiface.uploadhandler import MAGIC_LENGTH, sniff_content_type
+from utils.fileutil import stream_file
+from utils.imageutil import FACE_SEGMENTS, ImgSegments, face_api, face_segments_save, get_img_path, match_face_shapes
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = (JobStatus.QUEUED, JobStatus.RUNNING)
+EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png'}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobError(Exception):
+    pass
+
+
+def job_dir() -> pathlib.Path:
+    return pathlib.Path(settings.AIFACE_JOB_DIR or os.path.join(settings.UPLOAD_DIR, 'jobs'))
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def depth() -> int:
+    return Job.objects.filter(status__in=ACTIVE).count()
+
+
+def submit(img, client_id='') -> Job:
+    """
+    keep the upload on disk and queue it, the caller gets the job right away
+    :param img:     validated UploadedFile
+    :raise QueueFull: AIFACE_JOB_MAX_DEPTH jobs are already waiting, checked before anything is written
+    """
+    max_depth = settings.AIFACE_JOB_MAX_DEPTH
+    if depth() >= max_depth:
+        raise QueueFull(f'队列已满: {max_depth}')
+
+    img.seek(0)
+    ext = EXTENSIONS[sniff_content_type(img.read(MAGIC_LENGTH))]
+    digest = stream_file(img, hasher=('md5',))['md5']
+    path = _store_upload(img, f'{digest}.{ext}')
+    return Job.objects.create(client_id=client_id, digest=digest, upload=path.as_posix(), visible_at=timezone.now())
+
+
+def _store_upload(img, name) -> pathlib.Path:
+    directory = job_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / name
+    if path.exists():  # same bytes, same name
+        return path
+
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as des:
+            for chunk in img.chunks():
+                des.write(chunk)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+def claim(worker) -> Job:
+    """
+    take the oldest visible job, the lease runs for AIFACE_JOB_VISIBILITY_TIMEOUT seconds
+    attempts works as a version, only one worker gets to bump it
+    :return: the claimed job, None when nothing is ready
+    """
+    now = timezone.now()
+    candidates = (Job.objects.filter(status__in=ACTIVE, visible_at__lte=now)
+                  .order_by('visible_at', 'id').values_list('id', 'status', 'attempts')[:10])
+
+    for job_id, job_status, attempts in candidates:
+        unchanged = Job.objects.filter(id=job_id, status=job_status, attempts=attempts, visible_at__lte=now)
+        if attempts >= settings.AIFACE_JOB_MAX_ATTEMPTS:
+            # the worker of the last attempt never came back
+            if unchanged.update(status=JobStatus.FAILED, error='visibility timeout', finished=now):
+                _remove_upload(Job.objects.get(id=job_id))
+            continue
+
+        lease = timedelta(seconds=settings.AIFACE_JOB_VISIBILITY_TIMEOUT)
+        if unchanged.update(status=JobStatus.RUNNING, attempts=attempts + 1, worker=worker, visible_at=now + lease):
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def _leased(job):
+    # lost the lease when the job timed out and someone else claimed it
+    return Job.objects.filter(id=job.id, status=JobStatus.RUNNING, attempts=job.attempts, worker=job.worker)
+
+
+def finish(job, result) -> bool:
+    done = _leased(job).update(status=JobStatus.DONE, result=json.dumps(result, ensure_ascii=False), error='',
+                               finished=timezone.now())
+    if done:
+        _remove_upload(job)
+    return bool(done)
+
+
+def retry(job, error) -> bool:
+    """
+    back to the queue with an exponential delay, failed for good after AIFACE_JOB_MAX_ATTEMPTS
+    """
+    now = timezone.now()
+    if job.attempts >= settings.AIFACE_JOB_MAX_ATTEMPTS:
+        failed = _leased(job).update(status=JobStatus.FAILED, error=error, finished=now)
+        if failed:
+            _remove_upload(job)
+        return bool(failed)
+
+    delay = timedelta(seconds=settings.AIFACE_JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+    return bool(_leased(job).update(status=JobStatus.QUEUED, error=error, visible_at=now + delay))
+
+
+def _remove_upload(job):
+    # another job may have uploaded the same bytes
+    if Job.objects.filter(upload=job.upload, status__in=ACTIVE).exists():
+        return
+    try:
+        os.unlink(job.upload)
+    except FileNotFoundError:
+        pass
+
+
+def process(job) -> dict:
+    """
+    face_api + face_segments_save of the stored upload
+    :return: the tencent result, the relative path of every segment of the first face in segments and of
+             each face in faces
+    """
+    person_result = types.SimpleNamespace(user=types.SimpleNamespace(client_id=job.client_id or 'anonymous'),
+                                          face_img_name=os.path.basename(job.upload))
+
+    with open(job.upload, 'rb') as f:
+        image = File(f, name=person_result.face_img_name)
+        data, status_code = face_api(stream_file(image, hasher=('base64',))['base64'])
+        if status_code != status.HTTP_200_OK:
+            raise JobError(data)
+        if not data.get('FaceInfos'):
+            return {'data': data, 'segments': {}, 'faces': []}
+
+        image.seek(0)
+        data = face_segments_save(data, image, person_result)
+
+    faces = [{segment: get_img_path(segment, person_result, face_index=index) for segment in FACE_SEGMENTS}
+             for index in range(len(match_face_shapes(data)))]
+    full = get_img_path(ImgSegments.FULL, person_result)
+    return {'data': data, 'segments': {ImgSegments.FULL: full, **(faces[0] if faces else {})}, 'faces': faces}
+
+
+def run(job) -> bool:
+    try:
+        result = process(job)
+    except Exception as err:
+        logger.exception('job %s failed, attempt %s', job.id, job.attempts)
+        return retry(job, f'{type(err).__name__}: {err}')
+    return finish(job, result)
+
+
+def work(stop, worker=None, poll_interval=None):
+    """
+    claim and run jobs until stop (a threading / multiprocessing Event) is set
+    """
+    worker = worker or worker_name()
+    poll_interval = poll_interval or settings.AIFACE_JOB_POLL_INTERVAL
+    while not stop.is_set():
+        close_old_connections()
+        job = claim(worker)
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+        run(job)
+
+
+def job_to_dict(job) -> dict:
+    item = {
+        'job_id': job.pk,
+        'status': job.status,
+        'attempts': job.attempts,
+        'digest': job.digest,
+        'created': job.created.isoformat(),
+        'finished': job.finished.isoformat() if job.finished else None,
+    }
+    if job.status == JobStatus.DONE:
+        item['result'] = json.loads(job.result)
+    elif job.error:
+        item['msg'] = job.error
+    return item
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.startup import ENTRIES, profile
+
+
+class Command(BaseCommand):
+    help = 'import time tree and time to first request of a fresh worker, fails over the startup budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/metrics/', help='url of the first request')
+        parser.add_argument('--entry', choices=ENTRIES, action='append',
+                            help='wsgi (django.setup) or asgi (config.asgi), both by default')
+        parser.add_argument('--min-ms', type=float, default=5, help='leave out imports faster than this')
+        parser.add_argument('--depth', type=int, default=3)
+        parser.add_argument('--budget-ms', type=float, default=settings.AIFACE_STARTUP_BUDGET_MS,
+                            help='max time to first request, 0 for no limit')
+
+    def handle(self, *args, **options):
+        errors = []
+        for entry in options['entry'] or ENTRIES:
+            errors += self.profile_entry(entry, options)
+        if errors:
+            raise CommandError('; '.join(errors))
+
+    def profile_entry(self, entry, options) -> list:
+        report = profile(options['path'], entry=entry)
+
+        self.stdout.write(f'{entry}:')
+        self.stdout.write(f'{"total ms":>9} {"self ms":>9}  module')
+        for depth, name, self_seconds, cumulative in report['imports']:
+            if depth <= options['depth'] and cumulative * 1000 >= options['min_ms']:
+                self.stdout.write(f'{cumulative * 1000:9.1f} {self_seconds * 1000:9.1f}  {"  " * depth}{name}')
+
+        self.stdout.write(f"setup: {report['setup'] * 1000:.1f}ms")
+        self.stdout.write(f"first request: {report['first_request'] * 1000:.1f}ms "
+                          f"({options['path']} {report['status']})")
+        self.stdout.write(f"imported before first use: {', '.join(report['eager']) or '-'}")
+
+        errors = []
+        budget_ms = options['budget_ms']
+        if budget_ms and report['first_request'] * 1000 > budget_ms:
+            errors.append(f"{entry}: first request after {report['first_request'] * 1000:.0f}ms, "
+                          f"budget {budget_ms:.0f}ms")
+        # with AIFACE_PRELOAD they are imported on purpose
+        if report['eager'] and not settings.AIFACE_PRELOAD:
+            errors.append(f"{entry}: imported at startup: {', '.join(report['eager'])}, import them with lazy_import")
+        return errors
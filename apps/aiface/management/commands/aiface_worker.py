@@ -0,0 +1,52 @@
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from apps.aiface import jobs
+
+
+def _child(stop):
+    # the parent takes care of the signals, children stop through the event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    jobs.work(stop)
+
+
+class Command(BaseCommand):
+    help = 'run face_api + face_segments_save for the queued jobs in worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.AIFACE_JOB_WORKERS)
+
+    def handle(self, *args, **options):
+        ctx = multiprocessing.get_context('fork')
+        stop = ctx.Event()
+
+        # setting the event from a handler that interrupted stop.wait() deadlocks on its lock, just note it here
+        signals = []
+        signal.signal(signal.SIGINT, lambda signum, frame: signals.append(signum))
+        signal.signal(signal.SIGTERM, lambda signum, frame: signals.append(signum))
+
+        # a connection must not be shared with the forked children
+        connections.close_all()
+
+        procs = {}
+        while not signals:
+            for slot in range(options['processes']):
+                proc = procs.get(slot)
+                if proc is not None and proc.is_alive():
+                    continue
+                if proc is not None:
+                    self.stderr.write(f'worker {proc.pid} exited with {proc.exitcode}, restarting it')
+                procs[slot] = proc = ctx.Process(target=_child, args=(stop,), name=f'aiface_worker{slot}')
+                proc.start()
+            time.sleep(1)
+
+        self.stdout.write('stopping, running jobs finish first')
+        stop.set()
+        for proc in procs.values():
+            proc.join()
@@ -0,0 +1,25 @@
+import time
+
+from utils import timing
+
+
+class ServerTimingMiddleware:
+    """
+    collects the utils.timing stages of a request into a Server-Timing header
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = timing.begin_request()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            entries = timing.end_request(token)
+
+        total = time.perf_counter() - start
+        timing.record('total', total)
+        response['Server-Timing'] = timing.server_timing(entries + [('total', total)])
+        return response
@@ -0,0 +1,76 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Face',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField(help_text='position in face_list')),
+                ('face_token', models.CharField(blank=True, default='', max_length=64)),
+                ('left', models.FloatField(default=0)),
+                ('top', models.FloatField(default=0)),
+                ('width', models.FloatField(default=0)),
+                ('height', models.FloatField(default=0)),
+                ('rotation', models.FloatField(default=0)),
+                ('probability', models.FloatField(blank=True, null=True)),
+                ('age', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('beauty', models.FloatField(blank=True, null=True)),
+                ('gender', models.CharField(blank=True, default='', max_length=16)),
+                ('attributes', models.TextField(default='{}', help_text='json of the other face_field attributes')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FaceImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, help_text='md5 of the image bytes', max_length=32)),
+                ('client_id', models.CharField(blank=True, default='', max_length=64)),
+                ('provider', models.CharField(default='baidu', max_length=16)),
+                ('face_field', models.CharField(blank=True, default='', max_length=255)),
+                ('face_num', models.PositiveSmallIntegerField(default=0)),
+                ('log_id', models.BigIntegerField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Landmark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(help_text='landmark, landmark72 ...', max_length=16)),
+                ('points', models.TextField(help_text='json [x0, y0, x1, y1, ...]')),
+                ('face', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='landmarks', to='aiface.Face')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='faceimage',
+            index=models.Index(fields=['client_id', '-id'], name='aiface_image_client_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='faceimage',
+            unique_together={('digest', 'client_id', 'face_field')},
+        ),
+        migrations.AddField(
+            model_name='face',
+            name='image',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='faces', to='aiface.FaceImage'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='landmark',
+            unique_together={('face', 'kind')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='face',
+            unique_together={('image', 'index')},
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aiface', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'QUEUED'), ('running', 'RUNNING'), ('done', 'DONE'), ('failed', 'FAILED')], default='queued', max_length=16)),
+                ('client_id', models.CharField(blank=True, default='', max_length=64)),
+                ('digest', models.CharField(help_text='md5 of the image bytes', max_length=32)),
+                ('upload', models.CharField(help_text='path of the stored upload', max_length=255)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('visible_at', models.DateTimeField()),
+                ('worker', models.CharField(blank=True, default='', help_text='who holds the running job', max_length=64)),
+                ('result', models.TextField(blank=True, default='', help_text='json')),
+                ('error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'visible_at'], name='aiface_job_claim_idx'),
+        ),
+    ]
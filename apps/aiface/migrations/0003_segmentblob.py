@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aiface', '0002_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SegmentBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_id', models.CharField(max_length=64)),
+                ('segment', models.CharField(max_length=16)),
+                ('image', models.CharField(help_text='face_img_name', max_length=64)),
+                ('digest', models.CharField(help_text='sha256 of the file', max_length=64)),
+                ('blob', models.CharField(help_text='path under the blob store root', max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('client_id', 'image', 'segment')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aiface', '0003_segmentblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentblob',
+            name='size',
+            field=models.PositiveIntegerField(help_text='AIFACE_SEGMENT_SIZE of the crop, null for full size', null=True),
+        ),
+    ]
@@ -1,3 +1,122 @@
-from django.db import models
+from django.db import models, transaction
+from djchoices import ChoiceItem, DjangoChoices
 
-# Create your models here.
+
+class FaceImage(models.Model):
+    """
+    one analysed upload, the same image can show up once per client and face_field
+    """
+    digest = models.CharField(max_length=32, db_index=True, help_text='md5 of the image bytes')
+    client_id = models.CharField(max_length=64, blank=True, default='')
+    provider = models.CharField(max_length=16, default='baidu')
+    face_field = models.CharField(max_length=255, blank=True, default='')
+    face_num = models.PositiveSmallIntegerField(default=0)
+    log_id = models.BigIntegerField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('digest', 'client_id', 'face_field')
+        indexes = [
+            models.Index(fields=['client_id', '-id'], name='aiface_image_client_idx'),
+        ]
+
+
+class Face(models.Model):
+    image = models.ForeignKey(FaceImage, related_name='faces', on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField(help_text='position in face_list')
+    face_token = models.CharField(max_length=64, blank=True, default='')
+
+    # location
+    left = models.FloatField(default=0)
+    top = models.FloatField(default=0)
+    width = models.FloatField(default=0)
+    height = models.FloatField(default=0)
+    rotation = models.FloatField(default=0)
+    probability = models.FloatField(null=True, blank=True)
+
+    # the attributes analytics filters on most, everything else stays in `attributes`
+    age = models.PositiveSmallIntegerField(null=True, blank=True)
+    beauty = models.FloatField(null=True, blank=True)
+    gender = models.CharField(max_length=16, blank=True, default='')
+    attributes = models.TextField(default='{}', help_text='json of the other face_field attributes')
+
+    class Meta:
+        unique_together = ('image', 'index')
+
+
+class Landmark(models.Model):
+    face = models.ForeignKey(Face, related_name='landmarks', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16, help_text='landmark, landmark72 ...')
+    points = models.TextField(help_text='json [x0, y0, x1, y1, ...]')
+
+    class Meta:
+        unique_together = ('face', 'kind')
+
+
+class JobStatus(DjangoChoices):
+    QUEUED = ChoiceItem('queued')
+    RUNNING = ChoiceItem('running')
+    DONE = ChoiceItem('done')
+    FAILED = ChoiceItem('failed')
+
+
+class Job(models.Model):
+    """
+    one upload waiting for face_api + face_segments_save, see apps/aiface/jobs.py
+
+    a job can be claimed while it is queued or running once visible_at has passed,
+    a running job past visible_at belongs to a worker that died or hung
+    """
+    status = models.CharField(max_length=16, choices=JobStatus.choices, default=JobStatus.QUEUED)
+    client_id = models.CharField(max_length=64, blank=True, default='')
+    digest = models.CharField(max_length=32, help_text='md5 of the image bytes')
+    upload = models.CharField(max_length=255, help_text='path of the stored upload')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    visible_at = models.DateTimeField()
+    worker = models.CharField(max_length=64, blank=True, default='', help_text='who holds the running job')
+    result = models.TextField(blank=True, default='', help_text='json')
+    error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'visible_at'], name='aiface_job_claim_idx'),
+        ]
+
+
+class SegmentBlob(models.Model):
+    """
+    which blob of utils.blobstore holds a segment of an image a client uploaded
+    """
+    client_id = models.CharField(max_length=64)
+    segment = models.CharField(max_length=16)
+    image = models.CharField(max_length=64, help_text='face_img_name')
+    digest = models.CharField(max_length=64, help_text='sha256 of the file')
+    blob = models.CharField(max_length=255, help_text='path under the blob store root')
+    size = models.PositiveIntegerField(null=True, help_text='AIFACE_SEGMENT_SIZE of the crop, null for full size')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('client_id', 'image', 'segment')
+
+    @classmethod
+    def lookup(cls, client_id, image, size=None) -> dict:
+        """
+        :param size:    only the segments cropped for this AIFACE_SEGMENT_SIZE
+        :return:        {segment: blob}
+        """
+        return dict(cls.objects.filter(client_id=client_id, image=image, size=size).values_list('segment', 'blob'))
+
+    @classmethod
+    def record(cls, client_id, image, blobs: dict, size=None):
+        """
+        :param blobs:   {segment: (digest, blob)}, replaces what was recorded for those segments
+        :param size:    AIFACE_SEGMENT_SIZE the segments were cropped for
+        """
+        with transaction.atomic():
+            cls.objects.filter(client_id=client_id, image=image, segment__in=list(blobs)).delete()
+            cls.objects.bulk_create([
+                cls(client_id=client_id, image=image, segment=segment, digest=digest, blob=blob, size=size)
+                for segment, (digest, blob) in blobs.items()
+            ])
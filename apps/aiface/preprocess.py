@@ -0,0 +1,74 @@
+import base64
+import io
+
+from django.conf import settings
+
+from utils.fileutil import stream_file
+from utils.lazy import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+# baidu detect result keys holding coordinates, see face_list in the detect api doc
+POINT_KEYS = ('landmark', 'landmark72', 'landmark150')
+LOCATION_KEYS = ('left', 'top', 'width', 'height')
+
+JPEG_QUALITIES = (90, 85, 80, 70, 60, 50)
+
+
+def prepare_image(file_, max_edge=None, max_bytes=None):
+    """
+    downscale + recompress the upload when it is larger than the detector needs
+    :param file_:       UploadedFile
+    :param max_edge:    longest edge in pixels, settings.AIFACE_PREPROCESS_MAX_EDGE by default
+    :param max_bytes:   jpeg byte budget, settings.AIFACE_PREPROCESS_MAX_BYTES by default
+    :return:            (base64 str, scale), scale is sent size / original size
+    """
+    max_edge = max_edge or settings.AIFACE_PREPROCESS_MAX_EDGE
+    max_bytes = max_bytes or settings.AIFACE_PREPROCESS_MAX_BYTES
+
+    file_.seek(0)
+    img = Image.open(file_)  # only reads the header
+    if max(img.size) <= max_edge and file_.size <= max_bytes:
+        return stream_file(file_, hasher=('base64',))['base64'], 1
+
+    width = img.width
+    scale = min(1, max_edge / max(img.size))
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+
+    # let the jpeg decoder skip what the resize would throw away anyway
+    img.draft('RGB', size)
+    img = img.convert('RGB')
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS)
+
+    for quality in JPEG_QUALITIES:
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=quality)
+        if buf.tell() <= max_bytes:
+            break
+
+    return base64.b64encode(buf.getvalue()).decode(), img.width / width
+
+
+def rescale_result(result: dict, scale):
+    """
+    map the coordinates of a baidu detect result on the downscaled image back to the original one, in place
+    """
+    if scale == 1 or not (result.get('result') or {}).get('face_list'):
+        return result
+
+    for face in result['result']['face_list']:
+        location = face.get('location') or {}
+        for key in LOCATION_KEYS:
+            if key in location:
+                location[key] /= scale
+
+        for key in POINT_KEYS:
+            points = face.get(key)
+            if isinstance(points, dict):  # landmark150 is keyed by point name
+                points = points.values()
+            for point in points or ():
+                point['x'] /= scale
+                point['y'] /= scale
+
+    return result
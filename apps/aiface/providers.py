@@ -0,0 +1,227 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from apps.aiface.clients import baidu_detect
+from utils.imageutil import iai_call, models, sdk_exception
+from utils.lazy import lazy_import
+from utils.resilience import ResilienceError
+from utils.timing import stage
+
+requests = lazy_import('requests')
+
+# expression as baidu names it, tencent scores it 0 (none) ~ 50 (smile) ~ 100 (laugh)
+EXPRESSIONS = ('none', 'smile', 'laugh')
+
+BAIDU_NO_FACE = 222202
+TENCENT_NO_FACE = 'FailedOperation.ImageFacedetectFailed'
+
+
+class ProviderError(Exception):
+    pass
+
+
+def normalized_face(left, top, width, height, roll, age=None, gender=None, beauty=None, expression=None, glasses=None,
+                    landmarks=None) -> dict:
+    """
+    the provider independent face
+    :param roll:        in-plane rotation in degrees, signed as tencent's Roll, baidu's clockwise rotation is negated
+                        the same way utils.faceindex does
+    :param gender:      'male' / 'female'
+    :param beauty:      0 ~ 100
+    :param landmarks:   flat [x0, y0, x1, y1, ...], only when the provider returns them with the detection
+    """
+    return {
+        'location': {'left': left, 'top': top, 'width': width, 'height': height, 'roll': roll},
+        'age': age,
+        'gender': gender,
+        'beauty': beauty,
+        'expression': expression,
+        'glasses': glasses,
+        'landmarks': landmarks,
+    }
+
+
+class BaiduProvider:
+    name = 'baidu'
+    face_field = 'age,beauty,expression,gender,glasses,landmark72'
+
+    def detect(self, image_base64) -> list:
+        options = {'face_field': self.face_field, 'max_face_num': 10, 'face_type': 'LIVE'}
+        try:
+            result = baidu_detect(image_base64, 'BASE64', options)
+        # ValueError: the sdk parses whatever came back as json, an html error page included
+        except (ResilienceError, requests.exceptions.RequestException, ValueError) as err:
+            raise ProviderError(str(err) or type(err).__name__) from err
+
+        if result.get('error_code') == BAIDU_NO_FACE:
+            return []
+        if result.get('error_code') != 0:
+            raise ProviderError(f"{result.get('error_code')}: {result.get('error_msg')}")
+        return [self.normalize(face) for face in (result.get('result') or {}).get('face_list') or []]
+
+    @staticmethod
+    def normalize(face) -> dict:
+        location = face['location']
+        landmarks = [value for point in face.get('landmark72') or [] for value in (point['x'], point['y'])]
+        return normalized_face(
+            location['left'], location['top'], location['width'], location['height'], -location['rotation'],
+            age=face.get('age'),
+            gender=(face.get('gender') or {}).get('type'),
+            beauty=face.get('beauty'),
+            expression=(face.get('expression') or {}).get('type'),
+            glasses=(face.get('glasses') or {}).get('type', 'none') != 'none' if 'glasses' in face else None,
+            landmarks=landmarks or None,
+        )
+
+
+class TencentProvider:
+    """
+    DetectFace only, the landmarks would take an AnalyzeFace call on top
+    """
+    name = 'tencent'
+
+    def detect(self, image_base64) -> list:
+        detect_request = models.DetectFaceRequest()
+        detect_request.Image = image_base64
+        detect_request.MaxFaceNum = 10
+        detect_request.NeedFaceAttributes = 1
+        try:
+            result = iai_call('DetectFace', detect_request)
+        except sdk_exception.TencentCloudSDKException as err:
+            if err.code == TENCENT_NO_FACE:
+                return []
+            raise ProviderError(f'{err.code}: {err.message}') from err
+        except ResilienceError as err:
+            raise ProviderError(str(err)) from err
+        return [self.normalize(face) for face in result.get('FaceInfos') or []]
+
+    @staticmethod
+    def normalize(face) -> dict:
+        attributes = face.get('FaceAttributesInfo') or {}
+        expression = attributes.get('Expression')
+        gender = attributes.get('Gender')
+        return normalized_face(
+            face['X'], face['Y'], face['Width'], face['Height'], attributes.get('Roll', 0),
+            age=attributes.get('Age'),
+            gender=None if gender is None else ('male' if gender >= 50 else 'female'),
+            beauty=attributes.get('Beauty'),
+            expression=None if expression is None else EXPRESSIONS[min(2, round(expression / 50))],
+            glasses=attributes.get('Glass'),
+        )
+
+
+class ProviderStats:
+    """
+    exponentially weighted latency and error rate of one provider
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.latency = None  # seconds, None until the first answer
+        self.error_rate = 0.0
+        self.calls = 0
+        self.last_failure = 0
+
+    def update(self, seconds, ok):
+        self.calls += 1
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.latency = seconds if self.latency is None else self.latency + self.alpha * (seconds - self.latency)
+        else:
+            self.last_failure = time.monotonic()
+
+
+class Router:
+    """
+    sends each detection to the fastest healthy provider and fails over to the others
+
+    a provider is unhealthy while its error rate is above max_error_rate, after probe_interval seconds without
+    a failure it gets another chance. with weights the first provider is drawn by weight instead, e.g.
+    {'baidu': 3, 'tencent': 1} to keep a quarter of the traffic on tencent's qps quota
+    """
+
+    def __init__(self, providers, weights=None, alpha=None, max_error_rate=None, probe_interval=None):
+        self.providers = {provider.name: provider for provider in providers}
+        self.weights = weights
+        alpha = alpha or settings.AIFACE_PROVIDER_EWMA_ALPHA
+        self.max_error_rate = max_error_rate or settings.AIFACE_PROVIDER_MAX_ERROR_RATE
+        self.probe_interval = probe_interval or settings.AIFACE_PROVIDER_PROBE_INTERVAL
+        self.stats = {name: ProviderStats(alpha) for name in self.providers}
+        self._lock = threading.Lock()
+
+    def healthy(self, name) -> bool:
+        stats = self.stats[name]
+        return (stats.error_rate <= self.max_error_rate
+                or time.monotonic() - stats.last_failure >= self.probe_interval)
+
+    def order(self) -> list:
+        """
+        :return: provider names in the order they are tried
+        """
+        with self._lock:
+            healthy = [name for name in self.providers if self.healthy(name)]
+            # no latency yet sorts first, every provider gets measured
+            by_latency = sorted(healthy, key=lambda name: self.stats[name].latency or 0)
+            unhealthy = sorted(set(self.providers).difference(healthy), key=lambda name: self.stats[name].error_rate)
+
+        weights = [self.weights.get(name, 0) for name in by_latency] if self.weights else []
+        if any(weights):
+            first = random.choices(by_latency, weights=weights)[0]
+            by_latency.remove(first)
+            by_latency.insert(0, first)
+
+        # the unhealthy ones are still better than no answer at all
+        return by_latency + unhealthy
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.stats[name].update(seconds, ok)
+
+    def detect(self, image_base64, provider=None) -> dict:
+        """
+        :param provider:    name of the only provider to try
+        :return:            {'provider': name, 'face_num': n, 'faces': [normalized_face, ...]}
+        :raise ProviderError: every provider failed, with all their errors
+        """
+        names = [provider] if provider else self.order()
+        errors = {}
+        for name in names:
+            start = time.monotonic()
+            try:
+                with stage(f'provider_{name}'):
+                    faces = self.providers[name].detect(image_base64)
+            except ProviderError as err:
+                self.record(name, time.monotonic() - start, ok=False)
+                errors[name] = str(err)
+                continue
+            self.record(name, time.monotonic() - start, ok=True)
+            return {'provider': name, 'face_num': len(faces), 'faces': faces}
+
+        raise ProviderError('; '.join(f'{name}: {err}' for name, err in errors.items()))
+
+    def prometheus(self) -> str:
+        lines = ['# HELP aiface_provider_latency_seconds EWMA latency of the successful detections.',
+                 '# TYPE aiface_provider_latency_seconds gauge']
+        with self._lock:
+            stats = sorted(self.stats.items())
+        lines += [f'aiface_provider_latency_seconds{{provider="{name}"}} {item.latency or 0}' for name, item in stats]
+        lines += ['# HELP aiface_provider_error_ratio EWMA share of failed detections.',
+                  '# TYPE aiface_provider_error_ratio gauge']
+        lines += [f'aiface_provider_error_ratio{{provider="{name}"}} {item.error_rate}' for name, item in stats]
+        return '\n'.join(lines) + '\n'
+
+
+PROVIDERS = {provider.name: provider for provider in (BaiduProvider(), TencentProvider())}
+
+_router = None
+
+
+def get_router() -> Router:
+    global _router
+    if _router is None:
+        _router = Router([PROVIDERS[name] for name in settings.AIFACE_PROVIDERS],
+                         weights=settings.AIFACE_PROVIDER_WEIGHTS)
+    return _router
@@ -0,0 +1,134 @@
+import json
+
+from django.http import HttpResponse, JsonResponse
+
+try:
+    import msgpack
+except ImportError:  # optional, format=msgpack answers 406 without it
+    msgpack = None
+
+# everything aiface_baidu_api asked for before fields= existed, in the order of the detect api doc
+FACE_FIELDS = ('age', 'beauty', 'expression', 'face_shape', 'gender', 'glasses', 'landmark', 'landmark72', 'race',
+               'quality', 'eye_status', 'face_type')
+
+# face_list keys detect returns whatever face_field is
+BASE_KEYS = ('face_token', 'location', 'face_probability', 'angle')
+
+POINT_KEYS = ('landmark', 'landmark72', 'landmark150')
+
+FORMATS = ('json', 'compact', 'msgpack')
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def parse_fields(value) -> tuple:
+    """
+    :param value:   'age,gender,quality' from the request, empty for every field
+    :return:        the known fields in FACE_FIELDS order
+    :raise ValueError: on a field detect doesn't know
+    """
+    if not value:
+        return FACE_FIELDS
+
+    wanted = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = wanted.difference(FACE_FIELDS)
+    if unknown:
+        raise ValueError(f'未知的字段: {",".join(sorted(unknown))}, 可选: {",".join(FACE_FIELDS)}')
+    return tuple(field for field in FACE_FIELDS if field in wanted)
+
+
+def project(result: dict, fields) -> dict:
+    """
+    copy of a detect result with only BASE_KEYS + fields left in each face
+    """
+    faces = (result.get('result') or {}).get('face_list')
+    if not faces:
+        return result
+
+    keep = set(BASE_KEYS).union(fields)
+    return {**result, 'result': {
+        **result['result'],
+        'face_list': [{key: value for key, value in face.items() if key in keep} for face in faces],
+    }}
+
+
+def flat_points(points, digits=1):
+    """
+    [{'x': x, 'y': y}, ...] to [x0, y0, x1, y1, ...], landmark150 {name: {'x': x, 'y': y}} to {name: [x, y]}
+    """
+    if isinstance(points, dict):
+        return {name: [round(point['x'], digits), round(point['y'], digits)] for name, point in points.items()}
+    flat = []
+    for point in points:
+        flat += [round(point['x'], digits), round(point['y'], digits)]
+    return flat
+
+
+def compact(result: dict) -> dict:
+    """
+    landmarks as flat coordinate arrays rounded to 0.1 pixel, the rest as it is
+    """
+    faces = (result.get('result') or {}).get('face_list')
+    if not faces:
+        return result
+
+    return {**result, 'result': {
+        **result['result'],
+        'face_list': [{key: flat_points(value) if key in POINT_KEYS else value for key, value in face.items()}
+                      for face in faces],
+    }}
+
+
+def response_format(request) -> str:
+    """
+    ?format= / the format form field, otherwise an Accept header asking for msgpack
+    """
+    fmt = request.GET.get('format') or request.POST.get('format')
+    if fmt:
+        return fmt
+    accept = request.META.get('HTTP_ACCEPT', '')
+    if any(content_type in accept for content_type in MSGPACK_TYPES):
+        return 'msgpack'
+    return 'json'
+
+
+def format_error(fmt, formats=FORMATS):
+    """
+    :return: the error response for a format that can't be served, None when it can
+    """
+    if fmt not in formats:
+        return JsonResponse({'msg': f'format: {"/".join(formats)}'}, status=400)
+    if fmt == 'msgpack' and msgpack is None:
+        return JsonResponse({'msg': 'msgpack没有安装'}, status=406)
+    return None
+
+
+def request_options(request, formats=FORMATS):
+    """
+    :return: (fields, fmt, error response or None)
+    """
+    fmt = response_format(request)
+    error = format_error(fmt, formats)
+    try:
+        fields = parse_fields(request.GET.get('fields') or request.POST.get('fields'))
+    except ValueError as err:
+        fields, error = None, error or JsonResponse({'msg': str(err)}, status=400)
+    return fields, fmt, error
+
+
+def render(result: dict, fmt='json') -> HttpResponse:
+    if fmt == 'compact':
+        return JsonResponse(compact(result), json_dumps_params={'separators': (',', ':')})
+    if fmt == 'msgpack':
+        return HttpResponse(msgpack.packb(compact(result), use_bin_type=True), content_type=MSGPACK_TYPES[0])
+    return JsonResponse(result)
+
+
+def dumps_line(item: dict, fmt='json') -> str:
+    """
+    one ndjson line of the batch endpoint, msgpack is not available there
+    """
+    if fmt == 'compact':
+        if 'result' in item:
+            item = {**item, 'result': compact(item['result'])}
+        return json.dumps(item, ensure_ascii=False, separators=(',', ':')) + '\n'
+    return json.dumps(item, ensure_ascii=False) + '\n'
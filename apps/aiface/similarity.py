@@ -0,0 +1,159 @@
+import fcntl
+import json
+import logging
+import pathlib
+import threading
+import time
+
+from django.conf import settings
+
+from apps.aiface.models import Landmark
+from utils.faceindex import FaceIndex, face_descriptor
+from utils.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+# baidu landmark72, the one landmark every stored face has
+INDEX_KIND = 'landmark72'
+INDEX_DIM = 2 * 72
+
+
+def stored_descriptor(points, rotation) -> 'np.ndarray':
+    """
+    :param points:      flat [x0, y0, x1, y1, ...] as kept in Landmark.points
+    :param rotation:    Face.rotation, clockwise degrees
+    """
+    return face_descriptor(np.asarray(points, dtype=np.float64).reshape(-1, 2), angle=-rotation)
+
+
+class SimilarityIndex:
+    """
+    FaceIndex of the stored faces, keyed by Face.pk
+
+    loaded from AIFACE_INDEX_DIR when it was saved there before, otherwise rebuilt from the database on first use.
+    every worker process has its own copy, each search first adds the faces other processes stored since, and a
+    face asked for that is still missing is looked up on its own
+    """
+
+    def __init__(self, directory=None, save_interval=None):
+        directory = directory or settings.AIFACE_INDEX_DIR
+        self.directory = pathlib.Path(directory) if directory else None
+        self.save_interval = save_interval or settings.AIFACE_INDEX_SAVE_INTERVAL
+        self._index = None
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+        self._dirty = False
+        self._max_id = 0  # highest face id added, the database rows above it are new
+
+    @property
+    def index(self) -> FaceIndex:
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._load()
+        return self._index
+
+    def _load(self):
+        if self.directory is not None and FaceIndex.saved(self.directory):
+            try:
+                index = FaceIndex.load(self.directory)
+            except (OSError, ValueError):
+                logger.exception('failed to load the face index from %s, rebuilding it', self.directory)
+            else:
+                self._max_id = max(index.ids(), default=0)
+                self._add(index, self._rows(face_id__gt=self._max_id), decode=True)
+                return index
+
+        index = FaceIndex(INDEX_DIM)
+        self._add(index, self._rows(), decode=True)
+        return index
+
+    @staticmethod
+    def _rows(**filters):
+        rows = Landmark.objects.filter(kind=INDEX_KIND, **filters).order_by('face_id')
+        return rows.values_list('face_id', 'face__rotation', 'points').iterator()
+
+    def _add(self, index, faces, decode=False):
+        ids, vectors = [], []
+        for face_id, rotation, points in faces:
+            if decode:  # straight from the database
+                points = json.loads(points)
+            if len(points) != INDEX_DIM:
+                continue
+            try:
+                vectors.append(stored_descriptor(points, rotation))
+            except ValueError:
+                continue
+            ids.append(face_id)
+        if ids:
+            index.add_many(ids, vectors)
+            self._max_id = max(self._max_id, *ids)
+        return len(ids)
+
+    def sync(self):
+        """
+        add the faces stored since the last one this process saw, by other processes included
+        """
+        if self._add(self.index, self._rows(face_id__gt=self._max_id), decode=True):
+            self._dirty = True
+
+    def add(self, faces):
+        """
+        :param faces: [(face_id, rotation, flat landmark72 points), ...]
+        """
+        if self._add(self.index, faces):
+            self._dirty = True
+            self.maybe_save()
+
+    def remove(self, face_id):
+        if self.index.remove(face_id):
+            self._dirty = True
+
+    def search(self, face_id, k=10, metric='cosine') -> list:
+        """
+        :return: [(face_id, score), ...] of the faces closest to face_id, face_id itself left out
+        :raise KeyError: face_id is not a stored face with landmark72
+        """
+        index = self.index
+        self.sync()
+        if face_id not in index:
+            # stored by another process before a face this one has already seen
+            self._add(index, self._rows(face_id=face_id), decode=True)
+        return index.search(index.vector(face_id), k=k, metric=metric, exclude=(face_id,))
+
+    def maybe_save(self, force=False):
+        if self.directory is None or not self._dirty:
+            return
+        if not force and time.monotonic() - self._saved_at < self.save_interval:
+            return
+        self._saved_at = time.monotonic()
+        if self._save():
+            self._dirty = False
+
+    def _save(self) -> bool:
+        """
+        :return: False when another process is saving right now, this one tries again at its next save
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / 'save.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # closing the file releases the lock
+            self.index.save(self.directory)
+        return True
+
+    def reset(self):
+        """
+        forget the in-memory index, the next use loads or rebuilds it
+        """
+        with self._lock:
+            self._index = None
+            self._dirty = False
+            self._max_id = 0
+
+
+similarity_index = SimilarityIndex()
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from apps.aiface.models import Face, FaceImage, Landmark
+from apps.aiface.similarity import INDEX_KIND, similarity_index
+
+logger = logging.getLogger(__name__)
+
+LANDMARK_KINDS = ('landmark', 'landmark72', 'landmark150')
+# face_list keys that get their own column or table
+FACE_COLUMNS = ('face_token', 'location', 'face_probability', 'age', 'beauty', 'gender') + LANDMARK_KINDS
+
+
+def flat_points(points):
+    if isinstance(points, dict):  # landmark150 is keyed by point name
+        points = points.values()
+    flat = []
+    for point in points:
+        flat += [point['x'], point['y']]
+    return flat
+
+
+class ResultStore:
+    """
+    writes detect results to the database from a background thread, in batches
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size or settings.AIFACE_STORE_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.AIFACE_STORE_FLUSH_INTERVAL
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def submit(self, digest, client_id, face_field, result, provider='baidu'):
+        """
+        queue a successful detect result, returns right away
+        """
+        if result.get('error_code') != 0:
+            return
+        self._ensure_worker().put((digest, client_id or '', face_field, provider, result))
+
+    def flush(self):
+        """
+        block until everything submitted so far is written
+        """
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def _ensure_worker(self):
+        # the thread doesn't survive a fork, each worker process starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), name='aiface_store', daemon=True).start()
+            return self._queue
+
+    def _run(self, items):
+        while True:
+            batch = [items.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(items.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+
+            try:
+                close_old_connections()
+                self.write(batch)
+            except Exception:
+                logger.exception('failed to store %s detect results', len(batch))
+            finally:
+                for _ in batch:
+                    items.task_done()
+
+    @staticmethod
+    def write(batch):
+        """
+        sqlite doesn't hand back primary keys from bulk_create, so every level is read back by its natural key
+        """
+        indexed = []
+        with transaction.atomic():
+            images = [FaceImage(digest=digest, client_id=client_id, face_field=face_field, provider=provider,
+                                face_num=(result.get('result') or {}).get('face_num', 0),
+                                log_id=result.get('log_id'))
+                      for digest, client_id, face_field, provider, result in batch]
+            FaceImage.objects.bulk_create(images, ignore_conflicts=True)
+
+            existing = set(Face.objects.filter(image__digest__in={image.digest for image in images})
+                           .values_list('image__digest', 'image__client_id', 'image__face_field').distinct())
+            stored = {(image.digest, image.client_id, image.face_field): image.pk for image in
+                      FaceImage.objects.filter(digest__in={image.digest for image in images})}
+
+            faces, face_landmarks = [], []
+            for digest, client_id, face_field, provider, result in batch:
+                key = (digest, client_id, face_field)
+                if key in existing or key not in stored:
+                    continue
+                existing.add(key)  # the same image twice in one batch
+
+                for index, data in enumerate((result.get('result') or {}).get('face_list') or []):
+                    location = data.get('location') or {}
+                    faces.append(Face(
+                        image_id=stored[key], index=index, face_token=data.get('face_token', ''),
+                        left=location.get('left', 0), top=location.get('top', 0),
+                        width=location.get('width', 0), height=location.get('height', 0),
+                        rotation=location.get('rotation', 0), probability=data.get('face_probability'),
+                        age=data.get('age'), beauty=data.get('beauty'),
+                        gender=(data.get('gender') or {}).get('type', ''),
+                        attributes=json.dumps({k: v for k, v in data.items() if k not in FACE_COLUMNS},
+                                              ensure_ascii=False),
+                    ))
+                    face_landmarks.append({kind: data[kind] for kind in LANDMARK_KINDS if data.get(kind)})
+
+            Face.objects.bulk_create(faces, ignore_conflicts=True)
+
+            face_ids = dict(((image_id, index), pk) for pk, image_id, index in Face.objects.filter(
+                image_id__in={face.image_id for face in faces}).values_list('pk', 'image_id', 'index'))
+            rows = []
+            for face, landmarks in zip(faces, face_landmarks):
+                face_id = face_ids[(face.image_id, face.index)]
+                for kind, points in landmarks.items():
+                    points = flat_points(points)
+                    rows.append(Landmark(face_id=face_id, kind=kind, points=json.dumps(points)))
+                    if kind == INDEX_KIND:
+                        indexed.append((face_id, face.rotation, points))
+            Landmark.objects.bulk_create(rows, ignore_conflicts=True)
+
+        if indexed:
+            similarity_index.add(indexed)
+
+
+result_store = ResultStore()
@@ -1,3 +1,1128 @@
-from django.test import TestCase
+import asyncio
+import base64
+import fcntl
+import hashlib
+import io
+import json
+import math
+import os
+import pathlib
+import struct
+import sys
+import zlib
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf
 
-# Create your tests here.
+import numpy as np
+from PIL import Image, ImageChops
+from asgiref.wsgi import WsgiToAsgi
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.utils import timezone
+import httpx
+import requests
+
+from apps.aiface import jobs
+from apps.aiface.asgi import AsyncBaiduClient, AsyncDetectApplication
+from apps.aiface.cache import DetectCache, detect_cache
+from apps.aiface.clients import AipFacePool, baidu_retryable
+from apps.aiface.models import Face, FaceImage, Job, JobStatus, Landmark, SegmentBlob
+from apps.aiface.preprocess import prepare_image, rescale_result
+from apps.aiface.providers import PROVIDERS, BaiduProvider, ProviderError, Router, TencentProvider
+from apps.aiface.response import FACE_FIELDS, compact, msgpack, parse_fields, project
+from apps.aiface.similarity import SimilarityIndex, similarity_index
+from apps.aiface.store import ResultStore
+from utils import timing
+from benchmarks.fakeapi import FakeFaceAPI, patch_clients
+from benchmarks.synthetic import tencent_result
+from utils.blobstore import BlobStore
+from utils.faceindex import FaceIndex, baidu_descriptor
+from utils.fileutil import stream_file
+from utils.geometry import landmarks_to_array, rotate_points, segment_extents
+from utils import imageutil
+from utils.imageutil import rotated_crops
+from utils.lazy import LazyModule, lazy_import
+from utils.resilience import CircuitBreaker, CircuitOpen, DeadlineExceeded, Resilient
+from utils.startup import parse_importtime
+from utils.tokencache import TokenCache
+
+
+class AipFacePoolTestCase(SimpleTestCase):
+
+    def test_client_reused(self):
+        pool = AipFacePool(size=2, idle_timeout=60)
+        with pool.client() as client:
+            first = client
+        with pool.client() as client:
+            self.assertIs(client, first)
+
+    def test_idle_client_dropped(self):
+        pool = AipFacePool(size=2, idle_timeout=60)
+        with pool.client() as client:
+            first = client
+        pool.idle_timeout = -1
+        with pool.client() as client:
+            self.assertIsNot(client, first)
+
+
+class DetectCacheTestCase(SimpleTestCase):
+
+    def test_key_depends_on_options(self):
+        key = DetectCache.make_key('md5', {'face_field': 'age', 'max_face_num': 2})
+        self.assertEqual(key, DetectCache.make_key('md5', {'max_face_num': 2, 'face_field': 'age'}))
+        self.assertNotEqual(key, DetectCache.make_key('md5', {'face_field': 'age', 'max_face_num': 1}))
+
+    def test_lru_and_ttl(self):
+        cache = DetectCache(max_entries=2, ttl=60, disk_dir='')
+        cache.set('a', {'n': 1})
+        cache.set('b', {'n': 2})
+        cache.get('a')
+        cache.set('c', {'n': 3})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), {'n': 1})
+
+        cache.ttl = -1
+        cache.set('d', {'n': 4})
+        self.assertIsNone(cache.get('d'))
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = DetectCache(max_entries=1, ttl=60, disk_dir=disk_dir)
+            cache.set('a', {'n': 1})
+            cache.clear()
+            self.assertEqual(cache.get('a'), {'n': 1})
+
+    def test_concurrent_calls_coalesced(self):
+        cache = DetectCache(max_entries=8, ttl=60, disk_dir='')
+        calls = []
+
+        def detect():
+            calls.append(1)
+            time.sleep(0.05)
+            return {'error_code': 0}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_call('k', detect)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'error_code': 0}] * 8)
+
+
+class StreamFileTestCase(SimpleTestCase):
+
+    def test_matches_whole_file_encoding(self):
+        raw = os.urandom(100001)
+        for chunk_size in (1000, 1024, 3 * 1024, len(raw) + 1):
+            result = stream_file(SimpleUploadedFile('img.jpg', raw), chunk_size=chunk_size)
+            self.assertEqual(result['base64'], base64.b64encode(raw).decode())
+            self.assertEqual(result['md5'], hashlib.md5(raw).hexdigest())
+
+    def test_only_requested(self):
+        result = stream_file(SimpleUploadedFile('img.jpg', b'abc'), hasher=('md5',))
+        self.assertEqual(result['base64'], '')
+
+
+class GeometryTestCase(SimpleTestCase):
+
+    def test_landmark_formats(self):
+        expected = [[1, 2], [3, 4]]
+        self.assertEqual(landmarks_to_array([{'X': 1, 'Y': 2}, {'X': 3, 'Y': 4}]).tolist(), expected)
+        self.assertEqual(landmarks_to_array([{'x': 1, 'y': 2}, {'x': 3, 'y': 4}]).tolist(), expected)
+        self.assertEqual(landmarks_to_array([(1, 2), (3, 4)]).tolist(), expected)
+
+    def test_rotate_points(self):
+        rotated = rotate_points(landmarks_to_array([(2, 1)]), 90, origin=(1, 1))
+        self.assertTrue(all(math.isclose(a, b, abs_tol=1e-9) for a, b in zip(rotated[0], (1, 2))))
+
+    def test_segment_extents(self):
+        boxes = segment_extents({
+            'nose': [{'X': 0, 'Y': 0}, {'X': 2, 'Y': 4}],
+            'mouth': [{'X': 1, 'Y': 5}],
+        }, angle=0)
+        self.assertEqual(boxes, {'nose': (0, 0, 2, 4), 'mouth': (1, 5, 1, 5)})
+
+
+class RotatedCropsTestCase(SimpleTestCase):
+
+    def test_same_as_full_rotate(self):
+        img = Image.frombytes('RGB', (8, 6), os.urandom(8 * 6 * 3)).resize((400, 300), Image.BICUBIC)
+        boxes = [(150, 100, 250, 200), (150, 120.5, 250, 140.5), (150, 160, 250, 185)]
+        center = (img.width / 2, img.height / 2)
+
+        rotated = img.rotate(angle=-17.5, resample=Image.BICUBIC)
+        crops = rotated_crops(img, boxes, angle=17.5, center=center)
+
+        for box, crop in zip(boxes, crops):
+            self.assertIsNone(ImageChops.difference(rotated.crop(box), crop).getbbox())
+
+
+class PreprocessTestCase(SimpleTestCase):
+
+    def test_small_image_untouched(self):
+        buf = io.BytesIO()
+        Image.new('RGB', (100, 80)).save(buf, format='JPEG')
+        image, scale = prepare_image(SimpleUploadedFile('img.jpg', buf.getvalue()), max_edge=200, max_bytes=10 ** 6)
+        self.assertEqual(scale, 1)
+        self.assertEqual(base64.b64decode(image), buf.getvalue())
+
+    def test_large_image_shrunk(self):
+        buf = io.BytesIO()
+        Image.new('RGB', (1000, 800)).save(buf, format='PNG')
+        image, scale = prepare_image(SimpleUploadedFile('img.png', buf.getvalue()), max_edge=250, max_bytes=10 ** 6)
+        self.assertEqual(scale, 0.25)
+        self.assertEqual(Image.open(io.BytesIO(base64.b64decode(image))).size, (250, 200))
+
+    def test_rescale_result(self):
+        result = {'error_code': 0, 'result': {'face_list': [{
+            'location': {'left': 10, 'top': 20, 'width': 30, 'height': 40, 'rotation': 5},
+            'landmark72': [{'x': 1, 'y': 2}],
+        }]}}
+        face = rescale_result(result, 0.5)['result']['face_list'][0]
+        self.assertEqual(face['location'], {'left': 20, 'top': 40, 'width': 60, 'height': 80, 'rotation': 5})
+        self.assertEqual(face['landmark72'], [{'x': 2, 'y': 4}])
+
+
+class BatchViewTestCase(SimpleTestCase):
+
+    def test_results_in_upload_order(self):
+        def detect(img, **kwargs):
+            if img.name == 'broken.jpg':
+                raise ValueError('broken')
+            time.sleep(0.05 if img.name == 'slow.jpg' else 0)
+            return {'error_code': 0, 'name': img.name}
+
+        jpeg = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(jpeg, format='JPEG')
+        gif = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(gif, format='GIF')
+        imgs = [
+            SimpleUploadedFile('slow.jpg', jpeg.getvalue(), content_type='image/jpeg'),
+            SimpleUploadedFile('fast.jpg', jpeg.getvalue(), content_type='image/jpeg'),
+            SimpleUploadedFile('anim.gif', gif.getvalue(), content_type='image/gif'),
+            SimpleUploadedFile('broken.jpg', jpeg.getvalue(), content_type='image/jpeg'),
+        ]
+        with mock.patch('apps.aiface.views.aiface_baidu_api', side_effect=detect):
+            response = self.client.post('/batch/', {'img': imgs})
+            lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        self.assertEqual([line['index'] for line in lines], [0, 1, 2, 3])
+        self.assertEqual(lines[0]['result']['name'], 'slow.jpg')
+        self.assertEqual(lines[1]['result']['name'], 'fast.jpg')
+        self.assertIn('image/gif', lines[2]['msg'])
+        self.assertIn('broken', lines[3]['msg'])
+
+    def test_oversize_file_reported_in_place(self):
+        small, large = io.BytesIO(), io.BytesIO()
+        Image.new('RGB', (4, 4)).save(small, format='JPEG')
+        Image.effect_noise((256, 256), 64).convert('RGB').save(large, format='JPEG')
+        imgs = [
+            SimpleUploadedFile('large.jpg', large.getvalue(), content_type='image/jpeg'),
+            SimpleUploadedFile('small.jpg', small.getvalue(), content_type='image/jpeg'),
+        ]
+        detect = mock.Mock(return_value={'error_code': 0})
+        with override_settings(AIFACE_UPLOAD_MAX_BYTES=len(small.getvalue()) + 1), \
+                mock.patch('apps.aiface.views.aiface_baidu_api', detect):
+            response = self.client.post('/batch/', {'img': imgs})
+            lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        self.assertEqual([line['index'] for line in lines], [0, 1])
+        self.assertIn('图片大小', lines[0]['msg'])
+        self.assertEqual(lines[1]['result'], {'error_code': 0})
+        detect.assert_called_once()
+
+
+class ResponseTestCase(SimpleTestCase):
+    result = {'error_code': 0, 'result': {'face_num': 1, 'face_list': [{
+        'face_token': 't', 'location': {'left': 1}, 'age': 20, 'race': {'type': 'yellow'},
+        'landmark72': [{'x': 1.234, 'y': 2.0}, {'x': 3.0, 'y': 4.06}],
+        'landmark150': {'eye_left_corner': {'x': 5.0, 'y': 6.0}},
+    }]}}
+
+    def test_parse_fields(self):
+        self.assertEqual(parse_fields(''), FACE_FIELDS)
+        self.assertEqual(parse_fields('quality, age,gender'), ('age', 'gender', 'quality'))
+        with self.assertRaises(ValueError):
+            parse_fields('age,shoe_size')
+
+    def test_project_and_compact(self):
+        face = project(self.result, ('age',))['result']['face_list'][0]
+        self.assertEqual(sorted(face), ['age', 'face_token', 'location'])
+
+        face = compact(self.result)['result']['face_list'][0]
+        self.assertEqual(face['landmark72'], [1.2, 2.0, 3.0, 4.1])
+        self.assertEqual(face['landmark150'], {'eye_left_corner': [5.0, 6.0]})
+        self.assertEqual(face['race'], {'type': 'yellow'})
+
+    def upload(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(jpeg, format='JPEG')
+        return SimpleUploadedFile('a.jpg', jpeg.getvalue(), content_type='image/jpeg')
+
+    def test_fields_and_format_in_request(self):
+        with mock.patch('apps.aiface.views.aiface_baidu_api', return_value=self.result) as api:
+            response = self.client.post('/?fields=gender,age&format=compact', {'img': self.upload()})
+            self.assertEqual(api.call_args[1]['fields'], ('age', 'gender'))
+            self.assertEqual(response.json()['result']['face_list'][0]['landmark72'], [1.2, 2.0, 3.0, 4.1])
+
+            self.assertEqual(self.client.post('/?fields=shoe_size', {'img': self.upload()}).status_code, 400)
+            self.assertEqual(self.client.post('/batch/?format=msgpack', {'img': self.upload()}).status_code, 400)
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        with mock.patch('apps.aiface.views.aiface_baidu_api', return_value=self.result):
+            response = self.client.post('/', {'img': self.upload()}, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False), compact(self.result))
+
+
+class TimingTestCase(SimpleTestCase):
+
+    def test_server_timing_header_and_metrics(self):
+        with mock.patch('apps.aiface.views.aiface_baidu_api', return_value={'error_code': 0}):
+            jpeg = io.BytesIO()
+            Image.new('RGB', (4, 4)).save(jpeg, format='JPEG')
+            img = SimpleUploadedFile('a.jpg', jpeg.getvalue(), content_type='image/jpeg')
+            response = self.client.post('/', {'img': img})
+
+        names = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['parse', 'validate', 'serialize', 'total'])
+
+        metrics = self.client.get('/metrics/').content.decode()
+        self.assertIn('aiface_stage_seconds_bucket{stage="validate",le="+Inf"}', metrics)
+
+    def test_stages_from_worker_threads(self):
+        token = timing.begin_request()
+        try:
+            with FakeFaceAPI() as api, patch_clients(api):
+                imageutil.face_api(base64.b64encode(b'img').decode())
+        finally:
+            entries = timing.end_request(token)
+
+        names = [name for name, _ in entries]
+        self.assertIn('DetectFace', names)
+        self.assertIn('AnalyzeFace', names)
+
+    def test_stage_outside_request(self):
+        with timing.stage('outside'):
+            pass
+        self.assertIn('aiface_stage_seconds_count{stage="outside"} 1', timing.prometheus())
+
+
+class FaceApiTestCase(SimpleTestCase):
+
+    def setUp(self):
+        # one attempt, no hedging, and a breaker of its own for every test
+        policy = mock.patch.object(imageutil, 'get_policy', lambda name: Resilient(name, max_attempts=1,
+                                                                                  hedge_percentile=None))
+        policy.start()
+        self.addCleanup(policy.stop)
+        self.image = base64.b64encode(b'img').decode()
+
+    def test_calls_sent_together(self):
+        with FakeFaceAPI(latency_script=[300, 300]) as api, patch_clients(api):
+            start = time.monotonic()
+            _, status_code = imageutil.face_api(self.image)
+            elapsed = time.monotonic() - start
+        self.assertEqual(status_code, 200)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 0.55)  # about the slower call, not the sum
+
+    def test_tencent_client_follows_the_endpoint(self):
+        for _ in range(2):  # the executor threads made their clients for the first server already
+            with FakeFaceAPI() as api, patch_clients(api):
+                imageutil.face_api(self.image)
+            self.assertEqual(api.calls, {'DetectFace': 1, 'AnalyzeFace': 1})
+
+    def test_same_result_as_one_after_another(self):
+        detect_request = imageutil.models.DetectFaceRequest()
+        detect_request.Image = self.image
+        detect_request.NeedFaceAttributes = 1
+        detect_request.NeedQualityDetection = 1
+        detect_request.MaxFaceNum = settings.AIFACE_MAX_FACES
+        analyze_request = imageutil.models.AnalyzeFaceRequest()
+        analyze_request.Image = self.image
+
+        with FakeFaceAPI() as api, patch_clients(api):
+            expected = imageutil.iai_call('DetectFace', detect_request)
+            expected['FaceShapeSet'] = imageutil.iai_call('AnalyzeFace', analyze_request).get('FaceShapeSet')
+            data, status_code = imageutil.face_api(self.image)
+        self.assertEqual(status_code, 200)
+        self.assertTrue(expected['FaceShapeSet'])
+        # every response has a RequestId of its own
+        self.assertNotEqual(data.pop('RequestId'), expected.pop('RequestId'))
+        self.assertEqual(data, expected)
+
+    def test_failure_not_waiting_for_the_other_call(self):
+        # whichever call comes first fails at once, the other one takes 2s
+        with FakeFaceAPI(latency_script=[0, 2000], error_script=[True, False]) as api, patch_clients(api):
+            start = time.monotonic()
+            data, status_code = imageutil.face_api(self.image)
+            elapsed = time.monotonic() - start
+        self.assertEqual(status_code, 500)
+        self.assertIn('times equals', data)
+        self.assertLess(elapsed, 1)
+
+
+class UploadGuardTestCase(SimpleTestCase):
+
+    @staticmethod
+    def png_header(width, height):
+        ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+        chunk = struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr + struct.pack('>I', zlib.crc32(b'IHDR' + ihdr))
+        return b'\x89PNG\r\n\x1a\n' + chunk
+
+    def test_not_an_image(self):
+        img = SimpleUploadedFile('a.jpg', b'<html>' + b'0' * 100, content_type='image/jpeg')
+        with mock.patch('apps.aiface.views.aiface_baidu_api') as detect:
+            response = self.client.post('/', {'img': img})
+        self.assertIn('图片格式错误', response.json()['msg'])
+        detect.assert_not_called()
+
+    def test_too_many_pixels(self):
+        img = SimpleUploadedFile('a.png', self.png_header(20000, 20000) + b'0' * 1000, content_type='image/png')
+        with mock.patch('apps.aiface.views.aiface_baidu_api') as detect:
+            response = self.client.post('/', {'img': img})
+        self.assertIn('20000x20000', response.json()['msg'])
+        detect.assert_not_called()
+
+
+class FaceIndexTestCase(SimpleTestCase):
+
+    @staticmethod
+    def baidu_face(points, rotation=0):
+        return {'location': {'rotation': rotation}, 'landmark72': [{'x': x, 'y': y} for x, y in points.tolist()]}
+
+    def test_descriptor_ignores_position_size_and_roll(self):
+        points = np.random.RandomState(0).uniform(0, 100, size=(72, 2))
+        moved = rotate_points(points * 3 + (40, -7), 25, origin=(10, 20))
+        self.assertTrue(np.allclose(baidu_descriptor(self.baidu_face(points)),
+                                    baidu_descriptor(self.baidu_face(moved, rotation=25)), atol=1e-5))
+
+    def test_add_remove_search(self):
+        index = FaceIndex(dim=2, capacity=1)
+        index.add_many([1, 2, 3], [(1, 0), (0, 1), (1, 1)])
+        index.add(4, (-1, 0))
+
+        self.assertEqual([face_id for face_id, _ in index.search((1, 0.1), k=2)], [1, 3])
+        self.assertEqual([face_id for face_id, _ in index.search((1, 0.1), k=2, exclude=(1,))], [3, 2])
+        self.assertEqual(index.search((2, 0), k=1, metric='l2'), [(1, 1.0)])
+
+        self.assertTrue(index.remove(1))
+        self.assertFalse(index.remove(1))
+        self.assertEqual(len(index), 3)
+        self.assertEqual([face_id for face_id, _ in index.search((1, 0.1), k=3)], [3, 2, 4])
+
+    def test_save_and_load_mmap(self):
+        index = FaceIndex(dim=2)
+        index.add_many([1, 2], [(1, 0), (0, 1)])
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(directory)
+            loaded = FaceIndex.load(directory)
+            self.assertEqual(loaded.search((0, 1), k=1), [(2, 1.0)])
+
+            # the first change copies the mapped arrays, the files stay as they were
+            loaded.add(3, (0, 2))
+            loaded.remove(1)
+            self.assertEqual(sorted(face_id for face_id, _ in loaded.search((0, 1), k=5)), [2, 3])
+            self.assertEqual(len(FaceIndex.load(directory)), 2)
+
+            # every save is a new version, the one before is kept for readers still opening it
+            loaded.save(directory)
+            loaded.save(directory)
+            self.assertEqual(sorted(FaceIndex.load(directory).ids()), [2, 3])
+            self.assertEqual(len(list(pathlib.Path(directory).glob('version-*'))), 2)
+
+
+class ResultStoreTestCase(TestCase):
+
+    def setUp(self):
+        similarity_index.reset()
+
+    @staticmethod
+    def detect_result(faces=1):
+        return {'error_code': 0, 'log_id': 1, 'result': {'face_num': faces, 'face_list': [{
+            'face_token': f'token{i}',
+            'location': {'left': 1, 'top': 2, 'width': 3, 'height': 4, 'rotation': 5},
+            'age': 20 + i,
+            'gender': {'type': 'male', 'probability': 0.9},
+            'race': {'type': 'yellow', 'probability': 1},
+            'landmark72': [{'x': 1, 'y': 2}, {'x': 3, 'y': 4}],
+        } for i in range(faces)]}}
+
+    def test_write_and_read_back(self):
+        ResultStore.write([
+            ('md5a', 'c1', 'age', 'baidu', self.detect_result(faces=2)),
+            ('md5a', 'c1', 'age', 'baidu', self.detect_result(faces=2)),
+            ('md5b', 'c1', 'age', 'baidu', self.detect_result()),
+            ('md5c', 'c2', 'age', 'baidu', self.detect_result()),
+        ])
+        self.assertEqual(FaceImage.objects.count(), 3)
+        self.assertEqual(Face.objects.count(), 4)
+
+        page = self.client.get('/results/', {'client_id': 'c1', 'limit': 1}).json()
+        self.assertEqual([image['digest'] for image in page['results']], ['md5b'])
+        face = page['results'][0]['faces'][0]
+        self.assertEqual(face['landmark72'], [1, 2, 3, 4])
+        self.assertEqual(face['race'], {'type': 'yellow', 'probability': 1})
+
+        page = self.client.get('/results/', {'client_id': 'c1', 'before': page['next']}).json()
+        self.assertEqual([image['digest'] for image in page['results']], ['md5a'])
+        self.assertEqual([face['age'] for face in page['results'][0]['faces']], [20, 21])
+        self.assertIsNone(page['next'])
+
+        # at least one result per page
+        for limit in (0, -2):
+            page = self.client.get('/results/', {'client_id': 'c1', 'limit': limit}).json()
+            self.assertEqual([image['digest'] for image in page['results']], ['md5b'])
+
+    def test_similar_faces(self):
+        points = np.random.RandomState(1).uniform(0, 100, size=(72, 2))
+        other = np.random.RandomState(2).uniform(0, 100, size=(72, 2))
+        results = []
+        for digest, face in (('same', points), ('bigger', points * 2 + 5), ('other', other)):
+            result = self.detect_result()
+            result['result']['face_list'][0]['landmark72'] = [{'x': x, 'y': y} for x, y in face.tolist()]
+            results.append((digest, 'c1', 'age', 'baidu', result))
+        ResultStore.write(results)
+
+        face_id = Face.objects.get(image__digest='same').pk
+        response = self.client.get('/similar/', {'face_id': face_id, 'k': 2}).json()
+        self.assertEqual([match['digest'] for match in response['results']], ['bigger', 'other'])
+        self.assertAlmostEqual(response['results'][0]['score'], 1, places=5)
+
+        # rebuilt from the database gives the same answer
+        similarity_index.reset()
+        self.assertEqual(self.client.get('/similar/', {'face_id': face_id, 'k': 1}).json()['results'],
+                         response['results'][:1])
+        self.assertEqual(self.client.get('/similar/', {'face_id': face_id, 'k': -1}).json()['results'],
+                         response['results'][:1])
+        self.assertEqual(self.client.get('/similar/', {'face_id': 0}).status_code, 404)
+
+    def landmark_results(self, *seeds):
+        results = []
+        for seed in seeds:
+            result = self.detect_result()
+            points = np.random.RandomState(seed).uniform(0, 100, size=(72, 2))
+            result['result']['face_list'][0]['landmark72'] = [{'x': x, 'y': y} for x, y in points.tolist()]
+            results.append((f'md5{seed}', 'c1', 'age', 'baidu', result))
+        return results
+
+    def test_faces_stored_by_other_processes(self):
+        ResultStore.write(self.landmark_results(1, 2))
+        other = SimilarityIndex()  # another worker, ResultStore.write only adds to the index of this one
+        self.assertEqual(len(other.index), 2)
+
+        ResultStore.write(self.landmark_results(3))
+        new_face = Face.objects.get(image__digest='md53').pk
+        first_face = Face.objects.get(image__digest='md51').pk
+        self.assertIn(new_face, [face_id for face_id, _ in other.search(first_face)])
+
+        # stored with a lower id than faces this process has already seen
+        Landmark.objects.filter(face_id=first_face).delete()
+        reloaded = SimilarityIndex()
+        self.assertNotIn(first_face, reloaded.index)
+        Landmark.objects.create(face_id=first_face, kind='landmark72', points=json.dumps(
+            np.random.RandomState(1).uniform(0, 100, size=144).tolist()))
+        self.assertEqual(len(reloaded.search(first_face)), 2)
+
+    def test_loaded_index_topped_up(self):
+        ResultStore.write(self.landmark_results(1, 2))
+        with tempfile.TemporaryDirectory() as directory:
+            saving = SimilarityIndex(directory=directory)
+            saving.index.save(directory)
+
+            ResultStore.write(self.landmark_results(3))
+            loaded = SimilarityIndex(directory=directory)
+            self.assertEqual(len(loaded.index), 3)
+
+            # one writer at a time, the other keeps its changes for its next save
+            loaded._dirty = True
+            with open(os.path.join(directory, 'save.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                loaded.maybe_save(force=True)
+                self.assertTrue(loaded._dirty)
+            loaded.maybe_save(force=True)
+            self.assertFalse(loaded._dirty)
+            self.assertEqual(len(FaceIndex.load(directory)), 3)
+
+
+class JobQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        settings = override_settings(AIFACE_JOB_DIR=self.tmp.name, AIFACE_JOB_MAX_ATTEMPTS=2,
+                                     AIFACE_JOB_MAX_DEPTH=2, AIFACE_JOB_RETRY_DELAY=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def submit(self, color='red'):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (4, 4), color).save(jpeg, format='JPEG')
+        img = SimpleUploadedFile('a.jpg', jpeg.getvalue(), content_type='image/jpeg')
+        return self.client.post('/jobs/', {'img': img}, HTTP_X_CID='c1')
+
+    def test_submit_run_and_poll(self):
+        response = self.submit()
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['job_id']
+
+        with mock.patch('apps.aiface.jobs.process', return_value={'data': {}, 'segments': {}}) as process:
+            self.assertTrue(jobs.run(jobs.claim('w1')))
+        self.assertEqual(process.call_args[0][0].client_id, 'c1')
+        self.assertIsNone(jobs.claim('w1'))
+
+        job = self.client.get(f'/jobs/{job_id}/').json()
+        self.assertEqual((job['status'], job['attempts'], job['result']), ('done', 1, {'data': {}, 'segments': {}}))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(self.client.get('/jobs/0/').status_code, 404)
+
+    def test_retry_then_fail(self):
+        self.submit()
+        with mock.patch('apps.aiface.jobs.process', side_effect=jobs.JobError('api down')), \
+                self.assertLogs('apps.aiface.jobs', 'ERROR'):
+            self.assertTrue(jobs.run(jobs.claim('w1')))
+            self.assertEqual(Job.objects.get().status, JobStatus.QUEUED)
+            self.assertTrue(jobs.run(jobs.claim('w1')))
+
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts, job.error), (JobStatus.FAILED, 2, 'JobError: api down'))
+
+    def test_visibility_timeout(self):
+        self.submit()
+        stuck = jobs.claim('w1')
+        self.assertIsNone(jobs.claim('w2'))
+
+        Job.objects.update(visible_at=timezone.now())
+        taken = jobs.claim('w2')
+        self.assertEqual((taken.worker, taken.attempts), ('w2', 2))
+        # the first worker lost its lease
+        self.assertFalse(jobs.finish(stuck, {}))
+
+        Job.objects.update(visible_at=timezone.now())
+        self.assertIsNone(jobs.claim('w3'))
+        self.assertEqual(Job.objects.get().status, JobStatus.FAILED)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_backpressure(self):
+        self.assertEqual(self.submit('red').status_code, 202)
+        self.assertEqual(self.submit('blue').status_code, 202)
+        response = self.submit('green')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+
+class BlobStoreTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = BlobStore(self.tmp.name)
+
+    def test_put_once(self):
+        digest, path, written = self.store.put_bytes(b'abc', '.jpg')
+        self.assertTrue(written)
+        self.assertEqual(path.relative_to(self.tmp.name).as_posix(), f'{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+        self.assertEqual(self.store.put_bytes(b'abc', '.jpg'), (digest, path, False))
+        self.assertEqual(self.store.put_chunks([b'a', b'bc'], '.jpg'), (digest, path, False))
+        self.assertEqual(sorted(p.name for p in pathlib.Path(self.tmp.name).rglob('*') if p.is_file()),
+                         [f'{digest}.jpg'])
+
+    def test_link(self):
+        _, path, _ = self.store.put_chunks([b'abc'], '.png')
+        target = pathlib.Path(self.tmp.name, 'facial', 'c1', 'full', 'a.png')
+        self.store.link(path, target)
+        self.store.link(path, target)
+        self.assertTrue(os.path.samefile(path, target))
+
+    def test_write_to_linked_path(self):
+        _, path, _ = self.store.put_bytes(b'abc', '.png')
+        target = pathlib.Path(self.tmp.name, 'facial', 'c1', 'full', 'a.png')
+        self.store.link(path, target)
+        self.assertEqual(os.stat(target).st_mode & 0o777, 0o444)
+
+        # a new version of the user's file replaces the link, the blob other clients share stays as it was
+        _, other, _ = self.store.put_chunks([b'xyz'], '.png')
+        self.store.link(other, target)
+        self.assertEqual(path.read_bytes(), b'abc')
+        self.assertEqual(target.read_bytes(), b'xyz')
+
+
+class SegmentBlobTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        settings = override_settings(UPLOAD_DIR=self.tmp.name, AIFACE_BLOB_DIR=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def save(self, client_id, raw, data):
+        person_result = mock.Mock(face_img_name='same.jpg')
+        person_result.user.client_id = client_id
+        return imageutil.face_segments_save(json.loads(json.dumps(data)), SimpleUploadedFile('same.jpg', raw),
+                                            person_result)
+
+    def test_same_image_stored_once(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (300, 200), 'red').save(jpeg, format='JPEG')
+        data = tencent_result(300, 200, centered=True)
+
+        self.save('c1', jpeg.getvalue(), data)
+        self.save('c2', jpeg.getvalue(), data)
+        blobs = [path for path in pathlib.Path(self.tmp.name, 'blobs').rglob('*') if path.is_file()]
+        self.assertEqual(len(blobs), len(imageutil.STORED_SEGMENTS))  # one set for both clients
+        self.assertEqual(SegmentBlob.objects.count(), 2 * len(imageutil.STORED_SEGMENTS))
+
+        with mock.patch('utils.imageutil.rotated_crops') as crops:
+            self.save('c1', jpeg.getvalue(), data)
+        crops.assert_not_called()
+        full = pathlib.Path(self.tmp.name, 'facial', 'c1', 'full', 'same.jpg')
+        self.assertTrue(os.path.samefile(full, pathlib.Path(self.tmp.name, 'facial', 'c2', 'full', 'same.jpg')))
+
+    def test_every_face_segmented(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (600, 400), 'blue').save(jpeg, format='JPEG')
+        data = tencent_result(600, 400, faces=3, seed=5)
+        # AnalyzeFace lists the faces in its own order
+        data['FaceShapeSet'] = data['FaceShapeSet'][::-1]
+        self.assertEqual([info for info, _ in imageutil.match_face_shapes(data)], data['FaceInfos'])
+        self.assertIs(imageutil.match_face_shapes(data)[0][1], data['FaceShapeSet'][2])
+
+        self.save('c1', jpeg.getvalue(), data)
+        facial = pathlib.Path(self.tmp.name, 'facial', 'c1')
+        for segment in imageutil.FACE_SEGMENTS:
+            self.assertEqual(sorted(path.name for path in (facial / segment).iterdir()),
+                             ['same.jpg', 'same_1.jpg', 'same_2.jpg'])
+        self.assertEqual(SegmentBlob.objects.count(), 1 + 3 * len(imageutil.FACE_SEGMENTS))
+
+        with mock.patch('utils.imageutil.rotated_crops') as crops:
+            self.save('c1', jpeg.getvalue(), data)
+        crops.assert_not_called()
+
+    def test_draft_decode(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (1600, 1200), 'green').save(jpeg, format='JPEG')
+        data = tencent_result(1600, 1200, centered=True)  # a 400px face
+        face = pathlib.Path(self.tmp.name, 'facial', 'c1', 'face', 'same.jpg')
+
+        self.save('c1', jpeg.getvalue(), data)
+        with Image.open(face) as crop:
+            self.assertEqual(crop.width, 400)
+
+        with override_settings(AIFACE_SEGMENT_SIZE=100):
+            result = self.save('c2', jpeg.getvalue(), data)
+        with Image.open(pathlib.Path(self.tmp.name, 'facial', 'c2', 'face', 'same.jpg')) as crop:
+            self.assertEqual(crop.width, 100)  # decoded at 1/4
+        self.assertEqual(result['FaceInfos'][0]['Width'], 400)
+        self.assertEqual(os.path.getsize(pathlib.Path(self.tmp.name, 'facial', 'c2', 'full', 'same.jpg')),
+                         len(jpeg.getvalue()))
+
+        # c1's full size crops are not reused for the new size
+        with override_settings(AIFACE_SEGMENT_SIZE=100):
+            self.save('c1', jpeg.getvalue(), data)
+        with Image.open(face) as crop:
+            self.assertEqual(crop.width, 100)
+
+    def test_crop_error_reported_after_the_other_faces(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (600, 400), 'blue').save(jpeg, format='JPEG')
+        data = tencent_result(600, 400, faces=3, seed=5)
+        data['FaceInfos'][1]['FaceAttributesInfo']['Roll'] = 13
+
+        def crops(img, boxes, angle, center):
+            if angle == 13:
+                raise ValueError('bad face')
+            return rotated_crops(img, boxes, angle=angle, center=center)
+
+        with mock.patch('utils.imageutil.rotated_crops', side_effect=crops), \
+                self.assertRaises(imageutil.SegmentSaveError) as raised:
+            self.save('c1', jpeg.getvalue(), data)
+        self.assertEqual(set(raised.exception.errors),
+                         {imageutil.segment_key(segment, 1) for segment in imageutil.FACE_SEGMENTS})
+
+        facial = pathlib.Path(self.tmp.name, 'facial', 'c1')
+        for segment in imageutil.FACE_SEGMENTS:
+            self.assertEqual(sorted(path.name for path in (facial / segment).iterdir()), ['same.jpg', 'same_2.jpg'])
+        self.assertTrue((facial / 'full' / 'same.jpg').exists())
+        self.assertEqual(SegmentBlob.objects.count(), 0)  # the next upload tries again
+
+
+class ResilienceTestCase(SimpleTestCase):
+
+    def detect(self, api, policy):
+        pool = AipFacePool(size=4)
+        self.addCleanup(pool.clear)
+
+        def call():
+            with pool.client() as client:
+                return client.detect('aGVsbG8=', 'BASE64', {})
+
+        with patch_clients(api):
+            return policy.call(call, retryable=baidu_retryable)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failures=2, reset_timeout=0.05)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())  # the probe
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+
+    def test_cancelled_probe_released(self):
+        policy = Resilient('test', max_attempts=1, hedge_percentile=None,
+                           breaker=CircuitBreaker(failures=1, reset_timeout=0.05))
+        policy.breaker.failure()
+        time.sleep(0.06)
+
+        async def probe():
+            task = asyncio.ensure_future(policy.call_async(lambda: asyncio.sleep(10)))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(probe())
+        self.assertEqual(policy.breaker.state, CircuitBreaker.OPEN)
+
+        class Interrupted(BaseException):
+            pass
+
+        def interrupted():
+            raise Interrupted()
+
+        time.sleep(0.06)
+        with self.assertRaises(Interrupted):
+            policy.call(interrupted)
+        time.sleep(0.06)
+        self.assertEqual(policy.call(lambda: 'ok'), 'ok')  # the next probe goes through
+        self.assertEqual(policy.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_retry_retryable_errors(self):
+        with FakeFaceAPI(error_script=[True, True]) as api:
+            result = self.detect(api, Resilient('test', max_attempts=3, backoff=0.01, hedge_percentile=None))
+        self.assertEqual(result['error_code'], 0)
+        self.assertEqual(api.calls['detect'], 3)
+
+    def test_breaker_fails_fast(self):
+        policy = Resilient('test', max_attempts=1, hedge_percentile=None, breaker=CircuitBreaker(failures=2))
+        with FakeFaceAPI(error_rate=1) as api:
+            self.assertEqual(self.detect(api, policy)['error_code'], 18)
+            self.assertEqual(self.detect(api, policy)['error_code'], 18)
+            with self.assertRaises(CircuitOpen):
+                self.detect(api, policy)
+        self.assertEqual(api.calls['detect'], 2)
+
+    def test_hedge_slow_call(self):
+        policy = Resilient('test', hedge_percentile=95, hedge_min_samples=5)
+        for _ in range(5):
+            policy.latency.add(0.02)
+
+        with FakeFaceAPI(latency_script=[2000]) as api:
+            start = time.monotonic()
+            self.assertEqual(self.detect(api, policy)['error_code'], 0)
+            self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(api.calls['detect'], 2)
+
+    def test_deadline(self):
+        policy = Resilient('test', deadline=0.2, hedge_percentile=None)
+        with FakeFaceAPI(latency_script=[1000]) as api, self.assertRaises(DeadlineExceeded):
+            self.detect(api, policy)
+
+
+class RouterTestCase(SimpleTestCase):
+
+    class Provider:
+        def __init__(self, name, seconds=0, fail=False):
+            self.name, self.seconds, self.fail = name, seconds, fail
+
+        def detect(self, image_base64):
+            time.sleep(self.seconds)
+            if self.fail:
+                raise ProviderError('down')
+            return [{'age': 1}]
+
+    def test_fastest_first_and_failover(self):
+        slow, fast = self.Provider('slow', seconds=0.02), self.Provider('fast')
+        router = Router([slow, fast], alpha=0.5, max_error_rate=0.5, probe_interval=60)
+        router.detect('img')
+        router.detect('img')
+        self.assertEqual(router.order(), ['fast', 'slow'])
+
+        fast.fail = True
+        self.assertEqual(router.detect('img')['provider'], 'slow')
+        self.assertEqual(router.detect('img')['provider'], 'slow')
+        self.assertEqual(router.order(), ['slow', 'fast'])
+
+        slow.fail = True
+        with self.assertRaises(ProviderError):
+            router.detect('img')
+
+    def test_weights(self):
+        router = Router([self.Provider('a'), self.Provider('b')], weights={'a': 1, 'b': 0}, alpha=0.5,
+                        max_error_rate=0.5, probe_interval=60)
+        self.assertEqual({router.order()[0] for _ in range(20)}, {'a'})
+
+    def test_normalized_providers(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(jpeg, format='JPEG')
+        faces = {}
+        with FakeFaceAPI() as api, patch_clients(api):
+            for provider in ('baidu', 'tencent'):
+                img = SimpleUploadedFile('a.jpg', jpeg.getvalue(), content_type='image/jpeg')
+                result = self.client.post(f'/detect/?provider={provider}', {'img': img}).json()
+                self.assertEqual(result['provider'], provider)
+                faces[provider] = result['faces'][0]
+
+        self.assertEqual(faces['baidu'].keys(), faces['tencent'].keys())
+        self.assertEqual(faces['baidu']['location'], faces['tencent']['location'])
+        self.assertEqual((faces['tencent']['gender'], faces['tencent']['expression']), ('male', 'smile'))
+        self.assertEqual(len(faces['baidu']['landmarks']), 144)
+        metrics = self.client.get('/metrics/').content.decode()
+        self.assertIn('aiface_provider_latency_seconds{provider="baidu"}', metrics)
+
+    def test_provider_not_turned_on(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(jpeg, format='JPEG')
+        img = SimpleUploadedFile('a.jpg', jpeg.getvalue(), content_type='image/jpeg')
+        with mock.patch('apps.aiface.providers._router', Router([PROVIDERS['baidu']])):
+            response = self.client.post('/detect/?provider=tencent', {'img': img})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['msg'], 'provider: baidu')
+
+    def test_same_roll_from_both_providers(self):
+        baidu = {'location': {'left': 1, 'top': 2, 'width': 3, 'height': 4, 'rotation': 12}}
+        tencent = {'X': 1, 'Y': 2, 'Width': 3, 'Height': 4, 'FaceAttributesInfo': {'Roll': -12}}
+        self.assertEqual(BaiduProvider.normalize(baidu)['location'], TencentProvider.normalize(tencent)['location'])
+        # the angle baidu_descriptor rotates by
+        self.assertEqual(BaiduProvider.normalize(baidu)['location']['roll'], -12)
+
+    def test_failover_on_baidu_transport_error(self):
+        router = Router([PROVIDERS['baidu'], PROVIDERS['tencent']], alpha=0.5, max_error_rate=0.5, probe_interval=60)
+        errors = [requests.exceptions.ConnectionError('refused'), json.JSONDecodeError('Expecting value', '<html>', 0)]
+        with FakeFaceAPI() as api, patch_clients(api), \
+                mock.patch('apps.aiface.providers.baidu_detect', side_effect=errors):
+            for _ in errors:
+                router.stats['baidu'].last_failure = 0  # try baidu first again
+                self.assertEqual(router.detect(base64.b64encode(b'img').decode())['provider'], 'tencent')
+
+        self.assertEqual(router.stats['baidu'].calls, 2)
+        self.assertGreater(router.stats['baidu'].error_rate, 0)
+        self.assertEqual(router.stats['tencent'].calls, 2)
+
+
+class AsgiTestCase(SimpleTestCase):
+
+    @staticmethod
+    async def request(app, method, path, body=b'', content_type=MULTIPART_CONTENT):
+        scope = {'type': 'http', 'method': method, 'path': path, 'root_path': '', 'query_string': b'',
+                 'http_version': '1.1', 'headers': [(b'content-type', content_type.encode())]}
+        chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)] or [b'']
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await app(scope, receive, send)
+        headers = dict(sent[0]['headers'])
+        return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+    @staticmethod
+    def upload(color):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (8, 8), color).save(jpeg, format='JPEG')
+        return encode_multipart(BOUNDARY, {'img': SimpleUploadedFile('a.jpg', jpeg.getvalue())})
+
+    def test_index_on_the_event_loop(self):
+        client = AsyncBaiduClient(max_inflight=2)
+        app = AsyncDetectApplication(None, client=client)
+
+        async def main():
+            try:
+                return await asyncio.gather(*[self.request(app, 'POST', '/', self.upload((i * 40, 0, 0)))
+                                              for i in range(6)])
+            finally:
+                await client.close()
+
+        with FakeFaceAPI(latency_ms=50) as api, patch_clients(api):
+            start = time.monotonic()
+            responses = asyncio.run(main())
+            elapsed = time.monotonic() - start
+
+        for status_code, headers, body in responses:
+            self.assertEqual(status_code, 200)
+            self.assertEqual(json.loads(body)['error_code'], 0)
+            self.assertIn(b'detect;dur=', headers[b'server-timing'])
+        self.assertEqual(api.calls['detect'], 6)
+        self.assertGreaterEqual(elapsed, 3 * 0.05)  # 2 at a time
+
+    def test_same_image_detected_once(self):
+        client = AsyncBaiduClient()
+        app = AsyncDetectApplication(None, client=client)
+
+        async def main():
+            try:
+                return await asyncio.gather(*[self.request(app, 'POST', '/', self.upload((9, 9, 9)))
+                                              for _ in range(4)])
+            finally:
+                await client.close()
+
+        detect_cache.clear()
+        with FakeFaceAPI(latency_ms=50) as api, patch_clients(api):
+            responses = asyncio.run(main())
+
+        self.assertEqual([json.loads(body)['error_code'] for _, _, body in responses], [0] * 4)
+        self.assertEqual(api.calls['detect'], 1)
+        self.assertEqual(app._inflight, {})
+
+    def test_shared_result_rescaled_once(self):
+        client = AsyncBaiduClient()
+        app = AsyncDetectApplication(None, client=client)
+        jpeg = io.BytesIO()
+        Image.new('RGB', (2000, 1000), 'gray').save(jpeg, format='JPEG')
+        body = encode_multipart(BOUNDARY, {'img': SimpleUploadedFile('a.jpg', jpeg.getvalue())})
+
+        async def main():
+            try:
+                return await asyncio.gather(*[self.request(app, 'POST', '/', body) for _ in range(3)])
+            finally:
+                await client.close()
+
+        detect_cache.clear()
+        with FakeFaceAPI(latency_ms=50) as api, patch_clients(api), \
+                override_settings(AIFACE_PREPROCESS=True, AIFACE_PREPROCESS_MAX_EDGE=500):
+            responses = asyncio.run(main())
+            # the fixture face is at left 300 on the 500px wide copy baidu gets
+            self.assertEqual([json.loads(body)['result']['face_list'][0]['location']['left']
+                              for _, _, body in responses], [1200] * 3)
+            cached = asyncio.run(self.request(app, 'POST', '/', body))
+        self.assertEqual(json.loads(cached[2])['result']['face_list'][0]['location']['left'], 1200)
+        self.assertEqual(api.calls['detect'], 1)
+
+    def test_non_json_error_page_retried(self):
+        client = AsyncBaiduClient()
+        answers = [httpx.Response(502, text='<html>bad gateway</html>'), httpx.Response(200, json={'error_code': 0})]
+
+        async def main():
+            client._bind()
+            client._http = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: answers.pop(0)))
+            try:
+                return await client.detect('img', 'BASE64', {})
+            finally:
+                await client.close()
+
+        with FakeFaceAPI() as api, patch_clients(api):
+            self.assertEqual(asyncio.run(main()), {'error_code': 0})
+        self.assertEqual(answers, [])
+
+    def test_validation_and_wsgi_fallback(self):
+        app = AsyncDetectApplication(WsgiToAsgi(WSGIHandler()), client=AsyncBaiduClient())
+        body = encode_multipart(BOUNDARY, {'img': SimpleUploadedFile('a.jpg', b'not an image at all')})
+
+        status_code, _, content = asyncio.run(self.request(app, 'POST', '/', body))
+        self.assertEqual(status_code, 200)
+        self.assertIn('图片格式错误', json.loads(content)['msg'])
+
+        status_code, _, content = asyncio.run(self.request(app, 'GET', '/metrics/'))
+        self.assertEqual(status_code, 200)
+        self.assertIn(b'aiface_stage_seconds', content)
+
+
+class TokenCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'token.json')
+        self.fetched = []
+
+    def fetch(self, expires_in=3600):
+        self.fetched.append(f'token{len(self.fetched)}')
+        return {'access_token': self.fetched[-1], 'expires_in': expires_in, 'time': int(time.time())}
+
+    def cache(self, **kwargs):
+        return TokenCache(self.path, self.fetch, background=False, **kwargs)
+
+    def test_shared_between_processes(self):
+        first, second = self.cache(), self.cache()
+        self.assertEqual(first.get()['access_token'], 'token0')
+        self.assertEqual(second.get()['access_token'], 'token0')
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_stale_token_replaced_once(self):
+        first, second = self.cache(), self.cache()
+        first.get(), second.get()
+        self.assertEqual(first.get(stale='token0')['access_token'], 'token1')
+        self.assertEqual(second.get(stale='token0')['access_token'], 'token1')
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_refresh_before_expiry(self):
+        cache = self.cache(margin=600, retry_interval=5)
+        self.assertAlmostEqual(cache.refresh(), 3600 - 600, delta=2)  # nothing cached yet, fetched right away
+        self.assertEqual(len(self.fetched), 1)
+
+        self.fetch = lambda: {'error': 'invalid_client'}
+        cache.fetch = self.fetch
+        with open(self.path, 'w') as f:
+            json.dump({'access_token': 'old', 'expires_in': 300, 'time': int(time.time())}, f)
+        with self.assertLogs('utils.tokencache', 'ERROR'):
+            self.assertEqual(cache.refresh(), 5)
+        self.assertEqual(cache.get()['access_token'], 'token0')  # the copy in memory still works
+
+
+class StartupTestCase(SimpleTestCase):
+
+    def test_lazy_import(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'aiface_lazy_target.py'), 'w') as f:
+            f.write('VALUE = 42\n')
+        sys.path.insert(0, directory)
+        self.addCleanup(sys.path.remove, directory)
+        self.addCleanup(sys.modules.pop, 'aiface_lazy_target', None)
+
+        module = lazy_import('aiface_lazy_target')
+        self.assertIsInstance(module, LazyModule)
+        self.assertNotIn('aiface_lazy_target', sys.modules)
+        self.assertEqual(module.VALUE, 42)
+        self.assertIn('aiface_lazy_target', sys.modules)
+        self.assertIs(lazy_import('aiface_lazy_target'), sys.modules['aiface_lazy_target'])
+
+    def test_parse_importtime(self):
+        text = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       100 |        100 |     b1\n'
+            'import time:       200 |        300 |   b\n'
+            'import time:        50 |         50 |   c\n'
+            'import time:      1000 |       1350 | a\n'
+        )
+        self.assertEqual([(depth, name) for depth, name, _, _ in parse_importtime(text)],
+                         [(0, 'a'), (1, 'b'), (2, 'b1'), (1, 'c')])
+        self.assertEqual(parse_importtime(text)[0][2:], (0.001, 0.00135))
+
+    def test_startup_budget(self):
+        # AIFACE_STARTUP_BUDGET_MS, and no vendor sdk or imaging code imported before its first use, wsgi and asgi
+        out = io.StringIO()
+        call_command('aiface_startup', stdout=out)
+        self.assertIn('wsgi:', out.getvalue())
+        self.assertIn('asgi:', out.getvalue())
+        self.assertEqual(out.getvalue().count('imported before first use: -'), 2)
@@ -0,0 +1,141 @@
+import functools
+import io
+import struct
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from hurry.filesize import size
+
+from utils.lazy import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+# leading bytes of the accepted formats, the client supplied content type is not trusted
+MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+)
+MAGIC_LENGTH = max(len(magic) for magic, _ in MAGIC_NUMBERS)
+
+# the image size has to show up within this many bytes, jpeg exif thumbnails can push it quite far
+HEADER_LIMIT = 256 * 1024
+
+
+def sniff_content_type(head: bytes):
+    for magic, content_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return content_type
+    return None
+
+
+def image_dimensions(head: bytes):
+    """
+    :return: (width, height) from the header alone, None while the header is still incomplete
+    """
+    if sniff_content_type(head) == 'image/png':
+        # the IHDR chunk always comes first, no need to wait for the chunks pillow reads up to IDAT
+        return struct.unpack('>II', head[16:24]) if len(head) >= 24 else None
+
+    try:
+        return Image.open(io.BytesIO(head)).size  # lazy, no pixel is decoded
+    except Exception:
+        return None
+
+
+class ImageGuardUploadHandler(FileUploadHandler):
+    """
+    sits in front of django's own handlers and stops the upload as soon as a file is not an image
+    or is over the byte / pixel limits, the reason ends up in request.upload_rejected
+
+    with per_file only the bad file is cut off, the rest of the upload goes on and the reason ends up in
+    request.upload_file_errors[(field_name, n)] for the n-th file of that field
+    """
+
+    def __init__(self, request=None, max_bytes=None, max_pixels=None, per_file=False):
+        super().__init__(request)
+        self.max_bytes = max_bytes or settings.AIFACE_UPLOAD_MAX_BYTES
+        self.max_pixels = max_pixels or settings.AIFACE_UPLOAD_MAX_PIXELS
+        self.per_file = per_file
+        self.file_counts = {}
+        if per_file and request is not None:
+            request.upload_file_errors = {}
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.ordinal = self.file_counts.get(field_name, 0)
+        self.file_counts[field_name] = self.ordinal + 1
+        self.received = 0
+        self.head = b''
+        self.checked = False
+        self.rejected = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.rejected:
+            return None  # the next handlers keep what came before, the file is reported by its error
+
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            self.reject(f'图片大小: 超过{size(self.max_bytes)}')
+
+        if not self.checked and not self.rejected:
+            self.head += raw_data[:HEADER_LIMIT - len(self.head)]
+            self.check_head()
+
+        return None if self.rejected else raw_data
+
+    def check_head(self):
+        if len(self.head) < MAGIC_LENGTH:
+            return
+
+        if sniff_content_type(self.head) is None:
+            self.reject(f'图片格式错误{self.content_type}')
+            return
+
+        dimensions = image_dimensions(self.head)
+        if dimensions is None:
+            # give up on the header once it is this long, img_validate still checks the full file
+            if len(self.head) >= HEADER_LIMIT:
+                self.checked = True
+                self.head = b''
+            return
+
+        self.checked = True
+        self.head = b''
+        width, height = dimensions
+        if width * height > self.max_pixels:
+            self.reject(f'图片尺寸: {width}x{height}, 超过{self.max_pixels // 1000000}M像素')
+
+    def reject(self, msg):
+        if self.per_file:
+            self.rejected = True
+            if self.request is not None:
+                self.request.upload_file_errors[(self.field_name, self.ordinal)] = msg
+            return
+        if self.request is not None:
+            self.request.upload_rejected = msg
+        raise StopUpload(connection_reset=True)
+
+    def file_complete(self, file_size):
+        return None  # the next handler builds the file
+
+
+def guard_image_upload(view):
+    """
+    must wrap the view before anything reads request.POST or request.FILES
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers.insert(0, ImageGuardUploadHandler(request))
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def guard_batch_upload(view):
+    """
+    guard_image_upload for several images, a bad one doesn't take the others down, see per_file
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers.insert(0, ImageGuardUploadHandler(request, per_file=True))
+        return view(request, *args, **kwargs)
+    return wrapper
@@ -3,4 +3,11 @@ from apps.aiface import views
 
 urlpatterns = [
     path('', views.index),
+    path('batch/', views.batch),
+    path('detect/', views.detect),
+    path('metrics/', views.metrics),
+    path('results/', views.results),
+    path('similar/', views.similar),
+    path('jobs/', views.job_submit),
+    path('jobs/<int:job_id>/', views.job_status),
 ]
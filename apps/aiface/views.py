@@ -1,23 +1,259 @@
-import base64
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image
-from aip import AipFace
 from django.conf import settings
-
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from hurry.filesize import size
 
+from apps.aiface import jobs
+from apps.aiface.cache import detect_cache
+from apps.aiface.clients import baidu_detect
+from apps.aiface.models import Face, FaceImage, Job
+from apps.aiface.preprocess import prepare_image, rescale_result
+from apps.aiface.providers import ProviderError, get_router
+from apps.aiface.response import FACE_FIELDS, dumps_line, project, render, request_options
+from apps.aiface.similarity import similarity_index
+from apps.aiface.store import result_store
+from apps.aiface.uploadhandler import MAGIC_LENGTH, guard_batch_upload, guard_image_upload, sniff_content_type
+from utils import timing
+from utils.fileutil import stream_file
+from utils.resilience import ResilienceError
+from utils.timing import stage, submit
+
 
 
 
+@guard_image_upload
 def index(request):
+    img, fields, fmt, error = index_upload(request)
+    if error is not None:
+        return error
+
+    result = aiface_baidu_api(img, client_id=request.META.get('HTTP_X_CID', ''), fields=fields)
+    with stage('serialize'):
+        return render(result, fmt)
+
+
+def index_upload(request):
+    """
+    the upload and the options of index, shared with the asgi path of apps.aiface.asgi
+    the request must already carry the guard_image_upload handler
+    :return: (img, fields, fmt, error response or None)
+    """
+    with stage('parse'):
+        img = request.FILES.get('img')
+    if hasattr(request, 'upload_rejected'):
+        return None, None, None, JsonResponse({'msg': request.upload_rejected})
+    with stage('validate'):
+        valid = img_validate(img)
+    if valid != 1:
+        return None, None, None, JsonResponse({'msg': valid})
+
+    # ?fields=age,gender only asks detect for those, ?format=compact|msgpack shrinks the response
+    fields, fmt, error = request_options(request)
+    return img, fields, fmt, error
+
+
+def metrics(request):
+    return HttpResponse(timing.prometheus() + get_router().prometheus(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@guard_image_upload
+def detect(request):
+    """
+    POST img, detection by whichever provider is faster and healthy right now, in the provider independent form
+    ?provider=baidu|tencent to pick one
+    """
+    img = request.FILES.get('img')
+    if hasattr(request, 'upload_rejected'):
+        return JsonResponse({'msg': request.upload_rejected})
+    valid = img_validate(img)
+    if valid != 1:
+        return JsonResponse({'msg': valid})
+
+    # only the providers AIFACE_PROVIDERS turned on
+    router = get_router()
+    provider = request.GET.get('provider')
+    if provider is not None and provider not in router.providers:
+        return JsonResponse({'msg': f'provider: {"/".join(router.providers)}'}, status=400)
+
+    with stage('encode'):
+        image = stream_file(img, hasher=('base64',))['base64']
+    try:
+        result = router.detect(image, provider=provider)
+    except ProviderError as err:
+        return JsonResponse({'msg': str(err)}, status=503)
+    with stage('serialize'):
+        return JsonResponse(result)
+
+
+@guard_batch_upload
+def batch(request):
+    imgs = request.FILES.getlist('img')
+    if not imgs:
+        return JsonResponse({'msg': '没有图片'})
+
+    max_files = settings.AIFACE_BATCH_MAX_FILES
+    if len(imgs) > max_files:
+        return JsonResponse({'msg': f'图片数量: {len(imgs)}, 超过{max_files}张'})
+
+    fields, fmt, error = request_options(request, formats=('json', 'compact'))
+    if error is not None:
+        return error
+
+    # validate everything before the first api call, invalid images are reported in place
+    rejected = request.upload_file_errors
+    valids = [rejected.get(('img', i)) or img_validate(img) for i, img in enumerate(imgs)]
+
+    results = batch_results(imgs, valids, client_id=request.META.get('HTTP_X_CID', ''), fields=fields, fmt=fmt)
+    return StreamingHttpResponse(results, content_type='application/x-ndjson')
+
+
+def batch_results(imgs, valids, client_id='', fields=FACE_FIELDS, fmt='json'):
+    """
+    one json line per image, in the order of the upload, each line is sent as soon as it is ready
+    """
+    workers = min(settings.AIFACE_BATCH_CONCURRENCY, len(imgs))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aiface_batch')
+    futures = [submit(executor, aiface_baidu_api, img, client_id=client_id, fields=fields) if valid == 1 else None
+               for img, valid in zip(imgs, valids)]
+
+    try:
+        for index, (img, valid, future) in enumerate(zip(imgs, valids, futures)):
+            item = {'index': index, 'name': img.name}
+            if future is None:
+                item['msg'] = valid
+            else:
+                try:
+                    item['result'] = future.result()
+                except Exception as err:  # one bad image must not take the whole batch down
+                    item['msg'] = f'{type(err).__name__}: {err}'
+            yield dumps_line(item, fmt)
+    finally:
+        # the client may hang up halfway, don't start what nobody is waiting for
+        for future in futures:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
+
+
+@guard_image_upload
+def job_submit(request):
+    """
+    POST img, the tencent detection and the segments run later in an aiface_worker process
+    poll /jobs/<job_id>/ for the result
+    """
     img = request.FILES.get('img')
+    if hasattr(request, 'upload_rejected'):
+        return JsonResponse({'msg': request.upload_rejected})
     valid = img_validate(img)
     if valid != 1:
         return JsonResponse({'msg': valid})
 
-    result = aiface_baidu_api(img)
-    return JsonResponse(result)
+    try:
+        with stage('job_submit'):
+            job = jobs.submit(img, client_id=request.META.get('HTTP_X_CID', ''))
+    except jobs.QueueFull as err:
+        response = JsonResponse({'msg': str(err)}, status=503)
+        response['Retry-After'] = settings.AIFACE_JOB_RETRY_DELAY
+        return response
+    return JsonResponse(jobs.job_to_dict(job), status=202)
+
+
+def job_status(request, job_id):
+    try:
+        job = Job.objects.get(pk=job_id)
+    except Job.DoesNotExist:
+        return JsonResponse({'msg': f'job {job_id} 不存在'}, status=404)
+    return JsonResponse(jobs.job_to_dict(job))
+
+
+def results(request):
+    """
+    stored detect results, newest first
+    GET ?client_id=&digest=&before=&limit=, client_id falls back to the X-CID header
+    pass the returned `next` as `before` to get the following page
+    """
+    client_id = request.GET.get('client_id', request.META.get('HTTP_X_CID'))
+    digest = request.GET.get('digest')
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 20)), settings.AIFACE_RESULTS_MAX_LIMIT))
+        before = int(request.GET['before']) if request.GET.get('before') else None
+    except ValueError:
+        return JsonResponse({'msg': 'limit / before 必须是整数'}, status=400)
+
+    images = FaceImage.objects.order_by('-id').prefetch_related('faces__landmarks')
+    if client_id is not None:
+        images = images.filter(client_id=client_id)
+    if digest:
+        images = images.filter(digest=digest)
+    if before is not None:
+        images = images.filter(id__lt=before)
+
+    page = list(images[:limit + 1])
+    return JsonResponse({
+        'results': [image_to_dict(image) for image in page[:limit]],
+        'next': page[limit - 1].pk if len(page) > limit else None,
+    })
+
+
+def similar(request):
+    """
+    stored faces with the closest landmark72 geometry
+    GET ?face_id=&k=&metric=cosine|l2, face_id as returned by /results/
+    """
+    try:
+        face_id = int(request.GET['face_id'])
+        k = max(1, min(int(request.GET.get('k', 10)), settings.AIFACE_RESULTS_MAX_LIMIT))
+    except (KeyError, ValueError):
+        return JsonResponse({'msg': 'face_id / k 必须是整数'}, status=400)
+
+    metric = request.GET.get('metric', 'cosine')
+    if metric not in ('cosine', 'l2'):
+        return JsonResponse({'msg': 'metric: cosine / l2'}, status=400)
+
+    try:
+        with stage('similar'):
+            matches = similarity_index.search(face_id, k=k, metric=metric)
+    except KeyError:
+        return JsonResponse({'msg': f'face {face_id} 没有landmark72'}, status=404)
+
+    faces = Face.objects.select_related('image').in_bulk([match_id for match_id, _ in matches])
+    return JsonResponse({'face_id': face_id, 'metric': metric, 'results': [{
+        'face_id': match_id,
+        'score': score,
+        'index': faces[match_id].index,
+        'image_id': faces[match_id].image_id,
+        'digest': faces[match_id].image.digest,
+        'client_id': faces[match_id].image.client_id,
+    } for match_id, score in matches if match_id in faces]})
+
+
+def image_to_dict(image):
+    return {
+        'id': image.pk,
+        'digest': image.digest,
+        'client_id': image.client_id,
+        'provider': image.provider,
+        'face_field': image.face_field,
+        'face_num': image.face_num,
+        'log_id': image.log_id,
+        'created': image.created.isoformat(),
+        'faces': [{
+            'id': face.pk,
+            'index': face.index,
+            'face_token': face.face_token,
+            'location': {'left': face.left, 'top': face.top, 'width': face.width, 'height': face.height,
+                         'rotation': face.rotation},
+            'face_probability': face.probability,
+            'age': face.age,
+            'beauty': face.beauty,
+            'gender': face.gender,
+            **json.loads(face.attributes),
+            **{landmark.kind: json.loads(landmark.points) for landmark in face.landmarks.all()},
+        } for face in image.faces.all()],
+    }
 
 
 def img_validate(img):  # 可以丢在serializer
@@ -26,31 +262,78 @@ def img_validate(img):  # 可以丢在serializer
     if not img:
         return '没有图片'
 
-    if img.size > (10 * 1024 * 1024):
-        return f'图片大小: {size(img.size)}, 超过10M'
+    max_bytes = settings.AIFACE_UPLOAD_MAX_BYTES
+    if img.size > max_bytes:
+        return f'图片大小: {size(img.size)}, 超过{size(max_bytes)}'
 
-    if img.content_type not in acceptable_content_type:
+    # go by the file content, the content type comes from the client
+    img.seek(0)
+    content_type = sniff_content_type(img.read(MAGIC_LENGTH))
+    img.seek(0)
+    if content_type not in acceptable_content_type:
         return f'图片格式错误{img.content_type}'
 
     return 1
 
 
-def aiface_baidu_api(img):
-    client = AipFace(settings.APP_ID, settings.API_KEY, settings.SECRET)
-
-    with img.open('rb') as image_file:
-        encoded_string = base64.b64encode(image_file.read())
-
-    image = encoded_string.decode()
-    image_type = "BASE64"
-    face_field = 'age,beauty,expression,face_shape,gender,glasses,landmark,landmark72,race,quality,eye_status,face_type'
-    options = {
-        'face_field': face_field,
+def detect_options(fields=FACE_FIELDS) -> dict:
+    return {
+        'face_field': ','.join(fields),
         'max_face_num': 2,
         'face_type': 'LIVE',
     }
-    result = client.detect(image, image_type, options)
-    return result
+
+
+def encode_upload(img) -> dict:
+    # md5 for the cache key and the base64 payload, in a single pass over the upload
+    with stage('encode'):
+        return stream_file(img, hasher=('md5',) if settings.AIFACE_PREPROCESS else ('md5', 'base64'))
+
+
+def detect_image(img, stream) -> tuple:
+    """
+    :return: (image, scale), the base64 detect gets and the factor to map its coordinates back to the upload
+    """
+    if settings.AIFACE_PREPROCESS:
+        with stage('preprocess'):
+            return prepare_image(img)
+    return stream['base64'], 1
+
+
+def detect_cacheable(result) -> bool:
+    return result.get('error_code') == 0
+
+
+def save_result(digest, client_id, fields, result) -> dict:
+    """
+    :return: the result with only the asked for fields
+    """
+    if settings.AIFACE_STORE_RESULTS:
+        result_store.submit(digest, client_id, ','.join(fields), result)
+    return result if fields == FACE_FIELDS else project(result, fields)
+
+
+def aiface_baidu_api(img, client_id='', fields=FACE_FIELDS):
+    """
+    :param fields:  face_field attributes to ask for, see response.parse_fields, faces come back with only those
+    """
+    options = detect_options(fields)
+    stream = encode_upload(img)
+
+    def detect():
+        image, scale = detect_image(img, stream)
+        image_type = "BASE64"
+        try:
+            with stage('detect'):
+                result = baidu_detect(image, image_type, options)
+        except ResilienceError as err:
+            return {'error_code': 'AIFACE_UNAVAILABLE', 'error_msg': str(err)}
+        return rescale_result(result, scale)
+
+    # the same bytes + options always get the same answer, and concurrent uploads share one call
+    key = detect_cache.make_key(stream['md5'], options)
+    result = detect_cache.get_or_call(key, detect, cacheable=detect_cacheable)
+    return save_result(stream['md5'], client_id, fields, result)
 
 # def cut_test(img):  # next step
 #     from django.core.files.uploadedfile import InMemoryUploadedFile
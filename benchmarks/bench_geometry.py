@@ -0,0 +1,100 @@
+"""
+scalar rotate_point vs the numpy landmark geometry, per face and per batch of faces
+
+    python -m benchmarks.bench_geometry [--faces 200] [--repeat 5] [--json]
+"""
+import argparse
+import json
+import timeit
+
+from benchmarks.synthetic import setup_django, tencent_result
+
+
+def scalar_extents(shape, angle, origin):
+    # what face_segments_save did before utils.geometry
+    from utils.imageutil import rotate_point
+
+    result = {}
+    parts = {
+        'eyebrow': shape['LeftEyeBrow'] + shape['RightEyeBrow'],
+        'nose': shape['Nose'],
+        'mouth': shape['Mouth'],
+    }
+    for name, points in parts.items():
+        rotated = [rotate_point(origin=origin, point=(point['X'], point['Y']), angle=angle) for point in points]
+        ys = [y for x, y in rotated]
+        result[name] = (min(ys), max(ys))
+    return result
+
+
+def vector_extents(shape, angle, origin):
+    from utils.geometry import segment_extents
+
+    boxes = segment_extents({
+        'eyebrow': shape['LeftEyeBrow'] + shape['RightEyeBrow'],
+        'nose': shape['Nose'],
+        'mouth': shape['Mouth'],
+    }, angle=angle, origin=origin)
+    return {name: (box[1], box[3]) for name, box in boxes.items()}
+
+
+def scalar_landmark72(landmark72, angle, origin):
+    from utils.imageutil import rotate_point
+
+    return [rotate_point(origin=origin, point=(point['x'], point['y']), angle=angle) for point in landmark72]
+
+
+def vector_landmark72(landmark72, angle, origin):
+    from utils.geometry import landmarks_to_array, rotate_points
+
+    return rotate_points(landmarks_to_array(landmark72), angle, origin)
+
+
+def run(faces, repeat):
+    from benchmarks.synthetic import baidu_landmark72
+
+    width, height = 4000, 3000
+    origin = (width / 2, height / 2)
+    data = tencent_result(width, height, faces=faces)
+    pairs = [(shape, info['FaceAttributesInfo']['Roll']) for info, shape in zip(data['FaceInfos'], data['FaceShapeSet'])]
+    landmarks = [baidu_landmark72(width, height, seed=i) for i in range(faces)]
+
+    # both versions have to agree before their timings mean anything
+    for shape, angle in pairs:
+        expected, actual = scalar_extents(shape, angle, origin), vector_extents(shape, angle, origin)
+        for name in expected:
+            assert all(abs(a - b) < 1e-6 for a, b in zip(expected[name], actual[name])), name
+
+    cases = {
+        'face_shape_scalar': lambda: [scalar_extents(shape, angle, origin) for shape, angle in pairs],
+        'face_shape_numpy': lambda: [vector_extents(shape, angle, origin) for shape, angle in pairs],
+        'landmark72_scalar': lambda: [scalar_landmark72(points, 15, origin) for points in landmarks],
+        'landmark72_numpy': lambda: [vector_landmark72(points, 15, origin) for points in landmarks],
+    }
+
+    results = []
+    for name, func in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        results.append({'case': name, 'faces': faces, 'seconds': best, 'us_per_face': best / faces * 1e6})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--faces', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print machine readable results')
+    args = parser.parse_args()
+
+    setup_django()
+    results = run(args.faces, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for row in results:
+        print(f"{row['case']:<20} {row['us_per_face']:>10.1f} us/face")
+
+
+if __name__ == '__main__':
+    main()
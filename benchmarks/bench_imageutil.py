@@ -0,0 +1,261 @@
+"""
+time and peak memory of every stage of utils.imageutil on synthetic images, offline
+
+    python -m benchmarks.bench_imageutil [--sizes 1 4 12 24] [--formats JPEG PNG] [--repeat 3]
+                                         [--stages decode full_rotate ...] [--compare-facecrop] [--json]
+
+every measurement runs in a forked child process:
+    seconds         best of --repeat runs
+    peak_py_kib     peak python allocations during one run (tracemalloc)
+    peak_rss_kib    peak resident memory above the level before the run, this is where the pillow buffers show up
+"""
+import argparse
+import gc
+import io
+import json
+import multiprocessing
+import pathlib
+import resource
+import tempfile
+import time
+import tracemalloc
+import types
+
+from benchmarks.bench_rotate import face_boxes
+from benchmarks.synthetic import image_bytes, setup_django, tencent_result
+
+STAGES = ('decode', 'rotate_point', 'rotate_polygon', 'segment_extents', 'full_rotate', 'rotated_crops', 'crop',
+          'save_segment', 'full_copy', 'calculate_file', 'face_segments_save')
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png'}
+
+
+def _status_kib(field):
+    # linux only, None anywhere else
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM, the kernel's peak rss counter
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kib(can_reset):
+    if can_reset:
+        peak = _status_kib('VmHWM')
+        if peak is not None:
+            return peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _child(prepare, repeat, conn):
+    try:
+        stage = prepare()
+        gc.collect()
+
+        # memory first, once the allocator holds on to freed buffers the rss stops moving
+        rss_before = _status_kib('VmRSS') or _peak_rss_kib(False)
+        can_reset = _reset_peak_rss()
+        tracemalloc.start()
+        stage()
+        _, py_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_peak = _peak_rss_kib(can_reset)
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            stage()
+            times.append(time.perf_counter() - start)
+
+        conn.send({'seconds': min(times), 'peak_py_kib': py_peak / 1024,
+                   'peak_rss_kib': max(0, rss_peak - rss_before)})
+    except Exception as err:
+        conn.send({'error': repr(err)})
+    finally:
+        conn.close()
+
+
+def measure(prepare, repeat):
+    """
+    :param prepare: builds the inputs in the child and returns the no-arg stage callable
+    """
+    ctx = multiprocessing.get_context('fork')
+    receiver, sender = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(prepare, repeat, sender))
+    proc.start()
+    sender.close()
+    result = receiver.recv()
+    proc.join()
+    return result
+
+
+class Inputs:
+    def __init__(self, megapixels, fmt, workdir):
+        self.raw, self.width, self.height = image_bytes(megapixels, fmt=fmt)
+        self.fmt = fmt
+        self.ext = EXTENSIONS[fmt]
+        self.workdir = workdir
+        self.data = tencent_result(self.width, self.height, centered=True)
+        self.face_info, self.face_shape = self.data['FaceInfos'][0], self.data['FaceShapeSet'][0]
+        self.boxes, self.angle, self.center = face_boxes(self.face_info, self.face_shape, self.width, self.height)
+        self.points = [(point['X'], point['Y']) for part in self.face_shape.values() for point in part]
+
+    def image(self):
+        from PIL import Image
+
+        img = Image.open(io.BytesIO(self.raw))
+        img.load()
+        return img
+
+    def upload(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        return SimpleUploadedFile(f'img.{self.ext}', self.raw)
+
+    def person_result(self, name):
+        return types.SimpleNamespace(user=types.SimpleNamespace(client_id='bench'),
+                                     face_img_name=f'{name}.{self.ext}')
+
+
+def stage_factory(name, inputs: Inputs):
+    from PIL import Image
+    from utils import imageutil
+    from utils.geometry import segment_extents
+
+    if name == 'decode':
+        return lambda: inputs.image
+
+    if name == 'rotate_point':
+        return lambda: lambda: [imageutil.rotate_point(point, inputs.angle, inputs.center) for point in inputs.points]
+
+    if name == 'rotate_polygon':
+        return lambda: lambda: imageutil.rotate_polygon(inputs.points, inputs.angle, inputs.center)
+
+    if name == 'segment_extents':
+        shape = inputs.face_shape
+        segments = {'eyebrow': shape['LeftEyeBrow'] + shape['RightEyeBrow'], 'nose': shape['Nose'],
+                    'mouth': shape['Mouth']}
+        return lambda: lambda: segment_extents(segments, inputs.angle, inputs.center)
+
+    if name == 'full_rotate':
+        def prepare():
+            img = inputs.image()
+            return lambda: img.rotate(angle=-inputs.angle, resample=Image.BICUBIC)
+        return prepare
+
+    if name == 'rotated_crops':
+        def prepare():
+            img = inputs.image()
+            return lambda: imageutil.rotated_crops(img, inputs.boxes, angle=inputs.angle, center=inputs.center)
+        return prepare
+
+    if name == 'crop':
+        def prepare():
+            rotated = inputs.image().rotate(angle=-inputs.angle, resample=Image.BICUBIC)
+            return lambda: [rotated.crop(box) for box in inputs.boxes]
+        return prepare
+
+    if name == 'save_segment':
+        def prepare():
+            crops = imageutil.rotated_crops(inputs.image(), inputs.boxes, angle=inputs.angle, center=inputs.center)
+            paths = [pathlib.Path(inputs.workdir, f'segment{i}.{inputs.ext}') for i in range(len(crops))]
+
+            def stage():
+                for crop, path in zip(crops, paths):
+                    crop.save(fp=path.as_posix())
+            return stage
+        return prepare
+
+    if name == 'full_copy':
+        def prepare():
+            upload = inputs.upload()
+            path = pathlib.Path(inputs.workdir, f'full.{inputs.ext}')
+
+            def stage():
+                with path.open('wb+') as des:
+                    for chunk in upload.chunks():
+                        des.write(chunk)
+            return stage
+        return prepare
+
+    if name == 'calculate_file':
+        def prepare():
+            upload = inputs.upload()
+            return lambda: imageutil.calculate_file(upload, hasher=('md5', 'base64'))
+        return prepare
+
+    if name == 'face_segments_save':
+        def prepare():
+            counter = iter(range(10 ** 6))
+            return lambda: imageutil.face_segments_save(json.loads(json.dumps(inputs.data)), inputs.upload(),
+                                                        inputs.person_result(f'fss{next(counter)}'))
+        return prepare
+
+    if name == 'facecrop':
+        def prepare():
+            from utils.imageutil_copy import FaceCrop
+
+            counter = iter(range(10 ** 6))
+            return lambda: FaceCrop(inputs.upload(), json.loads(json.dumps(inputs.data)),
+                                    inputs.person_result(f'fc{next(counter)}')).crop_and_save()
+        return prepare
+
+    raise ValueError(f'unknown stage {name}')
+
+
+def run(sizes, formats, stages, repeat):
+    with tempfile.TemporaryDirectory(prefix='aiface-bench-') as workdir:
+        for megapixels in sizes:
+            for fmt in formats:
+                inputs = Inputs(megapixels, fmt, workdir)
+                for stage in stages:
+                    row = measure(stage_factory(stage, inputs), repeat)
+                    row.update({'stage': stage, 'megapixels': megapixels, 'format': fmt,
+                                'width': inputs.width, 'height': inputs.height, 'bytes': len(inputs.raw)})
+                    yield row
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 12, 24], help='megapixels')
+    parser.add_argument('--formats', nargs='+', choices=sorted(EXTENSIONS), default=['JPEG', 'PNG'])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--compare-facecrop', action='store_true',
+                        help='also time FaceCrop.crop_and_save from utils/imageutil_copy.py')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print machine readable results')
+    args = parser.parse_args()
+
+    setup_django()
+    stages = list(args.stages) + (['facecrop'] if args.compare_facecrop else [])
+
+    results = []
+    for row in run(args.sizes, args.formats, stages, args.repeat):
+        results.append(row)
+        if args.json:
+            continue
+        if 'error' in row:
+            print(f"{row['megapixels']:>5} MP {row['format']:<4} {row['stage']:<20} {row['error']}")
+            continue
+        print(f"{row['megapixels']:>5} MP {row['format']:<4} {row['stage']:<20} "
+              f"{row['seconds'] * 1000:10.2f} ms  py {row['peak_py_kib'] / 1024:8.1f} MiB  "
+              f"rss {row['peak_rss_kib'] / 1024:8.1f} MiB")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
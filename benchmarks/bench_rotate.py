@@ -0,0 +1,112 @@
+"""
+full image rotate + crop vs imageutil.rotated_crops, by image size
+
+    python -m benchmarks.bench_rotate [--sizes 1 4 12 20] [--repeat 3] [--json]
+"""
+import argparse
+import io
+import json
+import time
+
+from benchmarks.synthetic import image_bytes, setup_django, tencent_face
+
+# mean absolute difference per channel allowed between the two pipelines, pixels next to the image border
+# are the only ones expected to differ
+TOLERANCE = 1.0
+
+
+def face_boxes(face_info, face_shape, width, height):
+    from utils.geometry import segment_extents
+
+    x0, y0 = width / 2, height / 2
+    angle = face_info['FaceAttributesInfo']['Roll']
+    left, top = face_info['X'], face_info['Y']
+    right, bottom = left + face_info['Width'], top + face_info['Height']
+
+    features = segment_extents({
+        'eyebrow': face_shape['LeftEyeBrow'] + face_shape['RightEyeBrow'],
+        'nose': face_shape['Nose'],
+        'mouth': face_shape['Mouth'],
+    }, angle=angle, origin=(x0, y0))
+    boxes = [(left, top, right, bottom)] + [(left, min_y, right, max_y) for _, min_y, _, max_y in features.values()]
+    return boxes, angle, (x0, y0)
+
+
+def full_rotate_crops(img, boxes, angle, center):
+    # what face_segments_save did before rotated_crops
+    from PIL import Image
+
+    rotated = img.rotate(angle=-angle, resample=Image.BICUBIC)
+    return [rotated.crop(box) for box in boxes]
+
+
+def mean_diff(a, b):
+    from PIL import ImageChops, ImageStat
+
+    if a.size != b.size:
+        return float('inf')
+    return max(ImageStat.Stat(ImageChops.difference(a, b)).mean)
+
+
+def timed(func, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run(sizes, repeat):
+    from PIL import Image
+    from utils.imageutil import rotated_crops
+
+    results = []
+    for megapixels in sizes:
+        raw, width, height = image_bytes(megapixels)
+        img = Image.open(io.BytesIO(raw))
+        img.load()
+
+        face_info, face_shape = tencent_face(width, height, roll=17.5)
+        boxes, angle, center = face_boxes(face_info, face_shape, width, height)
+
+        full_seconds, expected = timed(lambda: full_rotate_crops(img, boxes, angle, center), repeat)
+        region_seconds, actual = timed(lambda: rotated_crops(img, boxes, angle=angle, center=center), repeat)
+
+        diff = max(mean_diff(a, b) for a, b in zip(expected, actual))
+        assert diff <= TOLERANCE, f'{megapixels} MP: crops differ by {diff}'
+
+        results.append({
+            'megapixels': megapixels,
+            'width': width,
+            'height': height,
+            'full_rotate_seconds': full_seconds,
+            'region_rotate_seconds': region_seconds,
+            'speedup': full_seconds / region_seconds,
+            'max_mean_diff': diff,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 12, 20], help='megapixels')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print machine readable results')
+    args = parser.parse_args()
+
+    setup_django()
+    results = run(args.sizes, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for row in results:
+        print(f"{row['megapixels']:>5} MP  full {row['full_rotate_seconds'] * 1000:8.1f} ms  "
+              f"region {row['region_rotate_seconds'] * 1000:8.1f} ms  x{row['speedup']:.1f}  "
+              f"diff {row['max_mean_diff']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
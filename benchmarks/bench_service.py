@@ -0,0 +1,192 @@
+"""
+throughput and latency of views.index, imageutil.face_api and imageutil.face_segments_save against the local
+fake face api, at a set of concurrency levels
+
+    python -m benchmarks.bench_service --concurrency 1 4 16 --requests 200 --latency-ms 120 --output bench.json
+
+the output is a json document, one entry per scenario and concurrency level
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakeapi import FakeFaceAPI, load_fixture, patch_clients
+from benchmarks.synthetic import image_bytes, setup_django
+
+SCENARIOS = ('index', 'face_api', 'segments')
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def unique_jpeg(raw, n):
+    # decoders ignore bytes after the EOI marker, a counter there defeats the detect cache
+    return raw + n.to_bytes(8, 'big')
+
+
+class Scenario:
+    def __init__(self, name, width, height):
+        self.name = name
+        self.raw, _, _ = image_bytes(width * height / 1e6)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def next_bytes(self):
+        with self.lock:
+            self.counter += 1
+            return unique_jpeg(self.raw, self.counter)
+
+
+def make_call(name, scenario: Scenario):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import RequestFactory
+
+    from utils import imageutil
+
+    factory = RequestFactory()
+
+    if name == 'index':
+        from apps.aiface import views
+
+        def call():
+            img = SimpleUploadedFile('img.jpg', scenario.next_bytes(), content_type='image/jpeg')
+            response = views.index(factory.post('/', {'img': img}))
+            result = json.loads(response.content)
+            return result.get('error_code') == 0
+
+        return call
+
+    if name == 'face_api':
+        import base64
+
+        def call():
+            _, status_code = imageutil.face_api(base64.b64encode(scenario.next_bytes()).decode())
+            return status_code == 200
+
+        return call
+
+    if name == 'segments':
+        data = load_fixture('tencent_detect_face')
+        data['FaceShapeSet'] = load_fixture('tencent_analyze_face')['FaceShapeSet']
+
+        def call():
+            raw = scenario.next_bytes()
+            person_result = types.SimpleNamespace(user=types.SimpleNamespace(client_id='bench'),
+                                                  face_img_name=f'{uuid.uuid4().hex}.jpg')
+            imageutil.face_segments_save(json.loads(json.dumps(data)), SimpleUploadedFile('img.jpg', raw),
+                                         person_result)
+            return True
+
+        return call
+
+    raise ValueError(f'unknown scenario {name}')
+
+
+def run_level(call, concurrency, requests):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one():
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = call()
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            errors += not ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(requests):
+            executor.submit(one)
+    wall = time.perf_counter() - start
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'seconds': wall,
+        'throughput_rps': requests / wall,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=100, help='requests per concurrency level')
+    parser.add_argument('--latency-ms', type=float, default=100, help='median fake api latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.3)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--output', help='write the json results here instead of stdout')
+    args = parser.parse_args()
+
+    setup_django()
+
+    # the fixtures describe a face in an image of this size
+    fixture = load_fixture('tencent_detect_face')
+    width, height = fixture['ImageWidth'], fixture['ImageHeight']
+
+    results = []
+    with FakeFaceAPI(latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                     error_rate=args.error_rate, seed=0) as api, patch_clients(api):
+        for name in args.scenarios:
+            scenario = Scenario(name, width, height)
+            call = make_call(name, scenario)
+            call()  # warm up clients, pools and imports
+            for concurrency in args.concurrency:
+                row = run_level(call, concurrency, args.requests)
+                row['scenario'] = name
+                results.append(row)
+                print(f"{name:<10} c={concurrency:<4} {row['throughput_rps']:8.1f} req/s  "
+                      f"p50 {row['p50_ms']:7.1f}  p95 {row['p95_ms']:7.1f}  p99 {row['p99_ms']:7.1f} ms  "
+                      f"errors {row['errors']}", file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'fake_api': {'latency_ms': args.latency_ms, 'latency_sigma': args.latency_sigma,
+                     'error_rate': args.error_rate},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+local stand-in for the baidu and tencent face apis, replays the responses in benchmarks/fixtures
+
+    python -m benchmarks.fakeapi --port 8901 --latency-ms 120 --latency-sigma 0.4 --error-rate 0.02
+
+baidu:   GET|POST /oauth/2.0/token, POST /rest/2.0/face/v3/detect
+tencent: POST / with the X-TC-Action header set to DetectFace or AnalyzeFace
+"""
+import argparse
+import json
+import math
+import pathlib
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+FIXTURE_DIR = pathlib.Path(__file__).resolve().parent.joinpath('fixtures')
+
+BAIDU_ERROR = {'error_code': 18, 'error_msg': 'Open api qps request limit reached'}
+TENCENT_ERROR = {'Code': 'RequestLimitExceeded', 'Message': 'Your current request times equals to `20` in a second'}
+
+
+def load_fixture(name):
+    with FIXTURE_DIR.joinpath(f'{name}.json').open() as f:
+        return json.load(f)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeFaceAPI:
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, latency_sigma=0, error_rate=0, fixtures=None, seed=None,
+                 latency_script=(), error_script=()):
+        """
+        :param latency_ms:      median latency added to every api call (not to the token call)
+        :param latency_sigma:   sigma of the lognormal latency distribution, 0 for a fixed latency
+        :param error_rate:      share of api calls answered with a qps limit error
+        :param latency_script:  latency in ms of the first api calls, one per call, before latency_ms applies
+        :param error_script:    True / False for the first api calls, before error_rate applies
+        :param fixtures:        {'baidu_detect': ..., 'tencent_detect_face': ..., 'tencent_analyze_face': ...},
+                                the files in benchmarks/fixtures by default
+        """
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.fixtures = fixtures or {name: load_fixture(name) for name in
+                                     ('baidu_detect', 'tencent_detect_face', 'tencent_analyze_face')}
+        self.latency_script = deque(latency_script)
+        self.error_script = deque(error_script)
+        self.calls = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f'{host}:{port}'
+
+    @property
+    def url(self):
+        return f'http://{self.address}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fakeapi', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _delay_and_fail(self, api):
+        with self._lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+            delay = self.latency_ms
+            if self.latency_script:
+                delay = self.latency_script.popleft()
+            elif delay and self.latency_sigma:
+                delay = self._random.lognormvariate(math.log(delay), self.latency_sigma)
+            fail = self._random.random() < self.error_rate
+            if self.error_script:
+                fail = self.error_script.popleft()
+        if delay:
+            time.sleep(delay / 1000)
+        return fail
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in two writes, with nagle the body waits for the client's delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, data, status=200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length)
+
+            def do_GET(self):
+                if self.path.startswith('/oauth/2.0/token'):
+                    return self._send(self.baidu_token())
+                self._send({'error_code': 3, 'error_msg': 'Unsupported openapi method'}, status=404)
+
+            def do_POST(self):
+                self._read_body()
+
+                if self.path.startswith('/oauth/2.0/token'):
+                    return self._send(self.baidu_token())
+
+                if self.path.startswith('/rest/2.0/face/v3/detect'):
+                    fail = api._delay_and_fail('detect')
+                    return self._send(BAIDU_ERROR if fail else api.fixtures['baidu_detect'])
+
+                action = self.headers.get('X-TC-Action')
+                fixture = {'DetectFace': 'tencent_detect_face', 'AnalyzeFace': 'tencent_analyze_face'}.get(action)
+                if fixture is None:
+                    return self._send({'Response': {'Error': {'Code': 'InvalidAction', 'Message': str(action)},
+                                                    'RequestId': str(uuid.uuid4())}})
+
+                fail = api._delay_and_fail(action)
+                response = {'Error': TENCENT_ERROR} if fail else dict(api.fixtures[fixture])
+                response['RequestId'] = str(uuid.uuid4())
+                self._send({'Response': response})
+
+            @staticmethod
+            def baidu_token():
+                return {'access_token': f'fake.{uuid.uuid4().hex}', 'expires_in': 2592000,
+                        'scope': 'public brain_all_scope vis-faceverify_faceverify_h5-face-liveness',
+                        'session_key': 'fake', 'session_secret': 'fake'}
+
+        return Handler
+
+
+@contextmanager
+def patch_clients(api: FakeFaceAPI):
+    """
+    point AipFace and the tencent IaiClient of utils.imageutil at the fake api for the duration of the block
+    """
+    from aip.base import AipBase
+    from aip.face import AipFace
+    from django.test import override_settings
+
+    urls = {
+        (AipBase, '_AipBase__accessTokenUrl'): f'{api.url}/oauth/2.0/token',
+        (AipFace, '_AipFace__detectUrl'): f'{api.url}/rest/2.0/face/v3/detect',
+    }
+    originals = {key: getattr(*key) for key in urls}
+    for (cls, name), url in urls.items():
+        setattr(cls, name, url)
+
+    try:
+        with override_settings(QCLOUD_PROTOCOL='http', QCLOUD_ENDPOINT=api.address):
+            yield api
+    finally:
+        for (cls, name), url in originals.items():
+            setattr(cls, name, url)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--latency-sigma', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    api = FakeFaceAPI(host=args.host, port=args.port, latency_ms=args.latency_ms,
+                      latency_sigma=args.latency_sigma, error_rate=args.error_rate)
+    print(f'fake face api on {api.url}')
+    try:
+        api._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""
+settings for running the benchmarks offline, no cloud credentials needed
+"""
+import os
+import tempfile
+
+from config.settings import *  # noqa
+
+APP_ID = 'benchmark'
+API_KEY = 'benchmark'
+SECRET = 'benchmark'
+
+QCLOUD_SID = 'benchmark'
+QCLOUD_SKEY = 'benchmark'
+
+PRO_DIR = 'facial'
+UPLOAD_DIR = tempfile.mkdtemp(prefix='aiface-bench-')
+
+ALLOWED_HOSTS = ['*']
+
+# a fresh database next to the uploads, setup_django migrates it
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(UPLOAD_DIR, 'benchmark.sqlite3'),
+    }
+}
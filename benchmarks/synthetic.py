@@ -0,0 +1,91 @@
+import io
+import os
+import random
+
+import django
+
+# points per part of a tencent FaceShapeSet
+FACE_SHAPE_SIZES = {
+    'FaceProfile': 21,
+    'LeftEye': 8,
+    'RightEye': 8,
+    'LeftEyeBrow': 8,
+    'RightEyeBrow': 8,
+    'Mouth': 22,
+    'Nose': 13,
+    'LeftPupil': 1,
+    'RightPupil': 1,
+}
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    django.setup()
+
+    if os.environ['DJANGO_SETTINGS_MODULE'] == 'benchmarks.settings':
+        from django.core.management import call_command
+
+        call_command('migrate', verbosity=0)
+
+
+def tencent_face(width, height, seed=0, roll=None, centered=False):
+    """
+    one fake face somewhere in a width x height image
+    :param centered:    put the face in the middle of the image, face_segments_save can crop that one for any roll
+    :return:            (FaceInfo, FaceShape) like the ones in DetectFace / AnalyzeFace responses
+    """
+    rand = random.Random(seed)
+    face_w = face_h = min(width, height) // 3
+    if centered:
+        left, top = (width - face_w) // 2, (height - face_h) // 2
+    else:
+        left = rand.randint(0, width - face_w)
+        top = rand.randint(0, height - face_h)
+
+    face_info = {
+        'X': left, 'Y': top, 'Width': face_w, 'Height': face_h,
+        'FaceAttributesInfo': {'Roll': rand.uniform(-30, 30) if roll is None else roll},
+    }
+    face_shape = {
+        part: [{'X': rand.randint(left, left + face_w), 'Y': rand.randint(top, top + face_h)} for _ in range(n)]
+        for part, n in FACE_SHAPE_SIZES.items()
+    }
+    return face_info, face_shape
+
+
+def tencent_result(width, height, faces=1, seed=0, centered=False):
+    """
+    merged face_api result with `faces` faces
+    """
+    pairs = [tencent_face(width, height, seed=seed + i, centered=centered) for i in range(faces)]
+    return {
+        'ImageWidth': width,
+        'ImageHeight': height,
+        'FaceInfos': [info for info, _ in pairs],
+        'FaceShapeSet': [shape for _, shape in pairs],
+    }
+
+
+def baidu_landmark72(width, height, seed=0):
+    rand = random.Random(seed)
+    return [{'x': rand.uniform(0, width), 'y': rand.uniform(0, height)} for _ in range(72)]
+
+
+def image_bytes(megapixels, fmt='JPEG', seed=0):
+    """
+    a noisy image, so that the encoders can't cheat on flat colors
+    :return: (bytes, width, height)
+    """
+    from PIL import Image
+
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+
+    # upscaled random noise is cheap to make and still compresses like a photo
+    rand = random.Random(seed)
+    small = Image.frombytes('RGB', (64, 48), bytes(rand.getrandbits(8) for _ in range(64 * 48 * 3)))
+    img = small.resize((width, height), Image.BICUBIC)
+
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue(), width, height
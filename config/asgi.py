@@ -0,0 +1,20 @@
+"""
+ASGI config for config project.
+
+POST / is served on the event loop by apps.aiface.asgi, the rest of the site runs as WSGI in a thread pool.
+
+    uvicorn config.asgi:application
+"""
+
+import os
+
+from asgiref.wsgi import WsgiToAsgi
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.dev.settings')
+
+wsgi_application = get_wsgi_application()
+
+from apps.aiface.asgi import AsyncDetectApplication  # noqa: E402, needs the apps loaded
+
+application = AsyncDetectApplication(WsgiToAsgi(wsgi_application))
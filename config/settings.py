@@ -37,9 +37,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'apps.aiface.apps.AifaceConfig',
 ]
 
 MIDDLEWARE = [
+    'apps.aiface.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -118,3 +120,147 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# AiFace
+# Baidu AipFace client pool, see apps/aiface/clients.py
+
+AIFACE_POOL_SIZE = 8
+
+AIFACE_POOL_IDLE_TIMEOUT = 60  # seconds
+
+# detect result cache, see apps/aiface/cache.py
+
+AIFACE_CACHE_ENTRIES = 1024
+
+AIFACE_CACHE_TTL = 24 * 60 * 60  # seconds
+
+AIFACE_CACHE_DIR = None  # e.g. os.path.join(BASE_DIR, 'cache', 'detect') to enable the on-disk tier
+
+AIFACE_CACHE_DIR_MAX_BYTES = 256 * 1024 * 1024
+
+# Tencent iai calls made by utils.imageutil.face_api
+
+QCLOUD_MAX_WORKERS = 8
+
+AIFACE_MAX_FACES = 5  # DetectFace MaxFaceNum, face_segments_save crops every one of them
+
+QCLOUD_PROTOCOL = 'https'
+
+QCLOUD_ENDPOINT = None  # None for the sdk default, e.g. 'localhost:8901' for benchmarks/fakeapi.py
+
+# threads encoding and writing the crops of utils.imageutil.face_segments_save
+
+SEGMENT_SAVE_WORKERS = 4
+
+# px on the longest side of the smallest face crop, large jpegs then decode at 1/2, 1/4 or 1/8 scale
+# None keeps the crops at the resolution of the upload
+AIFACE_SEGMENT_SIZE = None
+
+# shrink uploads before they are sent to baidu, see apps/aiface/preprocess.py
+
+AIFACE_PREPROCESS = False
+
+AIFACE_PREPROCESS_MAX_EDGE = 1280  # px, longest edge
+
+AIFACE_PREPROCESS_MAX_BYTES = 1024 * 1024  # jpeg bytes, before base64
+
+# apps.aiface.views.batch
+
+AIFACE_BATCH_MAX_FILES = 50
+
+AIFACE_BATCH_CONCURRENCY = 4  # detect calls in flight per batch
+
+# upload limits, checked while the upload is still coming in, see apps/aiface/uploadhandler.py
+
+AIFACE_UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+
+AIFACE_UPLOAD_MAX_PIXELS = 40 * 1000 * 1000
+
+# detect results written to the database, see apps/aiface/store.py
+
+AIFACE_STORE_RESULTS = True
+
+AIFACE_STORE_BATCH_SIZE = 100
+
+AIFACE_STORE_FLUSH_INTERVAL = 1.0  # seconds a partial batch waits for more results
+
+AIFACE_RESULTS_MAX_LIMIT = 100
+
+# landmark72 similarity index over the stored faces, see apps/aiface/similarity.py
+
+AIFACE_INDEX_DIR = None  # e.g. os.path.join(BASE_DIR, 'cache', 'faceindex') to keep the index between restarts
+
+AIFACE_INDEX_SAVE_INTERVAL = 60  # seconds between saves while faces keep coming in
+
+# upload -> face_api + face_segments_save job queue, see apps/aiface/jobs.py and manage.py aiface_worker
+
+AIFACE_JOB_DIR = None  # where queued uploads wait, UPLOAD_DIR/jobs by default
+
+AIFACE_JOB_MAX_DEPTH = 1000  # queued + running jobs before submit answers 503
+
+AIFACE_JOB_MAX_ATTEMPTS = 3
+
+AIFACE_JOB_VISIBILITY_TIMEOUT = 300  # seconds a worker holds a job before another one may take it over
+
+AIFACE_JOB_RETRY_DELAY = 5  # seconds before the first retry, doubled for every further one
+
+AIFACE_JOB_WORKERS = 2
+
+AIFACE_JOB_POLL_INTERVAL = 1.0  # seconds an idle worker waits before looking for jobs again
+
+# content addressed storage of the full images and segments, see utils/blobstore.py
+
+AIFACE_BLOB_DIR = None  # UPLOAD_DIR/blobs by default, keep it on the same file system as UPLOAD_DIR for hard links
+
+# deadline, retries, hedging and circuit breaking of the baidu / tencent calls, see utils/resilience.py
+
+AIFACE_API_DEADLINE = 10  # seconds for a whole call, retries and hedges included
+
+AIFACE_API_CONNECT_TIMEOUT = 3
+
+AIFACE_API_MAX_ATTEMPTS = 3
+
+AIFACE_API_BACKOFF = 0.1  # seconds, the n-th retry waits a random time up to AIFACE_API_BACKOFF * 2 ** (n - 1)
+
+AIFACE_API_BACKOFF_MAX = 2
+
+AIFACE_API_HEDGE_PERCENTILE = 95  # send a second copy once a call is slower than this, None to disable
+
+AIFACE_API_HEDGE_MIN_SAMPLES = 20
+
+AIFACE_API_WORKERS = 16  # threads per api for the calls and their hedged copies
+
+AIFACE_BREAKER_FAILURES = 5  # failures in a row before calls fail fast
+
+AIFACE_BREAKER_RESET_TIMEOUT = 30  # seconds before a probe call is let through again
+
+# routing between the face providers of the detect/ endpoint, see apps/aiface/providers.py
+
+AIFACE_PROVIDERS = ('baidu', 'tencent')
+
+AIFACE_PROVIDER_WEIGHTS = None  # e.g. {'baidu': 3, 'tencent': 1} to split by weight instead of by latency
+
+AIFACE_PROVIDER_EWMA_ALPHA = 0.2  # weight of the newest sample in the latency / error averages
+
+AIFACE_PROVIDER_MAX_ERROR_RATE = 0.5  # above this a provider is only tried after the healthy ones
+
+AIFACE_PROVIDER_PROBE_INTERVAL = 30  # seconds after its last failure an unhealthy provider is tried first again
+
+# the asgi entry point, see config/asgi.py and apps/aiface/asgi.py
+
+AIFACE_ASGI_MAX_INFLIGHT = 256  # detect calls on the wire at once per process, the rest wait their turn
+
+# the baidu access token shared by all the processes on the host, see utils/tokencache.py
+
+AIFACE_TOKEN_CACHE_PATH = None  # UPLOAD_DIR/baidu_token.json by default
+
+AIFACE_TOKEN_REFRESH_MARGIN = 24 * 3600  # seconds before expiry the background refresh fetches a new token
+
+AIFACE_TOKEN_RETRY_INTERVAL = 60  # seconds between refresh attempts after a failure
+
+# worker boot, see utils/lazy.py and the aiface_startup command
+
+AIFACE_PRELOAD = False  # import the vendor sdks and the imaging code at startup, for gunicorn --preload
+
+AIFACE_STARTUP_BUDGET_MS = 2000  # max time to the first request of a fresh worker, checked by aiface_startup
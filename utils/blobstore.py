@@ -0,0 +1,139 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+
+class BlobStore:
+    """
+    files addressed by the sha256 of their content, written once
+
+        root/9f/86/9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08.jpg
+
+    a blob is written to a temp file in its own directory and linked into place, so a reader never sees
+    half a file and two writers of the same bytes don't step on each other
+
+    blobs are read-only, every path linked to one by link shares its bytes, see link
+    """
+
+    MODE = 0o444
+
+    def __init__(self, root, shard_depth=2, shard_width=2):
+        """
+        :param shard_depth: directory levels above a blob
+        :param shard_width: hex characters of the digest per level, 2 x 2 gives 65536 directories
+        """
+        self.root = pathlib.Path(root)
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        self._made_dirs = set()
+        self._lock = threading.Lock()
+
+    def relative_path(self, digest, ext='') -> pathlib.Path:
+        """
+        :param ext: with the dot, '.jpg'
+        """
+        width = self.shard_width
+        shards = [digest[i * width:(i + 1) * width] for i in range(self.shard_depth)]
+        return pathlib.Path(*shards, digest + ext)
+
+    def path(self, digest, ext='') -> pathlib.Path:
+        return self.root / self.relative_path(digest, ext)
+
+    def exists(self, digest, ext='') -> bool:
+        return self.path(digest, ext).exists()
+
+    def _mkdir(self, path):
+        if path in self._made_dirs:
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._made_dirs.add(path)
+
+    def put_bytes(self, data: bytes, ext='') -> tuple:
+        """
+        :return: (digest, path, written), written is False when the blob was already there
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest, ext)
+        if path.exists():
+            return digest, path, False
+        return digest, path, self._commit(path, lambda f: f.write(data))
+
+    def put_chunks(self, chunks, ext='') -> tuple:
+        """
+        stream an upload in, the digest is only known at the end so the temp file lands in the root
+        :param chunks:  iterable of bytes, e.g. UploadedFile.chunks()
+        :return:        (digest, path, written)
+        """
+        self._mkdir(self.root)
+        hasher = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+
+            digest = hasher.hexdigest()
+            path = self.path(digest, ext)
+            written = False
+            if not path.exists():
+                self._mkdir(path.parent)
+                os.chmod(tmp, self.MODE)
+                written = self._link_new(tmp, path)
+            return digest, path, written
+        finally:
+            os.unlink(tmp)
+
+    def _commit(self, path, write) -> bool:
+        self._mkdir(path.parent)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.chmod(tmp, self.MODE)
+            return self._link_new(tmp, path)
+        finally:
+            os.unlink(tmp)
+
+    @staticmethod
+    def _link_new(tmp, path) -> bool:
+        # unlike a rename, link refuses to replace a blob someone else just finished
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            return False
+        return True
+
+    def link(self, path, target):
+        """
+        make target, an old style path like UPLOAD_DIR/facial/{client_id}/{segment}/{name}, point at the blob
+        a hard link costs no space, a copy is the fallback where links are not possible
+
+        target is then the blob itself and must never be written in place, that would change every path
+        linked to it. write a temp file next to it and os.replace it over target, or link it to another blob
+        """
+        target = pathlib.Path(target)
+        self._mkdir(target.parent)
+        try:
+            if os.path.samefile(path, target):
+                return
+        except FileNotFoundError:
+            pass
+
+        fd, tmp = tempfile.mkstemp(dir=target.parent, suffix='.tmp')
+        os.close(fd)
+        os.unlink(tmp)
+        try:
+            try:
+                os.link(path, tmp)
+            except OSError:  # another file system, or links not supported
+                shutil.copyfile(path, tmp)
+            os.replace(tmp, target)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
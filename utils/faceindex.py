@@ -0,0 +1,220 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+from utils.geometry import landmarks_to_array, rotate_points
+from utils.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+METRICS = ('cosine', 'l2')
+
+
+def face_descriptor(points, angle=0) -> 'np.ndarray':
+    """
+    fixed length geometry of a face, the same face gives (nearly) the same vector wherever it is in the image,
+    whatever its size and in-plane rotation
+    :param points:  landmarks in any form landmarks_to_array takes, or an (n, 2) array
+    :param angle:   degrees passed to rotate_points to bring the face upright
+    :return:        float32 array of 2 * len(points), centered on the centroid and scaled to unit rms distance
+    """
+    if not isinstance(points, np.ndarray):
+        points = landmarks_to_array(points)
+    centroid = points.mean(axis=0)
+    aligned = rotate_points(points, angle, origin=centroid) - centroid
+
+    scale = np.sqrt((aligned ** 2).sum(axis=1).mean())
+    if scale == 0:
+        raise ValueError('landmarks collapse to a single point')
+    return (aligned / scale).ravel().astype(np.float32)
+
+
+def baidu_descriptor(face: dict, kind='landmark72') -> 'np.ndarray':
+    """
+    :param face:    one item of the detect face_list, location.rotation is clockwise
+    """
+    return face_descriptor(face[kind], angle=-face['location']['rotation'])
+
+
+def tencent_descriptor(face_info: dict, face_shape: dict) -> 'np.ndarray':
+    """
+    :param face_info:   item of DetectFace FaceInfos, face_segments_save rotates by the same Roll
+    :param face_shape:  item of AnalyzeFace FaceShapeSet, the parts are taken in name order
+    """
+    points = [point for name in sorted(face_shape) for point in face_shape[name]]
+    return face_descriptor(points, angle=face_info['FaceAttributesInfo']['Roll'])
+
+
+class FaceIndex:
+    """
+    brute force in-process vector index, one row per face id
+
+    rows live in a preallocated array that doubles when full, remove moves the last row into the hole,
+    so the live rows are always [:len(index)] and a query is one matrix-vector product
+    """
+
+    def __init__(self, dim, capacity=1024):
+        self.dim = dim
+        self._vectors = np.empty((capacity, dim), dtype=np.float32)
+        self._norms = np.empty(capacity, dtype=np.float32)
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._rows = {}  # face id: row
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, face_id):
+        return face_id in self._rows
+
+    def _reserve(self, count):
+        # arrays loaded with mmap are read only, the first write copies them into memory
+        capacity = len(self._ids)
+        if count <= capacity and self._vectors.flags.writeable and self._norms.flags.writeable:
+            return
+        capacity = max(capacity, 1)
+        while capacity < count:
+            capacity *= 2
+
+        for name in ('_vectors', '_norms', '_ids'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def add(self, face_id, vector):
+        """
+        add or replace the vector of face_id
+        """
+        self.add_many([face_id], [vector])
+
+    def add_many(self, face_ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            self._reserve(self._size + len(vectors))
+            for face_id, vector in zip(face_ids, vectors):
+                row = self._rows.get(face_id)
+                if row is None:
+                    row = self._rows[face_id] = self._size
+                    self._size += 1
+                self._vectors[row] = vector
+                self._norms[row] = np.linalg.norm(vector)
+                self._ids[row] = face_id
+
+    def remove(self, face_id) -> bool:
+        with self._lock:
+            row = self._rows.pop(face_id, None)
+            if row is None:
+                return False
+
+            self._reserve(self._size)
+            last = self._size - 1
+            if row != last:
+                self._vectors[row] = self._vectors[last]
+                self._norms[row] = self._norms[last]
+                self._ids[row] = self._ids[last]
+                self._rows[int(self._ids[row])] = row
+            self._size = last
+            return True
+
+    def ids(self) -> list:
+        with self._lock:
+            return self._ids[:self._size].tolist()
+
+    def vector(self, face_id) -> 'np.ndarray':
+        with self._lock:
+            return np.array(self._vectors[self._rows[face_id]])
+
+    def search(self, vector, k=10, metric='cosine', exclude=()) -> list:
+        """
+        :param metric:  cosine, higher is closer / l2, lower is closer
+        :param exclude: face ids left out of the result, usually the query face itself
+        :return:        [(face_id, score), ...] best first
+        """
+        if metric not in METRICS:
+            raise ValueError(f'metric must be one of {METRICS}')
+        query = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+
+        with self._lock:
+            size = self._size
+            if size == 0 or k <= 0:
+                return []
+            # copies, a remove after the lock is released moves rows around
+            dots = self._vectors[:size] @ query
+            norms = self._norms[:size].copy()
+            ids = self._ids[:size].copy()
+
+        if metric == 'cosine':
+            scores = dots / np.maximum(norms * np.linalg.norm(query), 1e-12)
+            order = -scores
+        else:
+            scores = np.sqrt(np.maximum(norms ** 2 - 2 * dots + query @ query, 0))
+            order = scores
+
+        count = min(k + len(exclude), size)
+        top = np.argpartition(order, count - 1)[:count] if count < size else np.arange(size)
+        top = top[np.argsort(order[top], kind='stable')]
+
+        exclude = set(exclude)
+        return [(int(ids[row]), float(scores[row])) for row in top if int(ids[row]) not in exclude][:k]
+
+    def save(self, directory):
+        """
+        one .npy per array in a new version directory, published all at once by swapping the `current` symlink,
+        so a reader never mixes the arrays of two saves. the version before stays for readers still opening it
+        """
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            arrays = {name: np.array(getattr(self, f'_{name}')[:self._size])
+                      for name in ('vectors', 'norms', 'ids')}
+
+        version = pathlib.Path(tempfile.mkdtemp(dir=directory, prefix='version-'))
+        link = directory / f'{version.name}.link'
+        try:
+            for name, array in arrays.items():
+                np.save(version / f'{name}.npy', array)
+            os.symlink(version.name, link)
+            previous = self._current(directory)
+            os.replace(link, directory / 'current')
+        except BaseException:
+            shutil.rmtree(version, ignore_errors=True)
+            if os.path.lexists(link):
+                os.unlink(link)
+            raise
+
+        for old in directory.glob('version-*'):
+            if old.name not in (version.name, previous.name):
+                shutil.rmtree(old, ignore_errors=True)
+
+    @staticmethod
+    def _current(directory) -> pathlib.Path:
+        current = directory / 'current'
+        return directory / os.readlink(current) if os.path.islink(current) else directory
+
+    @staticmethod
+    def saved(directory) -> bool:
+        return os.path.exists(FaceIndex._current(pathlib.Path(directory)) / 'ids.npy')
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        :param mmap:    map the files instead of reading them, only the pages a query touches get loaded
+        """
+        # resolved once, a save swapping the link meanwhile doesn't mix two versions
+        directory = cls._current(pathlib.Path(directory))
+        mode = 'r' if mmap else None
+        vectors = np.load(directory / 'vectors.npy', mmap_mode=mode)
+        norms = np.load(directory / 'norms.npy', mmap_mode=mode)
+        ids = np.load(directory / 'ids.npy')
+        if not (len(vectors) == len(norms) == len(ids)):
+            raise ValueError(f'{directory} holds arrays of different lengths')
+
+        index = cls(vectors.shape[1], capacity=1)
+        index._vectors, index._norms, index._ids = vectors, norms, ids
+        index._rows = {int(face_id): row for row, face_id in enumerate(ids)}
+        index._size = len(ids)
+        return index
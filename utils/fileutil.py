@@ -0,0 +1,46 @@
+import base64
+import hashlib
+
+# a multiple of 3 so that every chunk but the last one encodes to base64 without padding
+CHUNK_SIZE = 3 * 64 * 1024
+
+
+def stream_file(file_, hasher=('md5', 'base64'), chunk_size=CHUNK_SIZE) -> dict:
+    """
+    one pass over file_.chunks(), the file is never joined into a single bytes object
+
+    the base64 str every caller hands to the sdks is still one join of the encoded pieces, so for the moment
+    of the join the pieces and the result are both alive: about 2.7x the file size at the peak, 1.33x after
+    :param file_:       django File / UploadedFile
+    :param hasher:      any of 'base64' and the hashlib algorithm names, e.g. ('md5', 'base64')
+    :param chunk_size:  bytes read at a time
+    :return:            {'base64': str, 'md5': hexdigest, ...}, '' for anything not asked for
+    """
+    hashes = {name: hashlib.new(name) for name in hasher if name != 'base64'}
+    pieces = [] if 'base64' in hasher else None
+    tail = b''
+
+    for chunk in file_.chunks(chunk_size):
+        for h in hashes.values():
+            h.update(chunk)
+
+        if pieces is None:
+            continue
+
+        # carry the bytes that don't fill a 3-byte group over to the next chunk
+        if tail:
+            chunk = tail + chunk
+        cut = len(chunk) - len(chunk) % 3
+        view = memoryview(chunk)
+        pieces.append(base64.b64encode(view[:cut]).decode('ascii'))
+        tail = bytes(view[cut:])
+
+    result = {'base64': '', 'md5': ''}
+    result.update({name: h.hexdigest() for name, h in hashes.items()})
+
+    if pieces is not None:
+        if tail:
+            pieces.append(base64.b64encode(tail).decode('ascii'))
+        result['base64'] = ''.join(pieces)
+
+    return result
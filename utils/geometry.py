@@ -0,0 +1,79 @@
+import math
+from itertools import chain
+from operator import itemgetter
+
+from utils.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+
+def landmarks_to_array(points) -> 'np.ndarray':
+    """
+    :param points:  tencent [{'X': x, 'Y': y}, ...], baidu landmark72 [{'x': x, 'y': y}, ...] or [(x, y), ...]
+    :return:        float array with shape (n, 2)
+    """
+    count = 2 * len(points)
+    if count == 0:
+        return np.empty((0, 2))
+
+    if isinstance(points[0], dict):
+        getter = itemgetter('X', 'Y') if 'X' in points[0] else itemgetter('x', 'y')
+        points = map(getter, points)
+
+    # fromiter over the flat coordinates skips building a list of tuples first
+    flat = np.fromiter(chain.from_iterable(points), dtype=np.float64, count=count)
+    return flat.reshape(-1, 2)
+
+
+def rotation_matrix(angle) -> 'np.ndarray':
+    """
+    same direction as imageutil.rotate_point
+    :param angle:   degrees
+    """
+    angle_rad = math.radians(angle % 360)
+    cos, sin = math.cos(angle_rad), math.sin(angle_rad)
+    return np.array([[cos, -sin],
+                     [sin, cos]])
+
+
+def rotate_points(points, angle, origin=(0, 0), matrix=None) -> 'np.ndarray':
+    """
+    :param points:  array from landmarks_to_array
+    :param matrix:  rotation_matrix(angle), pass it in to reuse it for every segment of a face
+    :return:        rotated array with the same shape
+    """
+    if matrix is None:
+        matrix = rotation_matrix(angle)
+    origin = np.asarray(origin, dtype=np.float64)
+    return (points - origin) @ matrix.T + origin
+
+
+def extents(points) -> tuple:
+    """
+    :return: (min_x, min_y, max_x, max_y)
+    """
+    min_x, min_y = points.min(axis=0)
+    max_x, max_y = points.max(axis=0)
+    return float(min_x), float(min_y), float(max_x), float(max_y)
+
+
+def segment_extents(segments: dict, angle, origin=(0, 0)) -> dict:
+    """
+    rotate the points of every segment in one go and get the extents of each of them
+    :param segments:    {'nose': points, 'mouth': points, ...}, points in any form landmarks_to_array takes
+    :return:            {'nose': (min_x, min_y, max_x, max_y), ...}
+    """
+    names = list(segments)
+    sizes = [len(segments[name]) for name in names]
+    if not names or 0 in sizes:
+        raise ValueError('every segment needs at least one point')
+
+    points = list(chain.from_iterable(segments[name] for name in names))
+    rotated = rotate_points(landmarks_to_array(points), angle, origin)
+
+    offsets = np.cumsum([0] + sizes[:-1])
+    mins = np.minimum.reduceat(rotated, offsets, axis=0)
+    maxs = np.maximum.reduceat(rotated, offsets, axis=0)
+
+    return {name: (float(low[0]), float(low[1]), float(high[0]), float(high[1]))
+            for name, low, high in zip(names, mins, maxs)}
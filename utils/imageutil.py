@@ -1,15 +1,42 @@
+import io
 import json
 import math
+import os
 import pathlib
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, as_completed, wait
 
-from PIL import Image
 from django.conf import settings
 from django.core.files import File
 from djchoices import DjangoChoices, ChoiceItem
 from rest_framework import status
-from tencentcloud.common import credential
-from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
-from tencentcloud.iai.v20180301 import iai_client, models
+
+from apps.aiface.models import SegmentBlob
+from utils.blobstore import BlobStore
+from utils.fileutil import CHUNK_SIZE, stream_file
+from utils.geometry import extents, landmarks_to_array, rotate_points, segment_extents
+from utils.lazy import lazy_import
+from utils.resilience import ResilienceError, get_policy
+from utils.timing import stage, submit, timed
+
+# the tencent sdk and the imaging code load on first use, or in AifaceConfig.ready with AIFACE_PRELOAD
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+credential = lazy_import('tencentcloud.common.credential')
+sdk_exception = lazy_import('tencentcloud.common.exception.tencent_cloud_sdk_exception')
+client_profile = lazy_import('tencentcloud.common.profile.client_profile')
+http_profile = lazy_import('tencentcloud.common.profile.http_profile')
+iai_client = lazy_import('tencentcloud.iai.v20180301.iai_client')
+models = lazy_import('tencentcloud.iai.v20180301.models')
+
+
+class SegmentSaveError(Exception):
+    def __init__(self, errors: dict):
+        """
+        :param errors: {segment: exception} of every segment that failed to crop or save
+        """
+        self.errors = errors
+        super().__init__(', '.join(f'{segment}: {err!r}' for segment, err in errors.items()))
 
 
 class ImgSegments(DjangoChoices):
@@ -21,13 +48,15 @@ class ImgSegments(DjangoChoices):
     NOSE = ChoiceItem('nose')
 
 
-def get_img_path(segment, person_result, save=False):
+def get_img_path(segment, person_result, save=False, face_index=0):
     """
     :param segment:         which part of the face
     :param person_result:   to specify the file path (client_id) and file name (img_md5)
     :param save:            True：return a absolute path for saving file
                             False：return a relative path for combining url
+    :param face_index:      which face of the image, the first one keeps the plain name
     :return:                path pattern: facial/{client_id}/{segment}/{img_md5}.jpg || png
+                            facial/{client_id}/{segment}/{img_md5}_{face_index}.jpg for the other faces
     """
     if segment not in ImgSegments.values:
         raise ValueError('segment invalid')
@@ -39,13 +68,61 @@ def get_img_path(segment, person_result, save=False):
     if save:
         prefix_dir = pathlib.Path(settings.UPLOAD_DIR)
         element_path = prefix_dir.joinpath(element_path)
-        element_path.mkdir(parents=True, exist_ok=True)  # mkdir if doesn't exist
+        _mkdir(element_path)
 
-    img_path = element_path.joinpath(person_result.face_img_name).as_posix()
+    name = person_result.face_img_name
+    if face_index:
+        name = f'{pathlib.PurePath(name).stem}_{face_index}{pathlib.PurePath(name).suffix}'
+    img_path = element_path.joinpath(name).as_posix()
 
     return img_path
 
 
+_made_dirs = set()
+_made_dirs_lock = threading.Lock()
+
+
+def _mkdir(path: pathlib.Path):
+    # mkdir if doesn't exist, every client_id/segment directory only needs it once per process
+    if path in _made_dirs:
+        return
+    path.mkdir(parents=True, exist_ok=True)
+    with _made_dirs_lock:
+        _made_dirs.add(path)
+
+
+# what face_segments_save cuts out of every face
+FACE_SEGMENTS = (ImgSegments.FACE, ImgSegments.EYEBROW, ImgSegments.NOSE, ImgSegments.MOUTH)
+
+# every segment face_segments_save writes for a single face image, in the index of a stored image
+STORED_SEGMENTS = (ImgSegments.FULL,) + FACE_SEGMENTS
+
+
+def segment_key(segment, face_index=0) -> str:
+    """
+    SegmentBlob.segment of a face segment, 'face' for the first face, 'face_1' for the second
+    """
+    return f'{segment}_{face_index}' if face_index else segment
+
+
+def stored_segments(face_num) -> list:
+    """
+    :return: [(segment, face_index), ...] face_segments_save writes for face_num faces, the full image once
+    """
+    return [(ImgSegments.FULL, 0)] + [(segment, index) for index in range(face_num) for segment in FACE_SEGMENTS]
+
+
+_blob_store = None
+
+
+def get_blob_store() -> BlobStore:
+    global _blob_store
+    root = pathlib.Path(settings.AIFACE_BLOB_DIR or os.path.join(settings.UPLOAD_DIR, 'blobs'))
+    if _blob_store is None or _blob_store.root != root:
+        _blob_store = BlobStore(root)
+    return _blob_store
+
+
 def rotate_point(point: tuple, angle, origin=(0, 0)) -> tuple:
     """
     :param point: coordinate to be rotated
@@ -70,143 +147,317 @@ def rotate_polygon(polygon: list, angle, origin=(0, 0)) -> list:
     :param origin:
     :return: [(x, y), (x, y), ...]
     """
-    rotated_polygon = []
-    for corner in polygon:
-        rotated_corner = rotate_point(corner, angle, origin)
-        rotated_polygon.append(rotated_corner)
-    return rotated_polygon
+    rotated_polygon = rotate_points(landmarks_to_array(polygon), angle, origin)
+    return [tuple(corner) for corner in rotated_polygon.tolist()]
 
 
-def face_api(base64_img: str):
-    try:
-        # init a credential object
-        cred = credential.Credential(secretId=settings.QCLOUD_SID, secretKey=settings.QCLOUD_SKEY)
+def rotated_crops(img: 'Image.Image', boxes: list, angle, center, padding=4) -> list:
+    """
+    same crops as img.rotate(angle=-angle, resample=Image.BICUBIC).crop(box), but only the area around the
+    boxes gets rotated instead of the whole image
+    :param boxes:   [(left, top, right, bottom), ...] in the rotated image
+    :param angle:   the face Roll, as passed to rotate_point
+    :param center:  rotate center of the whole image
+    :param padding: extra pixels kept around the area for the bicubic filter
+    :return:        one image per box
+    """
+    # crop() rounds the box, round before shifting it so that .5 rounds the same way
+    boxes = [tuple(int(round(value)) for value in box) for box in boxes]
+
+    # the boxes themselves, and where their pixels come from in the origin image
+    corners = landmarks_to_array([(x, y) for left, top, right, bottom in boxes
+                                  for x in (left, right) for y in (top, bottom)])
+    sources = rotate_points(corners, -angle, origin=center)
+    min_x, min_y, max_x, max_y = extents(np.concatenate((corners, sources)))
+
+    region_left = math.floor(min_x) - padding
+    region_top = math.floor(min_y) - padding
+    region_box = (region_left, region_top, math.ceil(max_x) + padding, math.ceil(max_y) + padding)
+
+    region = img.crop(region_box).rotate(angle=-angle, resample=Image.BICUBIC,
+                                         center=(center[0] - region_left, center[1] - region_top))
+
+    return [region.crop((left - region_left, top - region_top, right - region_left, bottom - region_top))
+            for left, top, right, bottom in boxes]
+
+
+_local = threading.local()
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def _iai_client():
+    # IaiClient keeps its own connection state, so every executor thread gets one and keeps it
+    # until the settings it was made from change, e.g. override_settings pointing it at another endpoint
+    key = (settings.QCLOUD_PROTOCOL, settings.QCLOUD_ENDPOINT, settings.QCLOUD_SID, settings.QCLOUD_SKEY,
+           settings.AIFACE_API_DEADLINE)
+    cached = getattr(_local, 'iai_client', None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    cred = credential.Credential(secretId=settings.QCLOUD_SID, secretKey=settings.QCLOUD_SKEY)
+    profile = http_profile.HttpProfile(protocol=settings.QCLOUD_PROTOCOL, endpoint=settings.QCLOUD_ENDPOINT,
+                                       keepAlive=True, reqTimeout=settings.AIFACE_API_DEADLINE)
+    client = iai_client.IaiClient(
+        credential=cred, region='ap-guangzhou', profile=client_profile.ClientProfile(httpProfile=profile))
+    _local.iai_client = (key, client)
+    return client
+
 
-        # init a client object
-        client = iai_client.IaiClient(credential=cred, region='ap-guangzhou')
+def _get_executor(name, max_workers):
+    # created on first use so that forked workers never inherit the threads of the parent
+    with _executor_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            executor = _executors[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+    return executor
 
+
+# iai error codes worth another try, sub codes like InternalError.ServerError count as their prefix
+TENCENT_RETRYABLE = frozenset(('RequestLimitExceeded', 'InternalError', 'ResourceUnavailable', 'ClientNetworkError',
+                               'ServerNetworkError'))
+
+
+def tencent_retryable(result, error):
+    return (isinstance(error, sdk_exception.TencentCloudSDKException)
+            and str(error.code).split('.')[0] in TENCENT_RETRYABLE)
+
+
+def iai_call(action, api_request):
+    def call():
+        response = getattr(_iai_client(), action)(api_request)
+        return json.loads(response.to_json_string())
+
+    with stage(action):
+        return get_policy(f'tencent_{action}').call(call, retryable=tencent_retryable)
+
+
+@timed('face_api')
+def face_api(base64_img: str):
+    try:
         # request object
         detect_request = models.DetectFaceRequest()
         detect_request.Image = base64_img
         detect_request.NeedFaceAttributes = 1
         detect_request.NeedQualityDetection = 1
+        # AnalyzeFace returns the shapes of every face anyway
+        detect_request.MaxFaceNum = settings.AIFACE_MAX_FACES
 
         analyze_requset = models.AnalyzeFaceRequest()
         analyze_requset.Image = base64_img
 
-        # pass request object to response object
-        detect_response = client.DetectFace(detect_request)
-        analyze_response = client.AnalyzeFace(analyze_requset)
+        # both requests only need the image, send them at the same time
+        executor = _get_executor('face_api', settings.QCLOUD_MAX_WORKERS)
+        detect_future = submit(executor, iai_call, 'DetectFace', detect_request)
+        analyze_future = submit(executor, iai_call, 'AnalyzeFace', analyze_requset)
+
+        # report the first failure right away instead of waiting for the other call
+        done, _ = wait((detect_future, analyze_future), return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
 
         # Response needs a json object
-        api_result = json.loads(detect_response.to_json_string())
+        api_result = detect_future.result()
 
         # add analyze_data
         api_result.update({
-            'FaceShapeSet': json.loads(analyze_response.to_json_string()).get('FaceShapeSet')
+            'FaceShapeSet': analyze_future.result().get('FaceShapeSet')
         })
         status_code = status.HTTP_200_OK
 
-    except TencentCloudSDKException as err:
+    except sdk_exception.TencentCloudSDKException as err:
         api_result = err.message
         status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    except ResilienceError as err:
+        api_result = str(err)
+        status_code = status.HTTP_503_SERVICE_UNAVAILABLE
 
     return api_result, status_code
 
 
-def face_segments_save(data: dict, image: File, person_result):
-    img = Image.open(image)
+def match_face_shapes(data: dict) -> list:
+    """
+    DetectFace and AnalyzeFace each return their own list of faces, pair them up by where they are
+    :return: [(FaceInfo, FaceShape), ...] in FaceInfos order, faces without a shape are left out
+    """
+    infos = data.get('FaceInfos') or []
+    shapes = data.get('FaceShapeSet') or []
+    if len(infos) == 1 and len(shapes) == 1:
+        return [(infos[0], shapes[0])]
+    if not infos or not shapes:
+        return []
+
+    centers = np.array([(info['X'] + info['Width'] / 2, info['Y'] + info['Height'] / 2) for info in infos])
+    centroids = np.array([landmarks_to_array([point for part in shape.values() for point in part]).mean(axis=0)
+                          for shape in shapes])
+    distances = np.linalg.norm(centers[:, None] - centroids[None], axis=2)
+
+    # closest pairs first, every info and shape used once
+    pairs = {}
+    used = set()
+    for flat in np.argsort(distances, axis=None):
+        info_index, shape_index = divmod(int(flat), len(shapes))
+        if info_index not in pairs and shape_index not in used:
+            pairs[info_index] = shape_index
+            used.add(shape_index)
+    return [(infos[index], shapes[pairs[index]]) for index in range(len(infos)) if index in pairs]
+
+
+def draft_scale(img, faces: list, target) -> float:
+    """
+    let the jpeg decoder work at 1/2, 1/4 or 1/8 scale as long as the smallest face stays target px, must be called
+    before the image is loaded, other formats decode at full size
+    :param faces:   match_face_shapes output
+    :param target:  px on the longest side of the smallest face crop, None to always decode in full
+    :return:        decoded size / original size
+    """
+    if not target or not faces:
+        return 1
+    reduce = min(max(info['Width'], info['Height']) for info, _ in faces) / target
+    if reduce < 2:
+        return 1
 
-    # rotate center coordinate
-    x0 = img.width / 2
-    y0 = img.height / 2
+    width = img.width
+    img.draft(img.mode, (math.ceil(img.width / reduce), math.ceil(img.height / reduce)))
+    return img.width / width
 
-    # rotate origin image
-    angle = data['FaceInfos'][0]['FaceAttributesInfo']['Roll']
 
-    img = img.rotate(angle=-angle, resample=Image.BICUBIC)
+def scale_faces(faces: list, scale) -> list:
+    """
+    copies of match_face_shapes output with every coordinate multiplied by scale, Roll stays as it is
+    """
+    scaled = []
+    for info, shape in faces:
+        info = {**info, **{key: info[key] * scale for key in ('X', 'Y', 'Width', 'Height')}}
+        shape = {part: [{**point, 'X': point['X'] * scale, 'Y': point['Y'] * scale} for point in points]
+                 for part, points in shape.items()}
+        scaled.append((info, shape))
+    return scaled
 
-    def rotate_shortcut(segment_data):
-        segment_data = [rotate_point(origin=(x0, y0), point=(point['X'], point['Y']), angle=angle) for point in
-                        segment_data]
-        return [y for x, y in segment_data]
 
-    def save_shortcut(segment, file):
-        save_path = get_img_path(segment=segment, save=True, person_result=person_result)
-        file.save(fp=save_path)
+def face_boxes(face_data: dict, segments_data: dict, center: tuple) -> tuple:
+    """
+    :param face_data:       item of FaceInfos
+    :param segments_data:   the matching item of FaceShapeSet
+    :param center:          rotate center of the whole image
+    :return:                (angle, {segment: (left, top, right, bottom)}) in the image rotated by angle
+    """
+    x0, y0 = center
 
-    face_data = data['FaceInfos'][0]
+    # rotate angle of the face, only the face area gets rotated, see rotated_crops
+    angle = face_data['FaceAttributesInfo']['Roll']
 
     # face origin coordinate
     left = face_data['X']
-    right = left + face_data['Width']
     top = face_data['Y']
-    bottom = top + face_data['Height']
 
     face_center = (left + face_data['Width']/2, top + face_data['Height']/2)
     face_center = rotate_point(origin=(x0, y0), point=face_center, angle=angle)
 
-    # here cause some problem, right or bottom larger than left or top
+    # the face box around its center in the rotated image
     left = face_center[0] - face_data['Width']/2
-    right = face_center[1] + face_data['Width']/2
-    top = face_center[0] - face_data['Height']/2
+    right = face_center[0] + face_data['Width']/2
+    top = face_center[1] - face_data['Height']/2
     bottom = face_center[1] + face_data['Height']/2
 
-    # # face coordinate rotate # after img.rotate
-    # polygon = [(left, top), (right, top), (right, bottom), (left, bottom)]
-    # face_polygon = rotate_polygon(origin=(x0, y0), polygon=polygon, angle=angle)
-    # horizontal = [x for x, y in face_polygon]
-    # vertical = [y for x, y in face_polygon]
-    #
-    # left = min(horizontal)
-    # top = min(vertical)
-    # # right = left + face_data['Width']
-    # # bottom = top + face_data['Height']
-    # right = max(horizontal)
-    # bottom = max(vertical)
-
-    # face crop
-    face = img.crop((left, top, right, bottom))
-    # face = face.rotate(angle=-angle, resample=Image.BICUBIC)  # before img.rotate
-    save_shortcut(segment=ImgSegments.FACE, file=face)
-
-    segments_data = data['FaceShapeSet'][0]
-
-    # eyebrow coordinate
-    eyebrow_data = segments_data['LeftEyeBrow']
-    eyebrow_data += segments_data['RightEyeBrow']
-    eyebrow_height = rotate_shortcut(eyebrow_data)
-    # eyebrow crop
-    eyebrow = img.crop((left, min(eyebrow_height), right, max(eyebrow_height)))
-    save_shortcut(segment=ImgSegments.EYEBROW, file=eyebrow)
-
-    # nose coordinate
-    nose_height = rotate_shortcut(segments_data['Nose'])
-    # nose crop
-    nose = img.crop((left, min(nose_height), right, max(nose_height)))
-    save_shortcut(segment=ImgSegments.NOSE, file=nose)
-
-    # mouth coordinate
-    mouth_height = rotate_shortcut(segments_data['Mouth'])
-    # mouth crop
-    mouth = img.crop((left, min(mouth_height), right, max(mouth_height)))
-    save_shortcut(segment=ImgSegments.MOUTH, file=mouth)
-
-    # save the origin full image
-    file_path = get_img_path(segment=ImgSegments.FULL, save=True, person_result=person_result)
-    with pathlib.Path(file_path).open('wb+') as des:
-        for chunk in image.chunks():
-            des.write(chunk)
+    # rotate the feature points of the face in one batch
+    features = segment_extents({
+        ImgSegments.EYEBROW: segments_data['LeftEyeBrow'] + segments_data['RightEyeBrow'],
+        ImgSegments.NOSE: segments_data['Nose'],
+        ImgSegments.MOUTH: segments_data['Mouth'],
+    }, angle=angle, origin=(x0, y0))
+
+    # face, eyebrow, nose, mouth crop
+    boxes = {ImgSegments.FACE: (left, top, right, bottom)}
+    boxes.update({segment: (left, min_y, right, max_y) for segment, (_, min_y, _, max_y) in features.items()})
+    return angle, boxes
 
-    # return data after rotated
-    return data
 
+@timed('face_segments_save')
+def face_segments_save(data: dict, image: File, person_result):
+    """
+    crop and save the segments of every face in data, see get_img_path for where face n ends up
+    """
+    # files are stored once by content in the blob store, the usual paths are links to them
+    store = get_blob_store()
+    client_id = str(person_result.user.client_id)
+    ext = pathlib.Path(person_result.face_img_name).suffix
+    faces = match_face_shapes(data)
+
+    # crops made for another AIFACE_SEGMENT_SIZE don't count, they are cropped again
+    stored = SegmentBlob.lookup(client_id, person_result.face_img_name, size=settings.AIFACE_SEGMENT_SIZE)
+    expected = stored_segments(len(faces))
+    if all(segment_key(segment, index) in stored and (store.root / stored[segment_key(segment, index)]).exists()
+           for segment, index in expected):
+        # this client sent the same image before, nothing to crop or encode
+        for segment, index in expected:
+            store.link(store.root / stored[segment_key(segment, index)],
+                       get_img_path(segment, person_result, save=True, face_index=index))
+        return data
+
+    # decoded once up front, the crops of every face read it from several threads
+    img = Image.open(image)
+    scale = draft_scale(img, faces, settings.AIFACE_SEGMENT_SIZE)
+    if scale != 1:
+        # the crops come out smaller by the same factor, data keeps the coordinates of the upload
+        faces = scale_faces(faces, scale)
+    with stage('segments_decode'):
+        img.load()
 
-def calculate_file(file_, hasher, chunk_size=65536):
-    chunks = b''.join([chunk for chunk in file_.chunks(chunk_size)])
-    result = {}
+    # rotate center coordinate
+    center = (img.width / 2, img.height / 2)
+
+    # the boxes of all the faces before any pixel is touched
+    layouts = [face_boxes(face_data, segments_data, center) for face_data, segments_data in faces]
+
+    def save_shortcut(segment, file, face_index):
+        buffer = io.BytesIO()
+        file.save(buffer, format=Image.registered_extensions()[ext.lower()])
+        digest, path, _ = store.put_bytes(buffer.getvalue(), ext)
+        store.link(path, get_img_path(segment=segment, save=True, person_result=person_result, face_index=face_index))
+        return digest, path
+
+    def save_full():
+        digest, path, _ = store.put_chunks(image.chunks(), ext)
+        store.link(path, get_img_path(segment=ImgSegments.FULL, save=True, person_result=person_result))
+        return digest, path
+
+    # rotating and encoding release the GIL, every face is cropped and every crop saved at the same time
+    # crops and saves run on separate pools, a crop never waits for a thread its own saves need
+    crop_executor = _get_executor('segment_crop', settings.SEGMENT_SAVE_WORKERS)
+    save_executor = _get_executor('segment_save', settings.SEGMENT_SAVE_WORKERS)
+    futures = {submit(save_executor, save_full): ImgSegments.FULL}
+
+    with stage('segments_crop'):
+        crop_futures = {submit(crop_executor, rotated_crops, img, list(boxes.values()), angle=angle, center=center):
+                        (index, boxes) for index, (angle, boxes) in enumerate(layouts)}
+        # a face that fails to crop fails all of its segments, the other faces still go on to be saved
+        errors = {}
+        for crop_future in as_completed(crop_futures):
+            index, boxes = crop_futures[crop_future]
+            if crop_future.exception() is not None:
+                errors.update({segment_key(segment, index): crop_future.exception() for segment in boxes})
+                continue
+            for segment, crop in zip(boxes, crop_future.result()):
+                future = submit(save_executor, save_shortcut, segment=segment, file=crop, face_index=index)
+                futures[future] = segment_key(segment, index)
+
+    with stage('segments_save'):
+        wait(futures)
+    errors.update({segment: future.exception() for future, segment in futures.items() if future.exception()})
+    if errors:
+        raise SegmentSaveError(errors)
+
+    saved = {segment: future.result() for future, segment in futures.items()}
+    SegmentBlob.record(client_id, person_result.face_img_name, {
+        segment: (digest, path.relative_to(store.root).as_posix()) for segment, (digest, path) in saved.items()
+    }, size=settings.AIFACE_SEGMENT_SIZE)
+
+    # return data after rotated
+    return data
 
-    result['base64'] = base64.b64encode(chunks).decode() if 'base64' in hasher else ''
-    result['md5'] = hashlib.md5(chunks).hexdigest() if 'md5' in hasher else ''
 
-    return result
\ No newline at end of file
+def calculate_file(file_, hasher, chunk_size=CHUNK_SIZE):
+    hasher = [name for name in ('base64', 'md5') if name in hasher]
+    return stream_file(file_, hasher=hasher, chunk_size=chunk_size)
@@ -1,6 +1,8 @@
 import json
 import math
+import os
 import pathlib
+import tempfile
 
 from PIL import Image
 from django.conf import settings
@@ -11,6 +13,9 @@ from tencentcloud.common import credential
 from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
 from tencentcloud.iai.v20180301 import iai_client, models
 
+from utils.geometry import extents, landmarks_to_array, rotate_points, rotation_matrix
+from utils.imageutil import rotated_crops
+
 
 class ImgSegments(DjangoChoices):
     AVATAR = ChoiceItem('avatar')
@@ -64,14 +69,21 @@ class FaceCrop:
         # 旋转条件数据
         self.center_point = (self.img.width / 2, self.img.height / 2)
         self.angle = api_data['FaceInfos'][0]['FaceAttributesInfo']['Roll']
+        self.rotation = rotation_matrix(self.angle)  # 每张脸只算一次
         self.rotated = False
 
     def crop_and_save(self):
         self._crop_and_save(feature_points=self.face_points, feature_type=ImgSegments.FACE)
-        self.img = self._rotate_image(image=self.img)
-        self._crop_and_save(feature_points=self.eyebrow_points, feature_type=ImgSegments.EYEBROW)
-        self._crop_and_save(feature_points=self.nose_points, feature_type=ImgSegments.NOSE)
-        self._crop_and_save(feature_points=self.mouth_points, feature_type=ImgSegments.MOUTH)
+
+        # 只旋转五官所在的区域，不再旋转整张原图
+        features = {
+            ImgSegments.EYEBROW: self.eyebrow_points,
+            ImgSegments.NOSE: self.nose_points,
+            ImgSegments.MOUTH: self.mouth_points,
+        }
+        crops = rotated_crops(self.img, list(features.values()), angle=self.angle, center=self.center_point)
+        for feature_type, feature_obj in zip(features, crops):
+            self._save_shortcut(feature_type=feature_type, file=feature_obj)
         return self._rotated_api_data
 
     @property
@@ -123,18 +135,24 @@ class FaceCrop:
 
     def _save_shortcut(self, feature_type, file):
         save_path = get_img_path(segment=feature_type, save=True, person_result=self.person_result)
-        if feature_type == ImgSegments.FULL:  # 原图保存
-            with pathlib.Path(save_path).open('wb+') as des:
-                for chunk in self.origin_img.chunks():
-                    des.write(chunk)
-        file.save(fp=save_path)
+        # save_path may be a hard link to a shared blob, see BlobStore.link: written next to it, then swapped in
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(save_path), suffix=pathlib.Path(save_path).suffix)
+        try:
+            with os.fdopen(fd, 'wb+') as des:
+                if feature_type == ImgSegments.FULL:  # 原图保存
+                    for chunk in self.origin_img.chunks():
+                        des.write(chunk)
+            file.save(fp=tmp)
+            os.replace(tmp, save_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
 
     def _range_point(self, points):
-        points = [self._rotate_point(point=(point['X'], point['Y'])) for point in points]
-        range_x = [x for x, y in points]
-        range_y = [y for x, y in points]
-        return {'max_x': max(range_x), 'min_x': min(range_x),
-                'max_y': max(range_y), 'min_y': min(range_y)}
+        points = rotate_points(landmarks_to_array(points), self.angle, self.center_point, matrix=self.rotation)
+        min_x, min_y, max_x, max_y = extents(points)
+        return {'max_x': max_x, 'min_x': min_x,
+                'max_y': max_y, 'min_y': min_y}
 
     def _rotate_image(self, image):
         if image == self.img:
@@ -151,8 +169,9 @@ class FaceCrop:
         return new_point
 
     def _rotate_polygon(self, polygon: list) -> list:
-        rotated_polygon = [self._rotate_point(corner) for corner in polygon]
-        return rotated_polygon
+        rotated_polygon = rotate_points(landmarks_to_array(polygon), self.angle, self.center_point,
+                                        matrix=self.rotation)
+        return [tuple(corner) for corner in rotated_polygon.tolist()]
 
     @property
     def _rotated_api_data(self):
@@ -0,0 +1,65 @@
+import importlib
+import sys
+import threading
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    stands in for a module until one of its attributes is used, then imports it and takes over its namespace
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_lock'] = threading.Lock()
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        with self._lazy_lock:
+            if self._lazy_module is None:
+                module = importlib.import_module(self.__name__)
+                # later lookups hit the copied namespace and never come through __getattr__ again
+                self.__dict__.update(module.__dict__)
+                self.__dict__['_lazy_module'] = module
+        return self._lazy_module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        state = 'loaded' if self._lazy_module is not None else 'not loaded'
+        return f'<lazy module {self.__name__!r}, {state}>'
+
+
+def lazy_import(name) -> types.ModuleType:
+    """
+    np = lazy_import('numpy')
+
+    the module itself when something already imported it, see preload to import every lazy module up front
+    """
+    with _registry_lock:
+        lazy = _registry.setdefault(name, LazyModule(name))
+    # registered either way, lazy_modules has to list what something imported too early
+    module = sys.modules.get(name)
+    return module if module is not None else lazy
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def lazy_modules() -> list:
+    return sorted(_registry)
+
+
+def preload(names=None):
+    """
+    import the lazy modules now, e.g. in the gunicorn master before it forks
+    :param names: all of them by default
+    """
+    for name in names or lazy_modules():
+        lazy = _registry.get(name)
+        if lazy is not None:
+            lazy._load()
+        else:
+            importlib.import_module(name)
@@ -0,0 +1,319 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from utils.lazy import lazy_import
+from utils.timing import record, submit
+
+# only call_async needs it, that is the asgi process
+asyncio = lazy_import('asyncio')
+
+
+class ResilienceError(Exception):
+    pass
+
+
+class CircuitOpen(ResilienceError):
+    pass
+
+
+class DeadlineExceeded(ResilienceError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    closed:     calls go through, `failures` failures in a row open the breaker
+    open:       calls fail fast for `reset_timeout` seconds
+    half open:  a single probe call goes through, it closes the breaker again or re-opens it
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._count = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        return self.admit() is not None
+
+    def admit(self):
+        """
+        :return: None when the call must fail fast, otherwise whether it is the half open probe,
+                 a probe must end in success, failure or release
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state, self._probing = self.HALF_OPEN, False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return None
+
+    def success(self):
+        with self._lock:
+            self.state, self._count, self._probing = self.CLOSED, 0, False
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self.state == self.HALF_OPEN or self._count >= self.failures:
+                self.state, self._opened_at, self._probing = self.OPEN, time.monotonic(), False
+
+    def release(self):
+        """
+        after a probe that ended without an answer, e.g. cancelled, it counts as a failure
+        otherwise the breaker would wait for it forever and never let another call through
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probing:
+                self.state, self._opened_at, self._probing = self.OPEN, time.monotonic(), False
+
+
+class LatencyWindow:
+    """
+    latencies of the last `size` successful calls
+    """
+
+    def __init__(self, size=256):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percent):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def _always_on_error(result, error):
+    return error is not None
+
+
+class Resilient:
+    """
+    runs one vendor call with a deadline, jittered retries, a hedged duplicate once the call is slower than
+    `hedge_percentile` of the recent ones, and a circuit breaker in front of it all
+    """
+
+    def __init__(self, name, deadline=10, max_attempts=3, backoff=0.1, backoff_max=2, hedge_percentile=95,
+                 hedge_min_samples=20, breaker=None, max_workers=16):
+        """
+        :param deadline:            seconds for the whole call, retries and hedges included
+        :param backoff:             the n-th retry waits a random time up to backoff * 2 ** (n - 1), backoff_max at most
+        :param hedge_percentile:    None to never hedge
+        :param hedge_min_samples:   successful calls needed before the percentile is trusted
+        """
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyWindow()
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _submit(self, func):
+        with self._lock:
+            # executor threads don't survive a fork
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+            return submit(self._executor, self._timed, func)
+
+    def _timed(self, func):
+        start = time.monotonic()
+        result = func()
+        self.latency.add(time.monotonic() - start)
+        return result
+
+    def hedge_delay(self):
+        if self.hedge_percentile is None or len(self.latency) < self.hedge_min_samples:
+            return None
+        return self.latency.percentile(self.hedge_percentile)
+
+    def call(self, func, retryable=_always_on_error):
+        """
+        :param func:        no-arg callable making one request, it may run several times and on several threads at once
+        :param retryable:   (result, error) -> bool, error is what func raised, result what it returned otherwise
+        :return:            what func returned, the last retryable result when every attempt got one
+        :raise:             CircuitOpen, DeadlineExceeded or the exception of the last attempt
+        """
+        probe = self.breaker.admit()
+        if probe is None:
+            raise CircuitOpen(f'{self.name}: 服务暂时不可用, {self.breaker.reset_timeout}秒后重试')
+        try:
+            return self._call(func, retryable)
+        finally:
+            if probe:
+                self.breaker.release()
+
+    def _call(self, func, retryable):
+        end = time.monotonic() + self.deadline
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                result = self._attempt(func, end, retryable)
+            except DeadlineExceeded:
+                self.breaker.failure()
+                raise
+            except Exception as err:
+                if not retryable(None, err):
+                    self.breaker.success()  # the vendor answered, the request was the problem
+                    raise
+                self.breaker.failure()
+                if attempt == self.max_attempts or not self._backoff(attempt, end):
+                    raise
+                continue
+
+            if not retryable(result, None):
+                self.breaker.success()
+                return result
+            self.breaker.failure()
+            if attempt == self.max_attempts or not self._backoff(attempt, end):
+                return result
+
+    async def call_async(self, func, retryable=_always_on_error):
+        """
+        call for coroutines, same deadline, retries and breaker but no hedging: a slow call only holds a socket
+        :param func:    no-arg callable returning an awaitable that makes one request
+        """
+        probe = self.breaker.admit()
+        if probe is None:
+            raise CircuitOpen(f'{self.name}: 服务暂时不可用, {self.breaker.reset_timeout}秒后重试')
+        try:
+            return await self._call_async(func, retryable)
+        finally:
+            if probe:
+                self.breaker.release()
+
+    async def _call_async(self, func, retryable):
+        end = time.monotonic() + self.deadline
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                result = await asyncio.wait_for(func(), end - time.monotonic())
+            except asyncio.TimeoutError:
+                self.breaker.failure()
+                raise DeadlineExceeded(f'{self.name}: 超过{self.deadline}秒')
+            except Exception as err:
+                if not retryable(None, err):
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                delay = None if attempt == self.max_attempts else self._backoff_delay(attempt, end)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            if not retryable(result, None):
+                self.breaker.success()
+                return result
+            self.breaker.failure()
+            delay = None if attempt == self.max_attempts else self._backoff_delay(attempt, end)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+
+    def _backoff_delay(self, attempt, end):
+        """
+        :return: seconds to wait before the next attempt, None when it would not fit in the deadline or the
+                 breaker opened
+        """
+        if self.breaker.state == CircuitBreaker.OPEN:
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+        if time.monotonic() + delay >= end:
+            return None
+        record(f'{self.name}_retry', delay)
+        return delay
+
+    def _backoff(self, attempt, end) -> bool:
+        """
+        sleep before the next attempt, False when there is none
+        """
+        delay = self._backoff_delay(attempt, end)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    def _attempt(self, func, end, retryable):
+        """
+        one attempt, hedged: the first good answer wins, a bad one only counts once every copy has finished
+        """
+        pending = {self._submit(func)}
+        delay = self.hedge_delay()
+        hedge_at = None if delay is None else time.monotonic() + delay
+        first_bad = None
+
+        while pending:
+            now = time.monotonic()
+            if now >= end:
+                raise DeadlineExceeded(f'{self.name}: 超过{self.deadline}秒')
+            wake = end if hedge_at is None else min(end, hedge_at)
+            done, pending = wait(pending, timeout=wake - now, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                error = future.exception()
+                if error is None and not retryable(future.result(), None):
+                    return future.result()
+                if error is not None and not retryable(None, error):
+                    raise error
+                first_bad = first_bad or future
+
+            if pending and hedge_at is not None and time.monotonic() >= hedge_at:
+                hedge_at = None
+                record(f'{self.name}_hedge', delay)
+                pending.add(self._submit(func))
+
+        # nobody is waiting for the slower copies, they finish in the background
+        return first_bad.result()
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(name) -> Resilient:
+    """
+    one Resilient per vendor api, configured by the AIFACE_API_* settings
+    """
+    with _policies_lock:
+        policy = _policies.get(name)
+        if policy is None:
+            policy = _policies[name] = Resilient(
+                name,
+                deadline=settings.AIFACE_API_DEADLINE,
+                max_attempts=settings.AIFACE_API_MAX_ATTEMPTS,
+                backoff=settings.AIFACE_API_BACKOFF,
+                backoff_max=settings.AIFACE_API_BACKOFF_MAX,
+                hedge_percentile=settings.AIFACE_API_HEDGE_PERCENTILE,
+                hedge_min_samples=settings.AIFACE_API_HEDGE_MIN_SAMPLES,
+                breaker=CircuitBreaker(settings.AIFACE_BREAKER_FAILURES, settings.AIFACE_BREAKER_RESET_TIMEOUT),
+                max_workers=settings.AIFACE_API_WORKERS,
+            )
+        return policy
@@ -0,0 +1,96 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+# a line of python -X importtime: "import time:   self [us] | cumulative | <2 spaces per level>name"
+_IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+# run in a fresh interpreter, from nothing imported to the response of the first request
+# argv: path, wsgi or asgi, the asgi entry is config.asgi with the request sent straight to its application
+_PROBE = '''
+import json, sys, time
+path, entry = sys.argv[1:3]
+start = time.perf_counter()
+if entry == 'asgi':
+    import asyncio
+    import config.asgi
+    setup = time.perf_counter()
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': b'', 'headers': [],
+             'http_version': '1.1'}
+    asyncio.run(config.asgi.application(scope, receive, send))
+    status_code = sent[0]['status']
+else:
+    import django
+    django.setup()
+    setup = time.perf_counter()
+    from django.test import Client
+    status_code = Client().get(path).status_code
+first_request = time.perf_counter()
+from utils.lazy import lazy_modules
+# an asgi server runs on asyncio anyway
+exempt = ('asyncio',) if entry == 'asgi' else ()
+print(json.dumps({
+    'setup': setup - start,
+    'first_request': first_request - start,
+    'status': status_code,
+    'eager': [name for name in lazy_modules() if name in sys.modules and name not in exempt],
+}))
+'''
+
+ENTRIES = ('wsgi', 'asgi')
+
+
+def parse_importtime(text) -> list:
+    """
+    :return: [(depth, name, self seconds, cumulative seconds), ...] parents first, in import order
+    """
+    # a module is printed once all of its imports are done, so children come before their parent
+    stack = [[]]
+    for line in text.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        depth = len(indent) // 2
+        while len(stack) <= depth + 1:
+            stack.append([])
+        children = stack[depth + 1]
+        stack[depth + 1] = []
+        stack[depth].append((depth, name, int(self_us) / 1e6, int(cumulative_us) / 1e6, children))
+
+    def flatten(nodes):
+        for depth, name, self_seconds, cumulative, children in nodes:
+            yield depth, name, self_seconds, cumulative
+            yield from flatten(children)
+
+    return list(flatten(stack[0]))
+
+
+def profile(path='/metrics/', settings_module=None, entry='wsgi') -> dict:
+    """
+    boot django in a child interpreter and serve one request
+    :param entry:   wsgi for django.setup and the test client, asgi for config.asgi.application
+    :return: {'setup': seconds, 'first_request': seconds, 'status': code, 'eager': [lazy modules imported],
+              'imports': parse_importtime output}
+    """
+    env = dict(os.environ)
+    if settings_module:
+        env['DJANGO_SETTINGS_MODULE'] = settings_module
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', _PROBE, path, entry], env=env,
+                          capture_output=True, text=True, cwd=os.getcwd(), check=False)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+
+    report = json.loads(proc.stdout.strip().splitlines()[-1])
+    report['imports'] = parse_importtime(proc.stderr)
+    return report
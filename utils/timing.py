@@ -0,0 +1,122 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds, prometheus style
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# (name, seconds) of the stages run for the current request, None outside of a request
+_entries = contextvars.ContextVar('timing_entries', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def record(name, seconds):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    histogram.observe(seconds)
+
+    entries = _entries.get()
+    if entries is not None:
+        entries.append((name, seconds))
+
+
+@contextmanager
+def stage(name):
+    """
+    with stage('detect'):
+        client.detect(...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """
+    @timed('face_api')
+    def face_api(...):
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def submit(executor, func, *args, **kwargs):
+    """
+    executor.submit in a copy of the current context, the stages func times in the worker count for this request
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+def begin_request():
+    return _entries.set([])
+
+
+def end_request(token) -> list:
+    entries = _entries.get()
+    _entries.reset(token)
+    return entries or []
+
+
+def server_timing(entries) -> str:
+    """
+    :param entries: [(name, seconds), ...], repeated names are added up
+    :return:        Server-Timing header value, durations in milliseconds
+    """
+    totals = {}
+    for name, seconds in entries:
+        totals[name] = totals.get(name, 0) + seconds
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in totals.items())
+
+
+def prometheus(metric='aiface_stage_seconds') -> str:
+    lines = [f'# HELP {metric} Time spent in each stage of the aiface request handling.',
+             f'# TYPE {metric} histogram']
+
+    with _histograms_lock:
+        histograms = sorted(_histograms.items())
+
+    for name, histogram in histograms:
+        counts, total, count = histogram.snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{stage="{name}"}} {total}')
+        lines.append(f'{metric}_count{{stage="{name}"}} {count}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,136 @@
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """
+    an oauth token shared by every process on the host through a json file
+
+    whoever holds the lock file fetches, the others read what it wrote. a daemon thread per process
+    refreshes `margin` seconds before expiry, so requests only ever wait for the very first token
+    """
+
+    def __init__(self, path, fetch, margin=86400, retry_interval=60, background=True):
+        """
+        :param fetch:           no-arg callable returning the token dict, with 'expires_in' seconds,
+                                a dict without `access_token` is an error and is never stored
+        :param margin:          seconds before expiry the refresh starts
+        :param retry_interval:  seconds between refresh attempts after a failed one
+        :param background:      False to leave the refresh to the callers
+        """
+        self.path = pathlib.Path(path)
+        self.fetch = fetch
+        self.margin = margin
+        self.retry_interval = retry_interval
+        self.background = background
+        self._token = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @staticmethod
+    def expires_at(token) -> float:
+        return token['time'] + int(token.get('expires_in', 0))
+
+    def _fresh(self, token, margin=30) -> bool:
+        return token is not None and time.time() < self.expires_at(token) - margin
+
+    @contextmanager
+    def _file_lock(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(f'{self.path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, token):
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix='.tmp')  # 0600, it is a credential
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(token, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _load(self, margin, stale=None) -> dict:
+        """
+        the token from the file, fetched first when it expires within margin seconds or is `stale`
+        """
+        with self._file_lock():
+            token = self._read()
+            if self._fresh(token, margin) and (stale is None or token['access_token'] != stale):
+                return token
+
+            token = self.fetch()
+            if 'access_token' not in token:
+                return token  # let the caller see the error, the next call tries again
+            token.setdefault('time', int(time.time()))
+            self._write(token)
+            return token
+
+    def get(self, stale=None) -> dict:
+        """
+        :param stale:   an access_token the api just rejected, it is replaced unless someone already did
+        """
+        self._start_refresher()
+        token = self._token
+        if self._fresh(token) and (stale is None or token['access_token'] != stale):
+            return token
+
+        with self._lock:
+            token = self._token
+            if self._fresh(token) and (stale is None or token['access_token'] != stale):
+                return token
+            token = self._load(30, stale)
+            if 'access_token' in token:
+                self._token = token
+            return token
+
+    def refresh(self) -> float:
+        """
+        :return: seconds until the next refresh is due
+        """
+        try:
+            token = self._load(self.margin)
+        except Exception:
+            logger.exception('token refresh failed')
+            return self.retry_interval
+        if 'access_token' not in token:
+            logger.error('token refresh failed: %s', token)
+            return self.retry_interval
+
+        self._token = token
+        return max(self.retry_interval, self.expires_at(token) - self.margin - time.time())
+
+    def _start_refresher(self):
+        # threads don't survive a fork, every worker process starts its own
+        if not self.background or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._refresh_forever, name='token_refresh', daemon=True).start()
+
+    def _refresh_forever(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.refresh())